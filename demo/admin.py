@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, UserProfile, ProfileImage, Product, Images, Rating
+from .models import User, UserProfile, ProfileImage, Product, Images, Rating, Job
 
 
 admin.site.register(User)
@@ -8,3 +8,4 @@ admin.site.register(ProfileImage)
 admin.site.register(Product)
 admin.site.register(Images)
 admin.site.register(Rating)
+admin.site.register(Job)
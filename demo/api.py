@@ -0,0 +1,147 @@
+"""Read-only JSON API over the service feeds and profiles.
+
+For the mobile app and partner widgets, which otherwise scrape the HTML pages:
+
+  - ``/api/feeds/<service>/`` takes the filters of the feed pages (``q``,
+    ``city``, ``min_rating``, ``per_page``) and is paged by ``after``/``before``
+    cursors, or by ``page`` numbers when searching (relevance order);
+  - ``/api/profiles/<pk>/`` returns one profile with its photos.
+
+Rows are read with ``values()``, so no model instances are built. Every
+response carries a strong ETag computed from the ``updated_at`` stamps of the
+profiles it contains, which any change to a profile, its owner, photos or
+ratings bumps (see ``UserProfile.touch``). A client that sends it back in
+``If-None-Match`` gets an empty ``304 Not Modified``: for a profile that
+costs one single-row query, for a feed the page query alone.
+"""
+import hashlib
+import json
+
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.http import Http404, JsonResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.text import slugify
+from django.views.decorators.http import require_safe
+
+from .images import DERIVATIVE_FORMATS, Derivatives
+from .models import SERVICE_TYPE_CHOICES, ProfileImage, UserProfile
+from .pagination import CursorPage
+from .views import _feed_filters, _feed_per_page, _service_feed_queryset
+
+# part of every ETag: bump when the shape of the responses changes
+API_VERSION = 1
+SERVICE_SLUGS = {slugify(label): label for label, _ in SERVICE_TYPE_CHOICES}
+
+# rank_score is only read for the cursor
+FEED_FIELDS = ('pk', 'company_name', 'service_type', 'company_description', 'logo',
+               'avg_rating', 'rating_count', 'rank_score', 'updated_at')
+PROFILE_FIELDS = FEED_FIELDS + ('office_address', 'office_number')
+
+
+def _etag(*parts):
+    digest = hashlib.sha256(json.dumps([API_VERSION, *parts], cls=DjangoJSONEncoder).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def _conditional_json(request, etag, build_payload):
+    """A 304 if the client has the ``etag`` version, else the JSON of ``build_payload()``."""
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse(build_payload())
+    response['ETag'] = etag
+    # clients may keep the response but must revalidate it
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _image(field, name, ready=None):
+    """URL of an uploaded image plus its derivative ``srcset``s once they exist."""
+    if not name:
+        return None
+    fieldfile = field.attr_class(None, field, name)
+    derivatives = Derivatives(fieldfile)
+    image = {'url': fieldfile.url}
+    if derivatives.exists() if ready is None else ready:
+        image['srcset'] = {fmt: derivatives.srcset(fmt) for fmt in DERIVATIVE_FORMATS}
+    return image
+
+
+def _profile(row):
+    return {
+        'id': row['pk'],
+        'url': reverse('api_profile', args=[row['pk']]),
+        'company_name': row['company_name'],
+        'service_type': row['service_type'],
+        'description': row['company_description'],
+        'city': row['city'],
+        'logo': _image(UserProfile._meta.get_field('logo'), row['logo']),
+        'avg_rating': row['avg_rating'],
+        'rating_count': row['rating_count'],
+        'updated_at': row['updated_at'],
+    }
+
+
+def _page_link(request, **params):
+    query = request.GET.copy()
+    for key in ('after', 'before', 'page'):
+        query.pop(key, None)
+    query.update(params)
+    return f'{request.path}?{query.urlencode()}'
+
+
+@require_safe
+def service_feed(request, service):
+    service_label = SERVICE_SLUGS.get(service)
+    if service_label is None:
+        raise Http404('Unknown service type')
+    q, city, min_rating = _feed_filters(request)
+    per_page = _feed_per_page(request)
+    rows = _service_feed_queryset(service_label, q, city, min_rating).values(*FEED_FIELDS, city=F('user__city'))
+
+    if q:
+        # search results are ordered by relevance, which the cursor does not encode
+        page = Paginator(rows, per_page).get_page(request.GET.get('page'))
+        rows = list(page.object_list)
+        next_link = _page_link(request, page=page.next_page_number()) if page.has_next() else None
+        previous_link = _page_link(request, page=page.previous_page_number()) if page.has_previous() else None
+    else:
+        page = CursorPage(rows, per_page, after=request.GET.get('after'), before=request.GET.get('before'))
+        rows = page.object_list
+        next_link = _page_link(request, after=page.next_cursor) if page.has_next() else None
+        previous_link = _page_link(request, before=page.previous_cursor) if page.has_previous() else None
+
+    etag = _etag(
+        'feed', service_label, [(row['pk'], row['updated_at']) for row in rows], next_link, previous_link,
+    )
+    return _conditional_json(request, etag, lambda: {
+        'service_type': service_label,
+        'results': [_profile(row) for row in rows],
+        'next': next_link,
+        'previous': previous_link,
+    })
+
+
+@require_safe
+def profile(request, pk):
+    row = UserProfile.objects.filter(pk=pk).values(*PROFILE_FIELDS, city=F('user__city')).first()
+    if row is None:
+        raise Http404('No such profile')
+
+    def build_payload():
+        image_field = ProfileImage._meta.get_field('image')
+        photos = ProfileImage.objects.filter(profile_id=pk).order_by('pk').values('pk', 'image', 'processing_status')
+        return {
+            **_profile(row),
+            'office_address': row['office_address'],
+            'office_number': row['office_number'],
+            'photos': [
+                {'id': photo['pk'], **_image(image_field, photo['image'],
+                                             ready=photo['processing_status'] == ProfileImage.READY)}
+                for photo in photos if photo['image']
+            ],
+        }
+
+    return _conditional_json(request, _etag('profile', pk, row['updated_at']), build_payload)
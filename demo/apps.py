@@ -5,4 +5,5 @@ class DemoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'demo'
 
-    
\ No newline at end of file
+    def ready(self):
+        from . import checks, instrumentation, signals  # noqa: F401  (registers the checks and signal receivers)
@@ -0,0 +1,259 @@
+"""Shared helpers for the benchmark management commands.
+
+Benchmarks never touch the development database: they run inside
+``benchmark_database()``, which creates and migrates a throw-away test
+database the same way ``manage.py test`` does.
+"""
+import random
+from array import array
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .facets import rebuild_facets
+from .models import SERVICE_TYPE_CHOICES, ProfileImage, Rating, User, UserProfile
+from .ranking import bayesian_score, rating_weight, rebuild_rankings, rebuild_top
+from .search import get_search_backend
+
+CITIES = ['Ahmedabad', 'Mumbai', 'Pune', 'Delhi', 'Bengaluru', 'Surat', 'Jaipur', 'Chennai']
+# relative metro sizes, so a few cities dominate the feeds like in production
+CITY_WEIGHTS = {
+    'Mumbai': 20, 'Delhi': 19, 'Bengaluru': 13, 'Chennai': 11, 'Ahmedabad': 8,
+    'Pune': 7, 'Surat': 6, 'Jaipur': 4, 'Lucknow': 4, 'Indore': 3, 'Nagpur': 3, 'Vadodara': 2,
+}
+# some categories have many more providers than others
+SERVICE_WEIGHTS = {
+    'Builders': 20, 'Interior Designers': 18, 'Architects': 12, 'Electric Solutions': 10,
+    'Furniture Retailers': 10, 'Bathware Suppliers': 8, 'Fabrications': 8, 'Garden Solutions': 6, 'Others': 8,
+}
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """Run the block against a freshly migrated, throw-away test database."""
+    from django.test.utils import setup_databases, teardown_databases
+
+    old_config = setup_databases(verbosity=verbosity, interactive=False, aliases={'default'})
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+
+
+def seed_profiles(count, batch_size=5000, seed=0):
+    """Bulk-insert ``count`` provider users with one profile each.
+
+    Rating aggregates are written directly (no Rating rows) so the table
+    statistics resemble a rated catalogue.
+    """
+    rng = random.Random(seed)
+    services = [choice[0] for choice in SERVICE_TYPE_CHOICES]
+    for start in range(0, count, batch_size):
+        stop = min(start + batch_size, count)
+        users = User.objects.bulk_create([
+            User(
+                name=f'provider{i}', contact=9000000000 + i, email=f'provider{i}@example.com',
+                city=rng.choice(CITIES), create_password='x', confirm_password='x',
+                user_type='service_provider',
+            )
+            for i in range(start, stop)
+        ], batch_size=batch_size)
+        profiles = []
+        # no rating dates: scored as if all were made now, without decay
+        scale = rating_weight(timezone.now())
+        for i, user in zip(range(start, stop), users):
+            rating_count = rng.randint(0, 50)
+            rating_sum = sum(rng.randint(1, 5) for _ in range(rating_count))
+            profiles.append(UserProfile(
+                user=user, company_name=f'Company {i}', office_address='CG road',
+                office_number='0100200340', gst_number=f'GST{i}', pan_number=f'PAN{i}',
+                service_type=rng.choice(services), company_description=f'Provider number {i}',
+                rating_sum=rating_sum, rating_count=rating_count,
+                avg_rating=rating_sum / rating_count if rating_count else 0,
+                rank_score=bayesian_score(rating_sum, rating_count),
+                decayed_count=rating_count * scale, decayed_sum=rating_sum * scale,
+            ))
+        UserProfile.objects.bulk_create(profiles, batch_size=batch_size)
+    # bulk_create sends no post_save signals
+    get_search_backend().rebuild()
+    rebuild_facets()
+    rebuild_top()
+    analyze()
+
+
+def _skewed_counts(rng, total, slots, cap, exponent):
+    """Split ``total`` over ``slots`` with Zipf-like popularity, at most ``cap`` each."""
+    weights = [1 / (rank ** exponent) for rank in range(1, slots + 1)]
+    rng.shuffle(weights)  # popularity is not related to the insertion order
+    scale = total / sum(weights)
+    counts = [min(int(w * scale), cap) for w in weights]
+    # hand out what rounding and the cap left over to profiles that still have room
+    missing = total - sum(counts)
+    open_slots = [i for i, c in enumerate(counts) if c < cap]
+    while missing > 0 and open_slots:
+        for i in list(open_slots):
+            if not missing:
+                break
+            counts[i] += 1
+            missing -= 1
+            if counts[i] == cap:
+                open_slots.remove(i)
+        open_slots = [i for i in open_slots if counts[i] < cap]
+    return counts
+
+
+def _insert_ratings(rows):
+    """INSERT ``(profile_id, user_id, rating, created_at, updated_at)`` tuples.
+
+    A plain ``executemany``: ``bulk_create`` spends most of its time preparing
+    each value of each Rating instance, and ratings are by far the largest table.
+    """
+    opts = Rating._meta
+    columns = [opts.get_field(name).column for name in ('profile', 'user', 'rating', 'created_at', 'updated_at')]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        connection.ops.quote_name(opts.db_table),
+        ', '.join(connection.ops.quote_name(column) for column in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def generate_load_data(providers, users, ratings, max_images=3, seed=0, batch_size=5000, prefix='load', log=None):
+    """Bulk-insert a reproducible, production-shaped data set; returns the row counts.
+
+    - ``users`` regular users and ``providers`` service providers with one
+      profile each, spread over the categories and cities by ``SERVICE_WEIGHTS``
+      and ``CITY_WEIGHTS``;
+    - ``ratings`` ratings with Zipf-like popularity (a few profiles collect most
+      of them) and a per-profile quality so averages differ;
+    - 0 to ``max_images`` ProfileImage rows per profile, pointing at the sample
+      uploads in ``media/Img/profile``.
+
+    Rows are written in batches with ``bulk_create`` (ratings with a raw
+    ``executemany``, see ``_insert_ratings``) so no signals fire: the rating
+    aggregates are computed while generating, and the search index, facets
+    and rankings are rebuilt once at the end. The same ``seed`` always gives the same data
+    (up to the rating timestamps, which are relative to now).
+    """
+    log = log or (lambda message: None)
+    rng = random.Random(seed)
+    if ratings > providers * users:
+        raise ValueError(f'{ratings} ratings need more than {providers} providers x {users} users')
+
+    # rating values first, so the profiles can be inserted with their aggregates
+    per_profile = _skewed_counts(rng, ratings, providers, cap=users, exponent=0.9)
+    values = array('B')
+    sums = []
+    for count in per_profile:
+        # most providers are rated well, a few badly (mean quality ~4.1)
+        quality = 5 - 3 * rng.betavariate(2, 5)
+        weights = [max(0.05, 1 - abs(star - quality) / 2.5) for star in range(1, 6)]
+        chunk = rng.choices(range(1, 6), cum_weights=list(accumulate(weights)), k=count)
+        values.extend(chunk)
+        sums.append(sum(chunk))
+
+    cities, city_weights = list(CITY_WEIGHTS), list(accumulate(CITY_WEIGHTS.values()))
+    services, service_weights = list(SERVICE_WEIGHTS), list(accumulate(SERVICE_WEIGHTS.values()))
+    sample_images = sorted(
+        f'Img/profile/{name}' for name in default_storage.listdir('Img/profile')[1]
+    ) or ['Img/profile/b2.jpeg']
+
+    with transaction.atomic():
+        user_ids = []
+        for start in range(0, users, batch_size):
+            batch = User.objects.bulk_create([
+                User(
+                    name=f'{prefix}user{i}', contact=8000000000 + i, email=f'{prefix}user{i}@example.com',
+                    city=rng.choices(cities, cum_weights=city_weights)[0],
+                    create_password='x', confirm_password='x', user_type='user',
+                )
+                for i in range(start, min(start + batch_size, users))
+            ], batch_size=batch_size)
+            user_ids.extend(user.pk for user in batch)
+        log(f'{users} users')
+
+        profile_ids = []
+        for start in range(0, providers, batch_size):
+            stop = min(start + batch_size, providers)
+            owners = User.objects.bulk_create([
+                User(
+                    name=f'{prefix}provider{i}', contact=9000000000 + i, email=f'{prefix}provider{i}@example.com',
+                    city=rng.choices(cities, cum_weights=city_weights)[0],
+                    create_password='x', confirm_password='x', user_type='service_provider',
+                )
+                for i in range(start, stop)
+            ], batch_size=batch_size)
+            profiles = UserProfile.objects.bulk_create([
+                UserProfile(
+                    user=owner, company_name=f'{prefix.title()} Company {i}', office_address='CG road',
+                    office_number='0100200340', gst_number=f'GST{i}', pan_number=f'PAN{i}',
+                    service_type=rng.choices(services, cum_weights=service_weights)[0],
+                    company_description=f'{rng.choice(services)} provider number {i}',
+                    rating_sum=sums[i], rating_count=per_profile[i],
+                    avg_rating=sums[i] / per_profile[i] if per_profile[i] else 0,
+                )
+                for i, owner in zip(range(start, stop), owners)
+            ], batch_size=batch_size)
+            profile_ids.extend(profile.pk for profile in profiles)
+        log(f'{providers} providers and profiles')
+
+        # rated at some hour of the last two years, more often recently
+        now = timezone.now()
+        hours = [connection.ops.adapt_datetimefield_value(now - timedelta(hours=h)) for h in range(24 * 730)]
+        pending = []
+        offset = 0
+        for profile_id, count in zip(profile_ids, per_profile):
+            raters = rng.sample(user_ids, count)
+            for j, user_id in enumerate(raters):
+                rated_at = hours[int(len(hours) * rng.random() ** 2)]
+                pending.append((profile_id, user_id, values[offset + j], rated_at, rated_at))
+            offset += count
+            if len(pending) >= batch_size * 10:
+                _insert_ratings(pending)
+                pending = []
+        _insert_ratings(pending)
+        log(f'{ratings} ratings')
+
+        images = [
+            ProfileImage(profile_id=profile_id, image=rng.choice(sample_images))
+            for profile_id in profile_ids
+            for _ in range(rng.randint(0, max_images))
+        ]
+        ProfileImage.objects.bulk_create(images, batch_size=batch_size)
+        log(f'{len(images)} profile images')
+
+        # bulk_create sends no post_save signals
+        get_search_backend().rebuild()
+        rebuild_facets()
+        rebuild_rankings()
+    analyze()
+    return {'users': users + providers, 'profiles': providers, 'ratings': ratings, 'images': len(images)}
+
+
+def analyze():
+    """Refresh planner statistics after a bulk load."""
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def plan_problems(plan):
+    """Return the lines of an EXPLAIN output that indicate a full scan or an unindexed sort."""
+    problems = []
+    for line in plan.splitlines():
+        text = line.strip()
+        if connection.vendor == 'sqlite':
+            # "SCAN t" is a full table scan; "SCAN t USING INDEX i" walks an index
+            detail = text.split(' ', 3)[-1] if text[:1].isdigit() else text
+            if detail.startswith('SCAN ') and ' USING ' not in detail:
+                problems.append(text)
+            elif 'USE TEMP B-TREE FOR ORDER BY' in detail:
+                problems.append(text)
+        elif connection.vendor == 'postgresql':
+            if 'Seq Scan' in text:
+                problems.append(text)
+    return problems
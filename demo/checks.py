@@ -0,0 +1,42 @@
+"""System checks of the demo settings (``manage.py check``, and before every command)."""
+from datetime import timedelta
+from numbers import Real
+
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+from django.utils import timezone
+
+# warn this long before the ranking weights stop growing
+WEIGHT_LIMIT_NOTICE = timedelta(days=5 * 365)
+
+
+@register
+def check_ranking_half_life(app_configs, **kwargs):
+    """``RANKING_HALF_LIFE_DAYS`` must keep the ranking weights growing (``demo.ranking.MAX_WEIGHT_EXPONENT``)."""
+    from .ranking import DECAY_EPOCH, MAX_WEIGHT_EXPONENT, weight_limit_reached_at
+
+    half_life = settings.RANKING_HALF_LIFE_DAYS
+    if isinstance(half_life, bool) or not isinstance(half_life, Real) or not half_life > 0:
+        return [Error(f'RANKING_HALF_LIFE_DAYS must be a positive number of days, not {half_life!r}.',
+                      id='demo.E002')]
+    try:
+        limit = weight_limit_reached_at()
+    except OverflowError:
+        # later than datetime.max
+        return []
+    hint = (f'Raise RANKING_HALF_LIFE_DAYS, or move demo.ranking.DECAY_EPOCH ({DECAY_EPOCH:%Y-%m-%d}) forward '
+            'and run manage.py rebuild_rankings.')
+    now = timezone.now()
+    if limit <= now:
+        return [Error(
+            f'With RANKING_HALF_LIFE_DAYS = {half_life}, ranking weights stopped growing on {limit:%Y-%m-%d} '
+            f'({MAX_WEIGHT_EXPONENT} half-lives after DECAY_EPOCH): newer ratings no longer decay.',
+            hint=hint, id='demo.E001',
+        )]
+    if limit <= now + WEIGHT_LIMIT_NOTICE:
+        return [Warning(
+            f'With RANKING_HALF_LIFE_DAYS = {half_life}, ranking weights stop growing on {limit:%Y-%m-%d} '
+            f'({MAX_WEIGHT_EXPONENT} half-lives after DECAY_EPOCH).',
+            hint=hint, id='demo.W001',
+        )]
+    return []
@@ -1,3 +1,6 @@
+from .sessions import SessionStore
+
+
 def user_flags(request):
     """Expose simple session-based flags to templates.
 
@@ -6,10 +9,15 @@ def user_flags(request):
     - is_user (bool)
     - logged_in_username
     - logged_in_user_id
+
+    These are for display only; with ``demo.sessions`` they come from the flags
+    cookie, which can outlive its session.
     """
+    session = request.session
+    flags = session.display_flags() if isinstance(session, SessionStore) else session
     return {
-        'is_service_provider': request.session.get('is_service_provider', False),
-        'is_user': request.session.get('is_user', False),
-        'logged_in_username': request.session.get('logged_in_username'),
-        'logged_in_user_id': request.session.get('logged_in_user_id'),
-    }
\ No newline at end of file
+        'is_service_provider': flags.get('is_service_provider', False),
+        'is_user': flags.get('is_user', False),
+        'logged_in_username': flags.get('logged_in_username'),
+        'logged_in_user_id': flags.get('logged_in_user_id'),
+    }
@@ -0,0 +1,112 @@
+"""Precomputed city and rating facets for the service feeds.
+
+The feed's filter dropdowns used to run a join plus ``DISTINCT`` over the
+category's profiles on every page view. The options and their profile counts
+now live in FeedFacet rows, so rendering them reads a handful of small rows
+(and usually not even that, see ``get_facets``).
+
+Rows are kept current by ``demo.signals``:
+  - rating changes move a profile between ``min_rating`` buckets with O(1)
+    counter updates (``move_rating_buckets``);
+  - the rarer profile create/delete, category change and owner city change
+    recompute the affected categories (``rebuild_facets``), an indexed
+    GROUP BY over that category only.
+
+Cities are counted case-insensitively, as the feed filters them: "Pune" and
+"pune" are one option.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Min, Q
+from django.db.models.functions import Lower
+
+from . import feed_cache
+from .models import SERVICE_TYPE_CHOICES, FeedFacet, UserProfile
+
+RATING_THRESHOLDS = (1, 2, 3, 4, 5)
+
+
+def _category(service_type):
+    return (service_type or '').lower()
+
+
+def _facet_rows(service_types=None):
+    """Compute FeedFacet rows from the profile table, optionally for some categories only."""
+    qs = UserProfile.objects.annotate(category=Lower('service_type'))
+    if service_types is not None:
+        qs = qs.filter(category__in=list(service_types))
+
+    rows = []
+    # one bucket per lower(city), like the feed's city filter and user_city_lower_idx;
+    # it is labelled with one of its spellings ("Pune" before "pune")
+    cities = (qs.exclude(user__city='').values('category', city_key=Lower('user__city'))
+              .annotate(n=Count('pk'), city=Min('user__city')).order_by())
+    for entry in cities:
+        rows.append(FeedFacet(
+            service_type=entry['category'], facet=FeedFacet.CITY, value=entry['city'], count=entry['n'],
+        ))
+    buckets = qs.values('category').annotate(**{
+        f'at_least_{k}': Count('pk', filter=Q(avg_rating__gte=k)) for k in RATING_THRESHOLDS
+    }).order_by()
+    for entry in buckets:
+        rows.extend(
+            FeedFacet(service_type=entry['category'], facet=FeedFacet.MIN_RATING, value=str(k), count=entry[f'at_least_{k}'])
+            for k in RATING_THRESHOLDS
+        )
+    return rows
+
+
+def rebuild_facets(service_types=None):
+    """Recompute the facets of the given categories (all when None); returns the number of rows."""
+    categories = None if service_types is None else {_category(s) for s in service_types if s}
+    if categories is not None and not categories:
+        return 0
+    with transaction.atomic():
+        stale = FeedFacet.objects.all()
+        if categories is not None:
+            stale = stale.filter(service_type__in=categories)
+        stale.delete()
+        rows = FeedFacet.objects.bulk_create(_facet_rows(categories), batch_size=1000)
+    if categories is None:
+        categories = {label for label, _ in SERVICE_TYPE_CHOICES}
+    feed_cache.invalidate_categories(categories)
+    return len(rows)
+
+
+def _adjust(service_type, facet, value, delta):
+    lookup = {'service_type': _category(service_type), 'facet': facet, 'value': value}
+    if FeedFacet.objects.filter(**lookup).update(count=F('count') + delta):
+        return
+    try:
+        with transaction.atomic():
+            FeedFacet.objects.create(count=delta, **lookup)
+    except IntegrityError:
+        # created concurrently
+        FeedFacet.objects.filter(**lookup).update(count=F('count') + delta)
+
+
+def move_rating_buckets(service_type, old_avg, new_avg):
+    """Account for a profile whose average rating changed from ``old_avg`` to ``new_avg``."""
+    for k in RATING_THRESHOLDS:
+        delta = (new_avg >= k) - (old_avg >= k)
+        if delta:
+            _adjust(service_type, FeedFacet.MIN_RATING, str(k), delta)
+
+
+def get_facets(service_label):
+    """Return ``{'cities': [(city, count), ...], 'min_rating': {k: count}}`` for a category.
+
+    Cached under the category's feed cache version, so it only hits the
+    database after the category changed.
+    """
+    def load():
+        facets = {'cities': [], 'min_rating': {k: 0 for k in RATING_THRESHOLDS}}
+        rows = FeedFacet.objects.filter(service_type=_category(service_label), count__gt=0)
+        for facet, value, count in rows.values_list('facet', 'value', 'count'):
+            if facet == FeedFacet.CITY:
+                facets['cities'].append((value, count))
+            else:
+                facets['min_rating'][int(value)] = count
+        facets['cities'].sort(key=lambda item: item[0].lower())
+        return facets
+
+    return feed_cache.get_or_compute(service_label, 'facets', load)
@@ -0,0 +1,141 @@
+"""Cache of rendered service feed fragments.
+
+The part of ``service_feed.html`` that lists the profiles and the pagination
+links (``service_feed_results.html``) depends only on the category and the
+normalized request parameters, so it is rendered once and stored in the cache
+named by ``settings.FEED_CACHE_ALIAS``: a ``LocMemCache`` (an in-process LRU)
+by default, or any shared backend such as Redis or Memcached.
+
+Invalidation is per category: every key embeds the category's current
+version, and the signals in ``demo.signals`` replace that version whenever a
+profile, its owner or one of its ratings changes, which orphans exactly that
+category's fragments.
+
+Hit/miss counters are kept per process in ``stats``.
+"""
+import hashlib
+import json
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.text import slugify
+
+
+def get_feed_cache():
+    return caches[settings.FEED_CACHE_ALIAS]
+
+
+def _slug(service_label):
+    # memcached keys may not contain spaces
+    return slugify(service_label)
+
+
+def _version_key(service_label):
+    return f'feed:version:{_slug(service_label)}'
+
+
+def category_version(service_label):
+    """Current version token of a category, creating one if it was evicted."""
+    cache = get_feed_cache()
+    key = _version_key(service_label)
+    version = cache.get(key)
+    if version is None:
+        # a fresh random token (never "1" again) so fragments cached under an
+        # evicted version can not become visible again
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_categories(service_labels):
+    """Drop the cached fragments of the given categories.
+
+    The version is replaced immediately and again once the surrounding
+    transaction commits, so a concurrent request cannot re-cache data from
+    before the commit under the new version.
+    """
+    labels = {label.lower() for label in service_labels if label}
+    if not labels:
+        return
+
+    def bump():
+        get_feed_cache().set_many({_version_key(label): uuid.uuid4().hex for label in labels}, timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def normalize_params(params):
+    """Canonical form of the request parameters that change the rendered fragment."""
+    return {
+        'q': ' '.join(params.get('q', '').lower().split()),
+        'city': params.get('city', '').strip().lower(),
+        'min_rating': params.get('min_rating', '').strip(),
+        'page': params.get('page', '').strip(),
+        'after': params.get('after', ''),
+        'before': params.get('before', ''),
+        'pagination': params.get('pagination', ''),
+        'per_page': params.get('per_page', ''),
+    }
+
+
+def fragment_key(service_label, params):
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode(), usedforsecurity=False).hexdigest()
+    return f'feed:fragment:{_slug(service_label)}:{category_version(service_label)}:{digest}'
+
+
+class FeedCacheStats:
+    """Thread-safe, per-process hit/miss counters for each category."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def record(self, service_label, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[service_label] += 1
+
+    def snapshot(self):
+        with self._lock:
+            labels = sorted(set(self.hits) | set(self.misses))
+            report = {}
+            for label in labels:
+                hits, misses = self.hits[label], self.misses[label]
+                report[label] = {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+            return report
+
+    def reset(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+
+stats = FeedCacheStats()
+
+
+def get_or_render(service_label, params, render):
+    """Return the cached fragment for ``params`` or store and return ``render()``."""
+    cache = get_feed_cache()
+    key = fragment_key(service_label, normalize_params(params))
+    html = cache.get(key)
+    stats.record(service_label, hit=html is not None)
+    if html is None:
+        html = render()
+        cache.set(key, html, timeout=settings.FEED_CACHE_TIMEOUT)
+    return html
+
+
+def get_or_compute(service_label, name, compute):
+    """Cache an arbitrary per-category value (e.g. facets) under the category version."""
+    cache = get_feed_cache()
+    key = f'feed:{name}:{_slug(service_label)}:{category_version(service_label)}'
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout=settings.FEED_CACHE_TIMEOUT)
+    return value
@@ -0,0 +1,170 @@
+"""Resized WebP/JPEG derivatives of uploaded images.
+
+Originals are often several megabytes, while the feed shows logos in a card
+a few hundred pixels wide and the profile page shows photos in a carousel and
+a thumbnail strip. For every uploaded image we therefore store one file per
+width in ``DERIVATIVE_WIDTHS`` and format in ``DERIVATIVE_FORMATS`` next to
+the original::
+
+    Img/profile/shop.png -> Img/profile/derivatives/shop.png.480w.webp
+
+and templates pick one with ``srcset`` (see ``demo.templatetags.media_tags``).
+
+Images are never upscaled: a derivative of an original narrower than its
+nominal width keeps the original size, so every name always exists once the
+derivatives were generated.
+"""
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+DERIVATIVE_WIDTHS = (160, 480, 1200)
+# format -> (file extension, content type, Pillow save options)
+DERIVATIVE_FORMATS = {
+    'webp': ('webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+DERIVATIVE_DIR = 'derivatives'
+ORIENTATION = 0x0112  # EXIF tag
+
+
+def derivative_name(name, width, fmt):
+    """Storage name of the ``width``-pixel ``fmt`` derivative of the file ``name``."""
+    directory, filename = os.path.split(name)
+    extension = DERIVATIVE_FORMATS[fmt][0]
+    # the original extension stays in the name so shop.png and shop.jpg do not collide
+    return os.path.join(directory, DERIVATIVE_DIR, f'{filename}.{width}w.{extension}').replace(os.sep, '/')
+
+
+def derivative_names(name):
+    """Storage names of every derivative of the file ``name``."""
+    return [derivative_name(name, width, fmt) for width in DERIVATIVE_WIDTHS for fmt in DERIVATIVE_FORMATS]
+
+
+def is_derivative(name):
+    return DERIVATIVE_DIR in name.replace(os.sep, '/').split('/')[:-1]
+
+
+def derivative_source(name):
+    """Storage name of the original a derivative ``name`` was generated from."""
+    directory, filename = os.path.split(name.replace(os.sep, '/'))
+    # shop.png.480w.webp -> shop.png
+    original = filename.rsplit('.', 2)[0]
+    return f'{os.path.dirname(directory)}/{original}'.lstrip('/')
+
+
+def _flatten(image):
+    """RGB copy of ``image`` with any transparency composited onto white (JPEG has no alpha)."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_derivatives(source):
+    """Resize the image file-like ``source``; returns ``{(width, fmt): bytes}``.
+
+    Raises ``OSError`` (``PIL.UnidentifiedImageError``) if it is not an image.
+    """
+    with Image.open(source) as original:
+        largest = max(DERIVATIVE_WIDTHS)
+        if original.width > largest:
+            # let the JPEG decoder skip detail the largest derivative does not need
+            original.draft('RGB', (largest, round(original.height * largest / original.width)))
+        icc_profile = original.info.get('icc_profile')
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA') if image.mode in ('RGBA', 'LA', 'P') else image.convert('RGB')
+
+    results = {}
+    # downscale step by step from the largest width, each step starts from the previous result
+    for width in sorted(DERIVATIVE_WIDTHS, reverse=True):
+        if image.width > width:
+            image = image.resize((width, max(round(image.height * width / image.width), 1)), Image.LANCZOS)
+        for fmt, (_, _, options) in DERIVATIVE_FORMATS.items():
+            buffer = BytesIO()
+            # Pillow writes no EXIF unless asked to, so derivatives carry no metadata but the colour profile
+            (image if fmt == 'webp' else _flatten(image)).save(
+                buffer, format=fmt.upper(), icc_profile=icc_profile, **options,
+            )
+            results[width, fmt] = buffer.getvalue()
+    return results
+
+
+def strip_metadata(fieldfile):
+    """Store a copy of a JPEG/PNG original without its EXIF data; returns its name.
+
+    Phone photos carry the GPS position and camera details. Only the
+    orientation tag is kept, and JPEGs are saved with their original
+    quantization tables (``quality='keep'``) to avoid another lossy generation.
+    The copy is stored under its own content name: other rows may still refer
+    to the original (see ``demo.storage``).
+    """
+    storage = fieldfile.storage
+    with storage.open(fieldfile.name, 'rb') as source, Image.open(source) as image:
+        exif = image.getexif()
+        if image.format not in ('JPEG', 'PNG') or not set(exif) - {ORIENTATION}:
+            return fieldfile.name
+        kept = Image.Exif()
+        if ORIENTATION in exif:
+            kept[ORIENTATION] = exif[ORIENTATION]
+        options = {'exif': kept.tobytes()}
+        if image.info.get('icc_profile'):
+            options['icc_profile'] = image.info['icc_profile']
+        if image.format == 'JPEG':
+            options['quality'] = 'keep'
+        buffer = BytesIO()
+        image.save(buffer, format=image.format, **options)
+    return storage.save(fieldfile.name, ContentFile(buffer.getvalue()))
+
+
+def generate_derivatives(fieldfile):
+    """Write all derivatives of the stored ``fieldfile``; returns their names."""
+    storage = fieldfile.storage
+    with storage.open(fieldfile.name, 'rb') as source:
+        rendered = render_derivatives(source)
+    names = []
+    for (width, fmt), content in rendered.items():
+        name = derivative_name(fieldfile.name, width, fmt)
+        if storage.exists(name):
+            storage.delete(name)
+        names.append(storage.save(name, ContentFile(content)))
+    return names
+
+
+class Derivatives:
+    """URLs of the derivatives of one image field value (see the model ``*_derivatives`` properties)."""
+
+    def __init__(self, fieldfile):
+        self.fieldfile = fieldfile
+
+    def __bool__(self):
+        return bool(self.fieldfile)
+
+    def exists(self):
+        """Whether the derivatives were generated (one file system check)."""
+        if not self.fieldfile:
+            return False
+        # generate_derivatives writes the smallest JPEG last
+        return self.fieldfile.storage.exists(derivative_name(self.fieldfile.name, min(DERIVATIVE_WIDTHS), 'jpeg'))
+
+    def url(self, width, fmt='webp'):
+        return self.fieldfile.storage.url(derivative_name(self.fieldfile.name, width, fmt))
+
+    def srcset(self, fmt='webp'):
+        return ', '.join(f'{self.url(width, fmt)} {width}w' for width in DERIVATIVE_WIDTHS)
+
+    @property
+    def thumbnail(self):
+        return self.url(min(DERIVATIVE_WIDTHS))
+
+    @property
+    def medium(self):
+        return self.url(sorted(DERIVATIVE_WIDTHS)[len(DERIVATIVE_WIDTHS) // 2])
+
+    @property
+    def large(self):
+        return self.url(max(DERIVATIVE_WIDTHS))
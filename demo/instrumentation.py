@@ -0,0 +1,215 @@
+"""Per-request performance instrumentation.
+
+``RequestTimingMiddleware`` measures every request: wall time, number of SQL
+queries and the time spent in them (through a database ``execute_wrapper``),
+template render time (through the ``DjangoTemplates`` backend below) and
+response bytes. It reports them
+
+  - to the client, in a ``Server-Timing`` header (browser dev tools show it);
+  - to the log, as a warning on ``demo.instrumentation`` when the same SQL runs
+    ``settings.DUPLICATE_QUERY_THRESHOLD`` times or more in one request, the
+    usual sign of an N+1 loop;
+  - to ``stats``, a per-process rolling window of the last
+    ``settings.REQUEST_STATS_WINDOW`` requests of each URL name, which the
+    admin-only ``perf_stats`` view reports as percentiles and a histogram.
+
+The measurements of the current request live in a context variable, so they
+follow the request into the threads the async ORM runs its queries in.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends import django as django_backend
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('total_ms', 'queries', 'sql_ms', 'template_ms', 'bytes')
+# upper bounds (ms) of the wall time histogram buckets; the last one is open
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """What one request spent, filled in while it runs."""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.statements = Counter()
+
+    def duplicates(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+def record_query(execute, sql, params, many, context):
+    """``execute_wrapper`` that counts and times the queries of the current request."""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.sql_time += time.perf_counter() - started
+        timings.queries += 1
+        # the SQL has placeholders for the parameters: an N+1 loop repeats the same text
+        timings.statements[sql] += 1
+
+
+@receiver(connection_created)
+def install_query_wrapper(sender, connection, **kwargs):
+    # connections are reopened on the same wrapper object: install it once
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class Template(django_backend.Template):
+
+    def render(self, context=None, request=None):
+        timings = _current.get()
+        if timings is None:
+            return super().render(context, request)
+        # a template rendered while another one renders is part of the outer time
+        timings.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template_depth -= 1
+            if not timings.template_depth:
+                timings.template_time += time.perf_counter() - started
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The stock Django template backend, with its render time recorded per request."""
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return Template(self.engine.get_template(template_name), self)
+        except django_backend.TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class RequestStats:
+    """Thread-safe, per-process rolling window of request measurements per URL name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(self._window)
+
+    @staticmethod
+    def _window():
+        return deque(maxlen=settings.REQUEST_STATS_WINDOW)
+
+    def record(self, url_name, sample):
+        with self._lock:
+            self.samples[url_name].append(sample)
+
+    def snapshot(self):
+        with self._lock:
+            windows = {name: list(samples) for name, samples in self.samples.items()}
+        report = {}
+        for name, samples in sorted(windows.items()):
+            summary = {'requests': len(samples)}
+            for metric in METRICS:
+                ordered = sorted(sample[metric] for sample in samples)
+                summary[metric] = {
+                    'p50': _percentile(ordered, 0.5),
+                    'p90': _percentile(ordered, 0.9),
+                    'p99': _percentile(ordered, 0.99),
+                    'max': ordered[-1],
+                }
+            histogram = Counter()
+            for sample in samples:
+                bucket = next((f'<={bound}' for bound in HISTOGRAM_BUCKETS_MS if sample['total_ms'] <= bound),
+                              f'>{HISTOGRAM_BUCKETS_MS[-1]}')
+                histogram[bucket] += 1
+            labels = [f'<={bound}' for bound in HISTOGRAM_BUCKETS_MS] + [f'>{HISTOGRAM_BUCKETS_MS[-1]}']
+            summary['total_ms_histogram'] = {label: histogram[label] for label in labels}
+            report[name] = summary
+        return report
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+
+
+stats = RequestStats()
+
+
+def _server_timing(total, timings):
+    return ', '.join((
+        f'db;dur={timings.sql_time * 1000:.1f};desc="{timings.queries} queries"',
+        f'tpl;dur={timings.template_time * 1000:.1f}',
+        f'total;dur={total * 1000:.1f}',
+    ))
+
+
+class RequestTimingMiddleware:
+    """Measure each request; see the module docstring. Keep it first in ``MIDDLEWARE``."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timings, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timings, time.perf_counter() - started)
+
+    def _finish(self, request, response, timings, total):
+        match = request.resolver_match
+        url_name = (match.view_name if match else None) or '<unresolved>'
+        duplicates = timings.duplicates(settings.DUPLICATE_QUERY_THRESHOLD)
+        for sql, count in duplicates:
+            logger.warning('Possible N+1 in %s (%s %s): %d executions of %s',
+                           url_name, request.method, request.path, count, sql)
+        stats.record(url_name, {
+            'total_ms': total * 1000,
+            'queries': timings.queries,
+            'sql_ms': timings.sql_time * 1000,
+            'template_ms': timings.template_time * 1000,
+            # streamed bodies are not known up front
+            'bytes': 0 if response.streaming else len(response.content),
+        })
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = _server_timing(total, timings)
+        return response
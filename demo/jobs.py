@@ -0,0 +1,143 @@
+"""A small job queue stored in the database, so no broker is needed.
+
+Work is queued as Job rows with ``enqueue`` (inside the caller's transaction,
+so a job exists exactly when the data it refers to was committed) and run by
+``manage.py run_worker``, which claims batches of due jobs and executes them
+in a process pool.
+
+Tasks are plain functions registered with ``@task`` (see ``demo.tasks``);
+their keyword arguments must be JSON-serializable. A task that raises is
+retried with exponential backoff up to ``MAX_ATTEMPTS`` times. Finished jobs
+are kept ``JOB_RETENTION_DAYS`` for inspection, then pruned by the worker.
+"""
+import traceback
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = timedelta(seconds=30)
+# a job still "running" after this long belongs to a worker that died
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+TASKS = {}
+
+
+def task(func=None, *, on_failure=None):
+    """Register ``func`` as a task that can be queued by name.
+
+    ``on_failure`` is called with the same arguments once the task failed for
+    the last time.
+    """
+    def register(func):
+        func.on_failure = on_failure
+        TASKS[_task_name(func)] = func
+        return func
+
+    return register if func is None else register(func)
+
+
+def _task_name(func_or_name):
+    return func_or_name if isinstance(func_or_name, str) else f'{func_or_name.__module__}.{func_or_name.__name__}'
+
+
+def enqueue(func_or_name, **kwargs):
+    return Job.objects.create(task=_task_name(func_or_name), payload=kwargs)
+
+
+def enqueue_many(func_or_name, payloads):
+    name = _task_name(func_or_name)
+    return Job.objects.bulk_create([Job(task=name, payload=payload) for payload in payloads])
+
+
+def requeue_stale():
+    """Return jobs claimed by a worker that never finished them to the queue."""
+    return Job.objects.filter(
+        status=Job.RUNNING, claimed_at__lt=timezone.now() - CLAIM_TIMEOUT,
+    ).update(status=Job.PENDING, claimed_at=None)
+
+
+def claim(limit):
+    """Mark up to ``limit`` due jobs as running and return their ids.
+
+    The status check in the UPDATE makes this safe with several workers: a job
+    another worker claimed first is simply not updated (and not returned).
+    """
+    now = timezone.now()
+    due = list(Job.objects.filter(status=Job.PENDING, run_after__lte=now)
+               .order_by('pk').values_list('pk', flat=True)[:limit])
+    if not due:
+        return []
+    with transaction.atomic():
+        Job.objects.filter(pk__in=due, status=Job.PENDING).update(
+            status=Job.RUNNING, claimed_at=now, attempts=F('attempts') + 1,
+        )
+        return list(Job.objects.filter(pk__in=due, status=Job.RUNNING, claimed_at=now).values_list('pk', flat=True))
+
+
+def run_job(job_id):
+    """Execute one claimed job; returns ``(job_id, status)``.
+
+    Runs in the worker's pool processes, so it only takes the id and reloads
+    the job from the database.
+    """
+    job = Job.objects.get(pk=job_id)
+    func = TASKS.get(job.task)
+    try:
+        if func is None:
+            raise LookupError(f'Unknown task {job.task!r}')
+        func(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if func is not None and job.attempts < MAX_ATTEMPTS:
+            _retry(job, error)
+            return job_id, Job.PENDING
+        _fail(job, func, error)
+        return job_id, Job.FAILED
+    Job.objects.filter(pk=job_id).update(status=Job.DONE, last_error='', finished_at=timezone.now())
+    return job_id, Job.DONE
+
+
+def requeue_crashed(job_ids, error, blame=True):
+    """Hand back claimed jobs whose pool process died, without waiting for CLAIM_TIMEOUT.
+
+    With ``blame`` the crash counts as an attempt, as an exception would: the
+    job is retried with backoff, or failed for good after ``MAX_ATTEMPTS``.
+    Without, the attempt is given back, for jobs that may only have shared the
+    pool with the one that crashed it. Returns how many jobs were still running.
+    """
+    jobs = list(Job.objects.filter(pk__in=job_ids, status=Job.RUNNING))
+    if not blame:
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=Job.PENDING, claimed_at=None, attempts=F('attempts') - 1, last_error=error,
+        )
+        return len(jobs)
+    for job in jobs:
+        func = TASKS.get(job.task)
+        if func is not None and job.attempts < MAX_ATTEMPTS:
+            _retry(job, error)
+        else:
+            _fail(job, func, error)
+    return len(jobs)
+
+
+def _retry(job, error):
+    delay = RETRY_DELAY * 2 ** (job.attempts - 1)
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.PENDING, claimed_at=None, last_error=error, run_after=timezone.now() + delay,
+    )
+
+
+def _fail(job, func, error):
+    Job.objects.filter(pk=job.pk).update(status=Job.FAILED, last_error=error, finished_at=timezone.now())
+    if func is not None and func.on_failure is not None:
+        func.on_failure(**job.payload)
+
+
+def prune_finished(older_than):
+    """Delete the jobs that were done or failed for good before ``older_than``; returns how many."""
+    return Job.objects.filter(status__in=[Job.DONE, Job.FAILED], finished_at__lt=older_than).delete()[0]
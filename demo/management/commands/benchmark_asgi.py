@@ -0,0 +1,157 @@
+import asyncio
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from demo.benchmarks import benchmark_database, seed_profiles
+from demo.models import UserProfile
+
+
+def _percentiles(latencies):
+    cuts = statistics.quantiles(latencies, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+def _wsgi_request(application, path, query):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1', 'HTTP_HOST': 'localhost',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(),
+        'wsgi.errors': BytesIO(), 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+    }
+    status = []
+    body = application(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        for _ in body:
+            pass
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return int(status[0].split()[0])
+
+
+async def _asgi_request(application, path, query):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+        'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+    }
+    sent_body = False
+    disconnect = asyncio.Event()
+    status = []
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Django listens for the client going away until the response is sent
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    disconnect.set()
+    return status[0]
+
+
+class Command(BaseCommand):
+    help = ('Compare p50/p99 latency of the feed and profile pages under WSGI (a thread per request) '
+            'and ASGI (the same views in the thread-sensitive executor) at a given number of concurrent clients')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=5000, help='Number of profiles to seed (default 5000)')
+        parser.add_argument('--concurrency', type=int, default=200, help='Concurrent clients (default 200)')
+        parser.add_argument('--requests', type=int, default=4000, help='Requests per server (default 4000)')
+        parser.add_argument('--threads', type=int, default=32,
+                            help='WSGI server threads, like gunicorn --threads (default 32)')
+
+    def handle(self, *args, **options):
+        from djangify_demo.asgi import application as asgi_application
+        from djangify_demo.wsgi import application as wsgi_application
+
+        with benchmark_database():
+            seed_profiles(options['profiles'])
+            pks = list(UserProfile.objects.values_list('pk', flat=True)[:500])
+            rng = random.Random(0)
+            # a mix of cached feed pages, uncached deeper pages and profiles
+            urls = []
+            for _ in range(options['requests']):
+                kind = rng.random()
+                if kind < 0.4:
+                    urls.append((reverse('builderfeed'), ''))
+                elif kind < 0.7:
+                    urls.append((reverse('interiorfeed'), f'pagination=page&page={rng.randint(1, 50)}'))
+                else:
+                    urls.append((reverse('profile_detail', args=[rng.choice(pks)]), ''))
+
+            for label, run in (('WSGI', self._run_wsgi), ('ASGI', self._run_asgi)):
+                for cache in caches.all():
+                    cache.clear()
+                application = wsgi_application if label == 'WSGI' else asgi_application
+                started = time.perf_counter()
+                latencies, statuses = run(application, urls, options)
+                elapsed = time.perf_counter() - started
+                if set(statuses) != {200}:
+                    raise CommandError(f'{label}: unexpected status codes {sorted(set(statuses))}')
+                p50, p99 = _percentiles(latencies)
+                self.stdout.write(
+                    f'{label}: p50 {p50:.1f} ms, p99 {p99:.1f} ms, '
+                    f'{len(latencies) / elapsed:.0f} requests/s ({options["concurrency"]} concurrent clients)'
+                )
+
+    def _run_wsgi(self, application, urls, options):
+        """``concurrency`` clients queueing for ``threads`` server threads, as with a threaded WSGI server."""
+        server = ThreadPoolExecutor(max_workers=options['threads'])
+        pending = iter(urls)
+        lock = threading.Lock()
+        latencies, statuses = [], []
+
+        def client():
+            while True:
+                with lock:
+                    url = next(pending, None)
+                if url is None:
+                    return
+                started = time.perf_counter()
+                status = server.submit(_wsgi_request, application, *url).result()
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    statuses.append(status)
+
+        clients = [threading.Thread(target=client) for _ in range(options['concurrency'])]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        server.shutdown()
+        return latencies, statuses
+
+    def _run_asgi(self, application, urls, options):
+        """``concurrency`` clients on one event loop, as uvicorn/daphne would run them."""
+        pending = iter(urls)
+        latencies, statuses = [], []
+
+        async def client():
+            for url in pending:
+                started = time.perf_counter()
+                statuses.append(await _asgi_request(application, *url))
+                latencies.append(time.perf_counter() - started)
+
+        async def main():
+            await asyncio.gather(*(client() for _ in range(options['concurrency'])))
+
+        asyncio.run(main())
+        return latencies, statuses
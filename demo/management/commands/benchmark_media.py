@@ -0,0 +1,209 @@
+import http.client
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers import basehttp
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.test.utils import override_settings
+from django.urls import include, path, reverse
+from django.views import static
+
+
+def _static_serve(request, path):
+    return static.serve(request, path, document_root=settings.MEDIA_ROOT)
+
+
+# the project's routes, plus how media was served before demo.media (DEBUG only)
+urlpatterns = [
+    path('static-serve/<path:path>', _static_serve, name='static_serve'),
+    path('', include('djangify_demo.urls')),
+]
+
+MiB = 1024 * 1024
+
+
+class _SendfileServerHandler(basehttp.ServerHandler):
+    """Sends a ``wsgi.file_wrapper`` response with ``os.sendfile``, like gunicorn does.
+
+    ``Content-Length`` bytes from the file's current offset: what
+    ``demo.media.MediaResponse`` sets up for a whole file or a range.
+    """
+
+    def sendfile(self):
+        try:
+            in_fd = self.result.filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+        length = int(self.headers['Content-Length'])
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+        out_fd = self.stdout.fileno()
+        while length:
+            sent = os.sendfile(out_fd, in_fd, offset, length)
+            if not sent:
+                break
+            offset += sent
+            length -= sent
+        return True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    handler_class = basehttp.ServerHandler
+    # headers and body go out in separate writes: do not wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_one_request(self):
+        # WSGIRequestHandler.handle_one_request, with handler_class
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        handler = self.handler_class(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+class _SendfileRequestHandler(_QuietRequestHandler):
+    handler_class = _SendfileServerHandler
+
+
+# label -> (URL name, request handler, MEDIA_SENDFILE_HEADER)
+MODES = {
+    'static.serve': ('static_serve', _QuietRequestHandler, None),
+    'serve_media': ('media', _QuietRequestHandler, None),
+    'serve_media + sendfile': ('media', _SendfileRequestHandler, None),
+    'serve_media X-Accel-Redirect': ('media', _QuietRequestHandler, 'X-Accel-Redirect'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Measure media throughput over HTTP for large gallery images: the previous DEBUG-only '
+            'static.serve route against demo.media.serve_media reading the file, sending it with '
+            'os.sendfile and offloading it with X-Accel-Redirect; whole files, ranges and revalidations')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=16, help='Number of gallery images (default 16)')
+        parser.add_argument('--size', type=float, default=8, help='Image size in MiB (default 8)')
+        parser.add_argument('--requests', type=int, default=400,
+                            help='Requests per mode and kind of request (default 400)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients (default 8)')
+        parser.add_argument('--range-size', type=int, default=MiB,
+                            help='Bytes per range request (default 1 MiB)')
+
+    def handle(self, *args, **options):
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root, ROOT_URLCONF=__name__, DEBUG=False):
+                names = [
+                    default_storage.save(f'gallery{i}.jpg', ContentFile(os.urandom(int(options['size'] * MiB))))
+                    for i in range(options['images'])
+                ]
+                for label, (route, handler, sendfile_header) in MODES.items():
+                    with override_settings(MEDIA_SENDFILE_HEADER=sendfile_header):
+                        self._run_mode(label, route, handler, names, options)
+        finally:
+            shutil.rmtree(media_root)
+
+    def _run_mode(self, label, route, handler, names, options):
+        server = ThreadedWSGIServer(('127.0.0.1', 0), handler)
+        server.set_app(get_internal_wsgi_application())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            paths = [reverse(route, args=[name]) for name in names]
+            for kind in ('whole', 'range', 'revalidate'):
+                requests = self._requests(kind, server, paths, options)
+                latencies, received, elapsed = self._load(server, requests, options['concurrency'])
+                p50, p99 = (cut * 1000 for cut in (statistics.quantiles(latencies, n=100)[i] for i in (49, 98)))
+                self.stdout.write(
+                    f'{label:<30} {kind:<10} p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  '
+                    f'{len(requests) / elapsed:7.0f} req/s  {received / MiB / elapsed:8.0f} MiB/s'
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def _requests(self, kind, server, paths, options):
+        rng = random.Random(0)
+        chosen = rng.choices(paths, k=options['requests'])
+        if kind == 'whole':
+            return [(p, {}) for p in chosen]
+        if kind == 'range':
+            size, length = int(options['size'] * MiB), options['range_size']
+            starts = [rng.randrange(0, size - length) for _ in chosen]
+            return [(p, {'Range': f'bytes={start}-{start + length - 1}'}) for p, start in zip(chosen, starts)]
+        # revalidation of a cached copy; static.serve sends no ETag, only Last-Modified
+        validators = {p: self._validator(server, p) for p in paths}
+        return [(p, validators[p]) for p in chosen]
+
+    @staticmethod
+    def _request(connection, path, headers):
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        received = 0
+        while chunk := response.read(MiB):
+            received += len(chunk)
+        return response, received
+
+    def _validator(self, server, path):
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+        try:
+            response, _ = self._request(connection, path, {})
+        finally:
+            connection.close()
+        if response.getheader('ETag'):
+            return {'If-None-Match': response.getheader('ETag')}
+        return {'If-Modified-Since': response.getheader('Last-Modified')}
+
+    def _load(self, server, requests, concurrency):
+        pending = iter(requests)
+        lock = threading.Lock()
+        latencies, totals, failures = [], [0], []
+
+        def client():
+            # one keep-alive connection per client, like a browser
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_port)
+            try:
+                while True:
+                    with lock:
+                        item = next(pending, None)
+                    if item is None:
+                        return
+                    started = time.perf_counter()
+                    response, received = self._request(connection, *item)
+                    if response.status not in (200, 206, 304):
+                        failures.append(f'{item[0]}: {response.status}')
+                    if response.getheader('Connection') == 'close':
+                        connection.close()
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+                        totals[0] += received
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise CommandError(f'{len(failures)} failed request(s), e.g. {failures[0]}')
+        return latencies, totals[0], time.perf_counter() - started
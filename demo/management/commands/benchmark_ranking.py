@@ -0,0 +1,102 @@
+import statistics
+import time
+from array import array
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, FloatField, Sum, Value
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+
+from demo import ranking
+from demo.benchmarks import benchmark_database, generate_load_data
+from demo.models import SERVICE_TYPE_CHOICES, Rating, UserProfile
+from demo.views import _service_profiles
+
+
+def _timed(func, rounds):
+    """Median seconds of ``rounds`` calls of ``func``."""
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def _aggregate_order(service_label):
+    """A category ordered by a Bayesian average computed from the ratings at request time (no decay)."""
+    prior_weight = settings.RANKING_PRIOR_WEIGHT
+    score = (
+        (Value(prior_weight * settings.RANKING_PRIOR_MEAN) + Cast(Coalesce(Sum('ratings__rating'), 0), FloatField()))
+        / (Value(float(prior_weight)) + Count('ratings'))
+    )
+    return _service_profiles(service_label).annotate(score=score).order_by('-score', 'company_name')
+
+
+class Command(BaseCommand):
+    help = ('Time the ranking: a full rescoring (NumPy and the Python loop), the incremental update after a '
+            'rating against rescoring the profile from its ratings, and reading the top providers and a feed page from the stored ranks against ordering '
+            'by an aggregate of the ratings at request time')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--providers', type=int, default=5000, help='Profiles (default 5000)')
+        parser.add_argument('--users', type=int, default=20000, help='Raters (default 20000)')
+        parser.add_argument('--ratings', type=int, default=200000, help='Ratings (default 200000)')
+        parser.add_argument('--rounds', type=int, default=20, help='Repetitions of each timing (default 20)')
+
+    def handle(self, *args, **options):
+        rounds = options['rounds']
+        with benchmark_database():
+            generate_load_data(options['providers'], options['users'], options['ratings'], max_images=0)
+            self._batch(rounds)
+            self._incremental(rounds)
+            self._reads(rounds)
+
+    def _report(self, label, seconds):
+        self.stdout.write(f'{label:<48} {seconds * 1000:10.2f} ms')
+
+    def _batch(self, rounds):
+        rows = list(Rating.objects.values_list('profile_id', 'rating', 'created_at'))
+        index = {pk: i for i, pk in enumerate(UserProfile.objects.values_list('pk', flat=True))}
+        # the arrays aggregate_profiles builds
+        groups = array('q', [index[profile_id] for profile_id, _, _ in rows])
+        values = array('b', [rating for _, rating, _ in rows])
+        days = array('d', [ranking._epoch_days(created_at) for _, _, created_at in rows])
+        numpy = ranking.np
+        engines = {'NumPy': numpy, 'Python loop': None} if numpy is not None else {'Python loop': None}
+        if numpy is None:
+            self.stdout.write('NumPy is not installed: only the Python loop is timed')
+        try:
+            for label, module in engines.items():
+                ranking.np = module
+                self._report(
+                    f'sum {len(rows)} decayed ratings ({label})',
+                    _timed(lambda: ranking.decayed_aggregates(groups, values, days, len(index)), max(rounds // 4, 1)),
+                )
+        finally:
+            ranking.np = numpy
+        self._report('rebuild_rankings (read, score, store)', _timed(ranking.rebuild_rankings, 1))
+
+    def _incremental(self, rounds):
+        counts = UserProfile.objects.annotate(n=Count('ratings')).order_by('-n').values_list('pk', 'n')
+        weight = ranking.rating_weight(timezone.now())
+        for pk, count in (counts[0], counts[len(counts) // 2]):
+            # adding and removing a 5-star rating leaves the profile as it was
+            self._report(f'shift after a rating ({count} ratings)', _timed(
+                lambda: (ranking.shift_profiles({pk: (weight, 5 * weight)}),
+                         ranking.shift_profiles({pk: (-weight, -5 * weight)})), rounds,
+            ) / 2)
+            self._report(f'rescore from the ratings ({count} ratings)',
+                         _timed(lambda: ranking.rescore_profiles([pk]), rounds))
+
+    def _reads(self, rounds):
+        labels = [label for label, _ in SERVICE_TYPE_CHOICES]
+        self._report('home page top 3 x 9 (ProviderRank)', _timed(lambda: ranking.top_providers(limit=3), rounds))
+        self._report('home page top 3 x 9 (aggregate)', _timed(
+            lambda: [list(_aggregate_order(label)[:3]) for label in labels], rounds,
+        ))
+        self._report('feed first page (rank_score index)', _timed(
+            lambda: list(_service_profiles('Builders').order_by('-rank_score', 'company_name')[:9]), rounds,
+        ))
+        self._report('feed first page (aggregate)', _timed(lambda: list(_aggregate_order('Builders')[:9]), rounds))
@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections
+
+from demo.benchmarks import benchmark_database, seed_profiles
+from demo.models import Rating, User, UserProfile
+from demo.ratings import find_rating_aggregate_drift, rebuild_rating_aggregates, supports_upsert, upsert_rating
+
+
+def _update_or_create(profile, user, rating):
+    """The previous write path of rate_profile: update_or_create, full_clean and the Rating signals."""
+    Rating.objects.update_or_create(profile=profile, user=user, defaults={'rating': rating, 'comment': 'benchmark'})
+
+
+def _upsert(profile, user, rating):
+    upsert_rating(profile, user, rating, 'benchmark')
+
+
+WRITE_PATHS = {'update_or_create': _update_or_create, 'upsert_rating': _upsert}
+
+
+class Command(BaseCommand):
+    help = ('Rate profiles from concurrent writer threads, with update_or_create and with '
+            'upsert_rating, and report ratings per second and failed writes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=500, help='Number of profiles to seed (default 500)')
+        parser.add_argument('--users', type=int, default=2000, help='Number of raters (default 2000)')
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writer threads (default 8)')
+        parser.add_argument('--ratings', type=int, default=4000, help='Ratings per write path (default 4000)')
+        parser.add_argument('--hot', type=float, default=0.5,
+                            help='Share of the ratings that go to one popular profile (default 0.5)')
+
+    def handle(self, *args, **options):
+        if not supports_upsert():
+            raise CommandError(f'{connection.vendor} has no INSERT ... ON CONFLICT / UPDATE ... RETURNING')
+        with benchmark_database():
+            seed_profiles(options['profiles'])
+            User.objects.bulk_create([
+                User(name=f'rater{i}', contact=8000000000 + i, email=f'rater{i}@example.com', city='Pune',
+                     create_password='x', confirm_password='x', user_type='user')
+                for i in range(options['users'])
+            ])
+            profiles = list(UserProfile.objects.all())
+            users = list(User.objects.filter(user_type='user'))
+            rng = random.Random(0)
+            hot = profiles[0]
+            # the same writes for both paths: re-rating happens, as users change their minds
+            writes = [
+                (hot if rng.random() < options['hot'] else rng.choice(profiles), rng.choice(users), rng.randint(1, 5))
+                for _ in range(options['ratings'])
+            ]
+
+            for label, write in WRITE_PATHS.items():
+                Rating.objects.all().delete()
+                rebuild_rating_aggregates()
+                done, failed, elapsed = self._run(write, writes, options['writers'])
+                drift = find_rating_aggregate_drift()
+                self.stdout.write(
+                    f'{label}: {done / elapsed:.0f} ratings/s, {failed} failed writes '
+                    f'({options["writers"]} writers, {len(drift)} profiles with drifted aggregates)'
+                )
+
+    def _run(self, write, writes, writers):
+        pending = iter(writes)
+        lock = threading.Lock()
+        counts = {'done': 0, 'failed': 0}
+
+        def writer():
+            try:
+                while True:
+                    with lock:
+                        item = next(pending, None)
+                    if item is None:
+                        return
+                    try:
+                        write(*item)
+                        outcome = 'done'
+                    except DatabaseError:
+                        # SQLite: "database is locked" when the write lock could not be had
+                        outcome = 'failed'
+                    with lock:
+                        counts[outcome] += 1
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts['done'], counts['failed'], time.perf_counter() - started
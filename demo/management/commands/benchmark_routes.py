@@ -0,0 +1,401 @@
+import itertools
+import json
+import re
+import statistics
+import threading
+import time
+from collections import defaultdict
+from http.cookiejar import CookieJar
+from pathlib import Path
+from typing import NamedTuple
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.paginator import Paginator
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import URLPattern, get_resolver, reverse
+from django.utils.text import slugify
+
+from demo.benchmarks import benchmark_database, seed_profiles
+from demo.models import SERVICE_TYPE_CHOICES, ProfileImage, User, UserProfile
+from demo.pagination import encode_cursor
+from demo.views import _service_feed_queryset
+
+FEED_ROUTES = {
+    'Builders': 'builderfeed', 'Architects': 'architectfeed', 'Bathware Suppliers': 'bathwarefeed',
+    'Interior Designers': 'interiorfeed', 'Furniture Retailers': 'furniturefeed',
+    'Electric Solutions': 'electricfeed', 'Garden Solutions': 'gardenfeed',
+    'Fabrications': 'fabricationsfeed', 'Others': 'othersfeed',
+}
+FEED_FILTERS = {'q': 'Company', 'city': 'Mumbai', 'min_rating': '4'}
+# routes that cannot be benchmarked, with the reason
+SKIPPED_ROUTES = {
+    'new': 'demo/Modified_files/new.html does not exist',
+}
+PASSWORD = 'benchmark-password'
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+class Scenario(NamedTuple):
+    name: str
+    route: str
+    path: str
+    role: str = 'anonymous'
+    method: str = 'GET'
+    # a dict, or a callable taking the round number for bodies that must differ per request
+    data: object = None
+    expect: tuple = (200,)
+
+
+def _with_query(path, **params):
+    params = {key: value for key, value in params.items() if value != ''}
+    return f'{path}?{urlencode(params)}' if params else path
+
+
+def _feed_scenarios():
+    scenarios = []
+    for service_label, route in FEED_ROUTES.items():
+        path = reverse(route)
+        # every combination of the three filters, none of them included
+        for mask in range(2 ** len(FEED_FILTERS)):
+            params = {key: value if mask & (1 << i) else '' for i, (key, value) in enumerate(FEED_FILTERS.items())}
+            label = '+'.join(key for key, value in params.items() if value) or 'unfiltered'
+            scenarios.append(Scenario(f'{route} {label}', route, _with_query(path, **params)))
+
+        per_page = 9
+        queryset = _service_feed_queryset(service_label)
+        last_page = Paginator(queryset, per_page).num_pages
+        scenarios.append(Scenario(f'{route} last page', route,
+                                  _with_query(path, pagination='page', page=last_page)))
+        if last_page > 1:
+            after = encode_cursor(queryset[(last_page - 1) * per_page - 1])
+            scenarios.append(Scenario(f'{route} last cursor page', route,
+                                      _with_query(path, pagination='cursor', after=after)))
+    return scenarios
+
+
+def build_scenarios(profile, rated_profile):
+    """Every route of ``djangify_demo.urls``; the writes come last so they do not
+    invalidate the feed caches under the reads."""
+    api_slug = slugify(SERVICE_TYPE_CHOICES[0][0])
+    # signups need a fresh name and email every time, whichever driver sends them
+    signups = itertools.count()
+
+    def signup(i):
+        name = f'bench-signup-{next(signups)}'
+        return {'name': name, 'contact': '9999999999', 'email': f'{name}@example.com', 'city': 'Pune',
+                'create_password': PASSWORD, 'confirm_password': PASSWORD, 'user_type': 'user'}
+
+    return [
+        *(Scenario(name, name, reverse(name))
+          for name in ('index', 'about', 'contact', 'explore', 'inquiry', 'otp', 'test',
+                       'trending', 'signup', 'choose')),
+        Scenario('choose (user)', 'choose', reverse('choose'), role='user'),
+        *_feed_scenarios(),
+        Scenario('profile_detail many photos', 'profile_detail', reverse('profile_detail', args=[profile.pk])),
+        Scenario('profile_detail many photos (user)', 'profile_detail',
+                 reverse('profile_detail', args=[profile.pk]), role='user'),
+        Scenario('companyprofile many photos', 'companyprofile', reverse('companyprofile'), role='provider'),
+        Scenario('createprof', 'createprof', reverse('createprof'), role='provider'),
+        Scenario('editprofile', 'editprofile', reverse('editprofile'), role='provider'),
+        Scenario('edit_account', 'edit_account', reverse('edit_account'), role='user'),
+        Scenario('api_service_feed', 'api_service_feed', reverse('api_service_feed', args=[api_slug])),
+        Scenario('api_service_feed q+city', 'api_service_feed',
+                 _with_query(reverse('api_service_feed', args=[api_slug]), q='Company', city='Mumbai')),
+        Scenario('api_profile many photos', 'api_profile', reverse('api_profile', args=[profile.pk])),
+        # a logo that ships with the repository
+        Scenario('media', 'media', reverse('media', args=['Img/logo/b1.jpg'])),
+        Scenario('feed_cache_stats', 'feed_cache_stats', reverse('feed_cache_stats'), role='staff'),
+        Scenario('perf_stats', 'perf_stats', reverse('perf_stats'), role='staff'),
+        Scenario('inquiry post', 'inquiry', reverse('inquiry'), method='POST', data={'message': 'hello'}),
+        Scenario('trending login', 'trending', reverse('trending'), role='login', method='POST',
+                 data={'name': 'bench-visitor', 'confirm_password': PASSWORD, 'user_type': 'user'}, expect=(302,)),
+        Scenario('signup submit', 'signup', reverse('signup'), role='signup', method='POST', data=signup,
+                 expect=(302,)),
+        Scenario('rate_profile', 'rate_profile', reverse('rate_profile', args=[rated_profile.pk]), role='user',
+                 method='POST', data=lambda i: {'rating': i % 5 + 1, 'comment': 'benchmark'}, expect=(302,)),
+    ]
+
+
+def uncovered_routes(scenarios):
+    """Named routes of the root URLconf no scenario requests.
+
+    Included URLconfs (the admin) and ``SKIPPED_ROUTES`` are left out.
+    """
+    names = {pattern.name for pattern in get_resolver().url_patterns
+             if isinstance(pattern, URLPattern) and pattern.name}
+    return sorted(names - {scenario.route for scenario in scenarios} - set(SKIPPED_ROUTES))
+
+
+def _queries(server_timing):
+    match = SERVER_TIMING_QUERIES.search(server_timing)
+    return int(match.group(1)) if match else None
+
+
+class ClientDriver:
+    """Requests through the Django test client, in this thread."""
+
+    label = 'client'
+
+    def __init__(self):
+        self.clients = defaultdict(Client)
+
+    def login(self, role, name, password, user_type):
+        response = self.clients[role].post(
+            reverse('trending'), {'name': name, 'confirm_password': password, 'user_type': user_type},
+        )
+        return response.status_code == 302
+
+    def login_staff(self, role, user, password):
+        self.clients[role].force_login(user)
+        return True
+
+    def request(self, role, method, path, data=None):
+        client = self.clients[role]
+        response = client.post(path, data) if method == 'POST' else client.get(path)
+        if response.streaming:
+            # read the body like a client would; that also closes the file
+            b''.join(response.streaming_content)
+        return response.status_code, response.get('Server-Timing', '')
+
+    def close(self):
+        pass
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _NoRedirects(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class LiveServerDriver:
+    """Real HTTP requests to a threaded WSGI server started on a free local port."""
+
+    label = 'live'
+
+    def __init__(self):
+        self.server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietRequestHandler)
+        self.server.set_app(get_internal_wsgi_application())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.cookies = defaultdict(CookieJar)
+        self.openers = {}
+
+    def _opener(self, role):
+        if role not in self.openers:
+            self.openers[role] = build_opener(HTTPCookieProcessor(self.cookies[role]), _NoRedirects)
+        return self.openers[role]
+
+    def _csrf_token(self, role):
+        token = next((cookie.value for cookie in self.cookies[role] if cookie.name == settings.CSRF_COOKIE_NAME), None)
+        if token is None:
+            # any page with a form sets the cookie
+            self.request(role, 'GET', reverse('trending'))
+            token = next(cookie.value for cookie in self.cookies[role] if cookie.name == settings.CSRF_COOKIE_NAME)
+        return token
+
+    def login(self, role, name, password, user_type):
+        status, _ = self.request(role, 'POST', reverse('trending'),
+                                 {'name': name, 'confirm_password': password, 'user_type': user_type})
+        return status == 302
+
+    def login_staff(self, role, user, password):
+        status, _ = self.request(role, 'POST', reverse('admin:login'),
+                                 {'username': user.get_username(), 'password': password, 'next': '/'})
+        return status == 302
+
+    def request(self, role, method, path, data=None):
+        body, headers = None, {}
+        if method == 'POST':
+            body = urlencode(data).encode()
+            headers = {'X-CSRFToken': self._csrf_token(role),
+                       'Content-Type': 'application/x-www-form-urlencoded'}
+        request = Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self._opener(role).open(request) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing', '')
+        except HTTPError as response:
+            response.read()
+            return response.code, response.headers.get('Server-Timing', '')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def _summary(latencies, queries, elapsed):
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(latencies),
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(cuts[49] * 1000, 2),
+        'p90_ms': round(cuts[89] * 1000, 2),
+        'p99_ms': round(cuts[98] * 1000, 2),
+        # the first request of a scenario fills the caches, the others should hit them
+        'queries_first': queries[0],
+        'queries': max(queries[1:], key=lambda count: -1 if count is None else count),
+    }
+
+
+def regressions(baseline, results, threshold, min_delta_ms, query_threshold):
+    """``(scenario, message)`` for every scenario that got slower or issues more queries than ``baseline``."""
+    found = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ('p50_ms', 'p90_ms'):
+            limit = max(before[metric] * (1 + threshold), before[metric] + min_delta_ms)
+            if current[metric] > limit:
+                found.append((name, f'{metric} {before[metric]:.2f} -> {current[metric]:.2f}'))
+        for metric in ('queries_first', 'queries'):
+            if before[metric] is not None and current[metric] is not None \
+                    and current[metric] > before[metric] + query_threshold:
+                found.append((name, f'{metric} {before[metric]} -> {current[metric]}'))
+    return found
+
+
+class Command(BaseCommand):
+    help = ('Seed a throw-away database, request every route of djangify_demo.urls (feeds with every '
+            'filter combination and their last pages, profiles with many photos, ratings, login, signup) '
+            'and compare latency percentiles and query counts with a JSON baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=2000, help='Number of profiles to seed (default 2000)')
+        parser.add_argument('--photos', type=int, default=100,
+                            help='Photos of the profile used for the profile pages (default 100)')
+        parser.add_argument('--rounds', type=int, default=20, help='Requests per scenario (default 20)')
+        parser.add_argument('--live', action='store_true',
+                            help='Also send every scenario over HTTP to a local threaded server')
+        parser.add_argument('--only', help='Run only the scenarios whose name contains this text')
+        parser.add_argument('--baseline', type=Path, default=settings.BASE_DIR / 'benchmark_baseline.json',
+                            help='Baseline JSON file (default benchmark_baseline.json in the project root)')
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Write the results to the baseline instead of comparing with it')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed relative p50/p90 increase over the baseline (default 0.25)')
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help='Latency increases below this many ms are never regressions (default 2)')
+        parser.add_argument('--query-threshold', type=int, default=0,
+                            help='Allowed increase in queries per request (default 0)')
+
+    def handle(self, *args, **options):
+        if options['rounds'] < 2:
+            raise CommandError('--rounds must be at least 2')
+        baseline = None
+        if not options['update_baseline'] and options['baseline'].exists():
+            baseline = json.loads(options['baseline'].read_text())
+            if baseline['settings'] != self._settings(options):
+                raise CommandError(f"{options['baseline']} was recorded with {baseline['settings']}; "
+                                   'use the same options or --update-baseline')
+
+        # unthrottled logins; Server-Timing carries the query counts, also over HTTP
+        limits = {'ip': (10 ** 9, 10 ** 9), 'account': (10 ** 9, 10 ** 9)}
+        with benchmark_database(), override_settings(LOGIN_RATE_LIMITS=limits, SERVER_TIMING_HEADER=True):
+            profile, rated_profile = self._seed(options)
+            scenarios = build_scenarios(profile, rated_profile)
+            missing = uncovered_routes(scenarios)
+            if missing:
+                raise CommandError(f"No benchmark scenario for the routes {', '.join(missing)}")
+            for route, reason in SKIPPED_ROUTES.items():
+                self.stdout.write(f'Skipping {route}: {reason}')
+            if options['only']:
+                scenarios = [scenario for scenario in scenarios if options['only'] in scenario.name]
+
+            results = {}
+            drivers = [ClientDriver] + ([LiveServerDriver] if options['live'] else [])
+            for driver_class in drivers:
+                driver = driver_class()
+                try:
+                    self._log_in(driver, profile)
+                    results[driver.label] = self._run(driver, scenarios, options['rounds'])
+                finally:
+                    driver.close()
+
+        report = {'settings': self._settings(options), 'results': results}
+        if baseline is None:
+            if options['only']:
+                raise CommandError('Record the baseline without --only')
+            options['baseline'].write_text(json.dumps(report, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(f"Baseline written to {options['baseline']}")
+            return
+
+        found = []
+        for label, driver_results in results.items():
+            found += [(f'{label} {name}', message) for name, message in regressions(
+                baseline['results'].get(label, {}), driver_results,
+                options['threshold'], options['min_delta_ms'], options['query_threshold'],
+            )]
+        for name, message in found:
+            self.stderr.write(f'REGRESSION {name}: {message}')
+        if found:
+            raise CommandError(f"{len(found)} regression(s) against {options['baseline']}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
+
+    @staticmethod
+    def _settings(options):
+        return {'profiles': options['profiles'], 'photos': options['photos'], 'rounds': options['rounds']}
+
+    def _seed(self, options):
+        seed_profiles(options['profiles'])
+        # the provider's profile is the one with many photos; every service label resolves
+        profile = UserProfile.objects.select_related('user').order_by('pk').first()
+        profile.user.set_password(PASSWORD)
+        profile.user.save(update_fields=['create_password', 'confirm_password'])
+        ProfileImage.objects.bulk_create(
+            ProfileImage(profile=profile, image=f'Img/profile/benchmark{i}.jpg', processing_status=ProfileImage.READY)
+            for i in range(options['photos'])
+        )
+        visitor = User(name='bench-visitor', contact=9999999999, email='bench-visitor@example.com',
+                       city='Pune', user_type='user')
+        visitor.set_password(PASSWORD)
+        visitor.save()
+        get_user_model().objects.create_superuser('bench-staff', 'staff@example.com', PASSWORD)
+        rated_profile = UserProfile.objects.exclude(pk=profile.pk).order_by('pk').first()
+        return profile, rated_profile
+
+    def _log_in(self, driver, profile):
+        logged_in = (
+            driver.login('user', 'bench-visitor', PASSWORD, 'user')
+            and driver.login('provider', profile.user.name, PASSWORD, 'service_provider')
+            and driver.login_staff('staff', get_user_model().objects.get(username='bench-staff'), PASSWORD)
+        )
+        if not logged_in:
+            raise CommandError(f'{driver.label}: could not log in the benchmark users')
+
+    def _run(self, driver, scenarios, rounds):
+        results = {}
+        width = max(len(scenario.name) for scenario in scenarios)
+        self.stdout.write(f'{driver.label}: {"scenario":<{width}}  {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} '
+                          f'{"req/s":>8} {"queries":>8}')
+        for scenario in scenarios:
+            latencies, queries = [], []
+            for i in range(rounds):
+                data = scenario.data(i) if callable(scenario.data) else scenario.data
+                started = time.perf_counter()
+                status, server_timing = driver.request(scenario.role, scenario.method, scenario.path, data)
+                latencies.append(time.perf_counter() - started)
+                if status not in scenario.expect:
+                    raise CommandError(f'{driver.label} {scenario.name}: {scenario.method} {scenario.path} '
+                                       f'returned {status}, expected {scenario.expect}')
+                queries.append(_queries(server_timing))
+            summary = results[scenario.name] = _summary(latencies, queries, sum(latencies))
+            self.stdout.write(
+                f'{driver.label}: {scenario.name:<{width}}  {summary["p50_ms"]:>8.2f} {summary["p90_ms"]:>8.2f} '
+                f'{summary["p99_ms"]:>8.2f} {summary["requests_per_s"]:>8.1f} '
+                f'{summary["queries_first"]:>3}/{summary["queries"]:<4}'
+            )
+        return results
@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from demo.benchmarks import benchmark_database, seed_profiles
+from demo.models import User, UserProfile
+
+STOCK_MIDDLEWARE = 'django.contrib.sessions.middleware.SessionMiddleware'
+BACKENDS = {
+    'db (stock)': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'MIDDLEWARE': [STOCK_MIDDLEWARE if name == 'demo.sessions.SessionMiddleware' else name
+                       for name in settings.MIDDLEWARE],
+    },
+    'demo.sessions': {
+        'SESSION_ENGINE': 'demo.sessions',
+        'MIDDLEWARE': [name if name != STOCK_MIDDLEWARE else 'demo.sessions.SessionMiddleware'
+                       for name in settings.MIDDLEWARE],
+    },
+}
+
+
+def _is_session_query(query):
+    return 'django_session' in query['sql']
+
+
+class Command(BaseCommand):
+    help = ('Browse a throw-away database as a logged-in user and count the database '
+            'round-trips per request with the stock db session backend and with demo.sessions')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=1000, help='Number of profiles to seed (default 1000)')
+        parser.add_argument('--rounds', type=int, default=20, help='Times to visit each page (default 20)')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            seed_profiles(options['profiles'])
+            User.objects.create(
+                name='visitor', contact=9999999999, email='visitor@example.com', city='Pune',
+                create_password='x', confirm_password='x', user_type='user',
+            )
+            profile = UserProfile.objects.order_by('pk').first()
+            pages = [reverse(name) for name in ('index', 'choose', 'explore', 'builderfeed')]
+            pages.append(reverse('profile_detail', args=[profile.pk]))
+
+            for label, overrides in BACKENDS.items():
+                # same starting point for both: cold feed and session caches
+                for cache in caches.all():
+                    cache.clear()
+                with override_settings(**overrides):
+                    total, session, requests = self._browse(pages, options['rounds'])
+                self.stdout.write(
+                    f'{label}: {total / requests:.2f} queries/request, '
+                    f'{session / requests:.2f} of them on django_session ({requests} requests)'
+                )
+
+    def _browse(self, pages, rounds):
+        client = Client()
+        response = client.post(reverse('trending'), {'name': 'visitor', 'confirm_password': 'x', 'user_type': 'user'})
+        if response.status_code != 302:
+            raise CommandError('Could not log in the benchmark user')
+        total = session = requests = 0
+        for _ in range(rounds):
+            for url in pages:
+                with CaptureQueriesContext(connection) as queries:
+                    client.get(url)
+                total += len(queries)
+                session += sum(1 for query in queries.captured_queries if _is_session_query(query))
+                requests += 1
+        return total, session, requests
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from demo.benchmarks import benchmark_database, plan_problems, seed_profiles
+from demo.models import FeedFacet
+from demo.pagination import CursorPage
+from demo.views import _login_candidates, _service_feed_queryset
+
+
+def _cursor_page_query(service_label, depth):
+    """The query CursorPage runs for the page after the ``depth``-th profile."""
+    row = _service_feed_queryset(service_label)[depth]
+    after = (row.rank_score, row.company_name, row.pk)
+    return CursorPage.window(_service_feed_queryset(service_label), 9, after=after)
+
+
+class Command(BaseCommand):
+    help = ('Seed a throw-away database and check with EXPLAIN that the feed, '
+            'facet and login queries are served by indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=100000, help='Number of profiles to seed (default 100000)')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            started = time.perf_counter()
+            seed_profiles(options['profiles'])
+            self.stdout.write(f"Seeded {options['profiles']} profiles in {time.perf_counter() - started:.1f}s")
+
+            # about half-way through one category's ~1/9th share of the profiles
+            depth = max(options['profiles'] // 20, 1)
+            queries = {
+                'feed': _service_feed_queryset('Builders')[:9],
+                'feed city+rating': _service_feed_queryset('Builders', city='pune', min_rating='4')[:9],
+                'feed deep page': _service_feed_queryset('Builders')[depth:depth + 9],
+                'feed deep cursor page': _cursor_page_query('Builders', depth),
+                'city/rating facets': FeedFacet.objects.filter(service_type='builders', count__gt=0),
+                'login by name': _login_candidates('provider42'),
+                'login by email': _login_candidates('Provider42@Example.com'),
+            }
+            failures = 0
+            for label, qs in queries.items():
+                plan = qs.explain()
+                problems = plan_problems(plan)
+                started = time.perf_counter()
+                list(qs)
+                elapsed = (time.perf_counter() - started) * 1000
+                style = self.style.ERROR if problems else self.style.SUCCESS
+                self.stdout.write(style(f'{label}: {elapsed:.1f} ms'))
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+                failures += bool(problems)
+
+        if failures:
+            raise CommandError(f'{failures} query plan(s) use a full scan or an unindexed sort')
+        self.stdout.write(self.style.SUCCESS('All queries use index scans'))
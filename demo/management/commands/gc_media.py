@@ -0,0 +1,148 @@
+import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from demo.images import derivative_source, is_derivative
+from demo.models import MediaBlob
+from demo.storage import referenced_names
+
+TEMPORARY_PREFIX = '.upload-'
+BATCH_SIZE = 500
+
+
+def _scan(directory):
+    files, directories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+    return files, directories
+
+
+def walk_files(root, workers):
+    """Yield ``(path, size, mtime)`` of every file under ``root``, scanning ``workers`` directories at a time."""
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_scan, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                yield from files
+                pending |= {pool.submit(_scan, path) for path in directories}
+
+
+class Command(BaseCommand):
+    help = ('Remove media files nothing refers to: originals no image field stores, derivatives of '
+            'those, and temporary files of interrupted uploads. Files modified within the grace '
+            'period are kept.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the orphans without removing them')
+        parser.add_argument('--quarantine', metavar='DIRECTORY',
+                            help='Move the orphans to DIRECTORY (keeping their paths) instead of deleting them')
+        parser.add_argument('--grace', type=int, default=None,
+                            help='Keep files modified less than this many seconds ago (default MEDIA_ORPHAN_GRACE)')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Directories scanned in parallel (default 8)')
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(settings.MEDIA_ROOT)
+        if not os.path.isdir(root):
+            raise CommandError(f'MEDIA_ROOT {root} does not exist')
+        quarantine = os.path.abspath(options['quarantine']) if options['quarantine'] else None
+        if quarantine and os.path.commonpath([root, quarantine]) == root:
+            # serve_media would publish it
+            raise CommandError('The quarantine directory must be outside MEDIA_ROOT')
+        grace = settings.MEDIA_ORPHAN_GRACE if options['grace'] is None else options['grace']
+        started = time.perf_counter()
+        # references first: a file stored after this snapshot is recent, so it is kept
+        referenced = set(referenced_names())
+        cutoff = time.time() - grace
+
+        files = {}
+        for path, size, modified in walk_files(root, options['workers']):
+            files[os.path.relpath(path, root).replace(os.sep, '/')] = (size, modified)
+        # derivatives go with their original while it is referenced or recent
+        kept = referenced | {name for name, (_, modified) in files.items() if modified >= cutoff}
+
+        orphans, scanned = {}, Counter()
+        for name, (size, modified) in files.items():
+            kind = self._kind(name)
+            scanned[kind] += size
+            if kind is None or modified >= cutoff:
+                continue
+            if kind == 'temporary' or (derivative_source(name) if kind == 'derivative' else name) not in kept:
+                orphans[name] = (kind, size)
+        self.stdout.write(
+            f'Scanned {len(files)} file(s), {sum(scanned.values()) / 1e6:.1f} MB, in '
+            f'{time.perf_counter() - started:.1f}s: {len(referenced)} referenced name(s)'
+        )
+
+        if not options['dry_run']:
+            orphans = self._remove(root, orphans, quarantine, cutoff)
+        if options['verbosity'] > 1:
+            for name in sorted(orphans):
+                self.stdout.write(f'  {name}')
+        by_kind, size_by_kind = Counter(), Counter()
+        for kind, size in orphans.values():
+            by_kind[kind] += 1
+            size_by_kind[kind] += size
+        summary = ', '.join(
+            f'{by_kind[kind]} {kind} ({size_by_kind[kind] / 1e6:.1f} MB)' for kind in ('original', 'derivative', 'temporary')
+        )
+        action = 'Would remove' if options['dry_run'] else 'Quarantined' if quarantine else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {len(orphans)} orphaned file(s), {sum(size_by_kind.values()) / 1e6:.1f} MB: {summary}'
+        ))
+
+    @staticmethod
+    def _kind(name):
+        if os.path.basename(name).startswith(TEMPORARY_PREFIX):
+            return 'temporary'
+        if any(part.startswith('.') for part in name.split('/')):
+            # not written by the storage
+            return None
+        return 'derivative' if is_derivative(name) else 'original'
+
+    def _remove(self, root, orphans, quarantine, cutoff):
+        """Delete or move ``orphans``; returns the ones actually removed."""
+        names = list({
+            derivative_source(name) if kind == 'derivative' else name
+            for name, (kind, _) in orphans.items() if kind != 'temporary'
+        })
+        counted = set()
+        for start in range(0, len(names), BATCH_SIZE):
+            batch = names[start:start + BATCH_SIZE]
+            # referenced since the snapshot
+            counted.update(MediaBlob.objects.filter(name__in=batch, refcount__gt=0).values_list('name', flat=True))
+        removed = {}
+        for name, orphan in orphans.items():
+            kind, _ = orphan
+            if name in counted or (kind == 'derivative' and derivative_source(name) in counted):
+                continue
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    # reused by an upload since the scan
+                    continue
+                if quarantine:
+                    target = os.path.join(quarantine, name)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed[name] = orphan
+        released = [name for name, (kind, _) in removed.items() if kind == 'original']
+        for start in range(0, len(released), BATCH_SIZE):
+            MediaBlob.objects.filter(name__in=released[start:start + BATCH_SIZE], refcount=0).delete()
+        return removed
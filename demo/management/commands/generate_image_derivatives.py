@@ -0,0 +1,56 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from demo.images import Derivatives, generate_derivatives
+from demo.models import IMAGE_FIELDS, ProfileImage
+
+
+class Command(BaseCommand):
+    help = 'Generate the resized WebP/JPEG derivatives of uploaded images that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate derivatives that already exist')
+        parser.add_argument('--jobs', type=int, default=4, help='Images processed in parallel (default 4)')
+
+    def _fieldfiles(self):
+        seen = set()
+        for model, field_name in IMAGE_FIELDS:
+            for instance in model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True}).only(field_name):
+                fieldfile = getattr(instance, field_name)
+                if fieldfile.name not in seen:
+                    seen.add(fieldfile.name)
+                    yield fieldfile
+
+    def _process(self, fieldfile):
+        if not self.force and Derivatives(fieldfile).exists():
+            outcome, detail = 'skipped', fieldfile.name
+        else:
+            try:
+                generate_derivatives(fieldfile)
+            except OSError as exc:
+                outcome, detail = 'failed', f'{fieldfile.name}: {exc}'
+            else:
+                outcome, detail = 'generated', fieldfile.name
+        if isinstance(fieldfile.instance, ProfileImage):
+            status = ProfileImage.FAILED if outcome == 'failed' else ProfileImage.READY
+            ProfileImage.objects.filter(image=fieldfile.name).update(processing_status=status)
+        return outcome, detail
+
+    def handle(self, *args, **options):
+        self.force = options['force']
+        started = time.perf_counter()
+        counts = {'generated': 0, 'skipped': 0, 'failed': 0}
+        # Pillow releases the GIL while decoding, resizing and encoding
+        with ThreadPoolExecutor(max_workers=max(options['jobs'], 1)) as pool:
+            for outcome, detail in pool.map(self._process, self._fieldfiles()):
+                counts[outcome] += 1
+                if outcome == 'failed':
+                    self.stderr.write(self.style.WARNING(f'Could not process {detail}'))
+                elif outcome == 'generated' and options['verbosity'] > 1:
+                    self.stdout.write(detail)
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated derivatives for {counts['generated']} image(s), skipped {counts['skipped']}, "
+            f"failed {counts['failed']} in {time.perf_counter() - started:.1f}s"
+        ))
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from demo.benchmarks import benchmark_database, generate_load_data
+from demo.models import User
+
+
+class Command(BaseCommand):
+    help = ('Bulk-insert a reproducible, production-sized data set (users, profiles in every '
+            'category, skewed ratings, images) for load testing')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--providers', type=int, default=20000, help='Service providers/profiles (default 20000)')
+        parser.add_argument('--users', type=int, default=100000, help='Regular users (default 100000)')
+        parser.add_argument('--ratings', type=int, default=1000000, help='Ratings (default 1000000)')
+        parser.add_argument('--max-images', type=int, default=3, help='Maximum photos per profile (default 3)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed gives the same data')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--prefix', default='load', help='Prefix of the generated user names (default "load")')
+        parser.add_argument('--throwaway', action='store_true',
+                            help='Generate into a temporary test database and drop it afterwards (timing only)')
+
+    def handle(self, *args, **options):
+        if options['throwaway']:
+            with benchmark_database():
+                self._generate(options)
+        else:
+            if User.objects.filter(name__startswith=options['prefix']).exists():
+                raise CommandError(
+                    f"Users named {options['prefix']}... already exist; use another --prefix or a fresh database"
+                )
+            self._generate(options)
+
+    def _generate(self, options):
+        started = time.perf_counter()
+
+        def log(message):
+            self.stdout.write(f'{time.perf_counter() - started:7.1f}s  {message}')
+
+        try:
+            counts = generate_load_data(
+                providers=options['providers'], users=options['users'], ratings=options['ratings'],
+                max_images=options['max_images'], seed=options['seed'], batch_size=options['batch_size'],
+                prefix=options['prefix'], log=log,
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {counts['users']} users, {counts['profiles']} profiles, {counts['ratings']} ratings "
+            f"and {counts['images']} images in {time.perf_counter() - started:.1f}s"
+        ))
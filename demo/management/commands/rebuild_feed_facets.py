@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from demo.facets import rebuild_facets
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-category city and rating facets shown in the service feed filters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('service_types', nargs='*', help='Only rebuild these categories (default: all)')
+
+    def handle(self, *args, **options):
+        rows = rebuild_facets(options['service_types'] or None)
+        self.stdout.write(self.style.SUCCESS(f'Stored {rows} facet row(s)'))
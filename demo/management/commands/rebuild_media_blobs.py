@@ -0,0 +1,65 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Sum
+
+from demo.feed_cache import invalidate_categories
+from demo.images import Derivatives
+from demo.models import IMAGE_FIELDS, SERVICE_TYPE_CHOICES, MediaBlob, UserProfile
+from demo.storage import is_content_name, rebuild_blob_references
+from demo.tasks import queue_image_processing
+
+
+class Command(BaseCommand):
+    help = ('Recount the references of stored media files (MediaBlob); with --dedupe, first move '
+            'files stored under their client names to content-addressed names')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dedupe', action='store_true',
+            help='Store every referenced file that still has its client name by content and point the rows at it',
+        )
+
+    def handle(self, *args, **options):
+        if options['dedupe']:
+            self._dedupe(options['verbosity'])
+        names = rebuild_blob_references()
+        report = MediaBlob.objects.filter(refcount__gt=0).aggregate(
+            blobs=Count('pk'), bytes=Sum('size'), references=Sum('refcount'),
+            referenced_bytes=Sum(F('size') * F('refcount')),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Counted references to {names} stored file(s): {report['references'] or 0} reference(s) to "
+            f"{report['blobs']} file(s), {(report['bytes'] or 0) / 1e6:.1f} MB on disk for "
+            f"{(report['referenced_bytes'] or 0) / 1e6:.1f} MB referenced"
+        ))
+
+    def _dedupe(self, verbosity):
+        moved = {}
+        for model, field in IMAGE_FIELDS:
+            rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}).values_list('pk', field)
+            pending = []
+            for pk, name in list(rows):
+                if is_content_name(name):
+                    continue
+                if name not in moved:
+                    if not default_storage.exists(name):
+                        self.stderr.write(self.style.WARNING(f'Missing file {name} ({model.__name__} {pk})'))
+                        moved[name] = None
+                        continue
+                    with default_storage.open(name, 'rb') as content:
+                        moved[name] = default_storage.save(name, content)
+                    if verbosity > 1:
+                        self.stdout.write(f'{name} -> {moved[name]}')
+                if moved[name] and model.objects.filter(pk=pk, **{field: name}).update(**{field: moved[name]}):
+                    instance = model(pk=pk, **{field: moved[name]})
+                    if not Derivatives(getattr(instance, field)).exists():
+                        pending.append(instance)
+            # derivatives are named after the stored file
+            queue_image_processing(pending, field)
+        # nothing refers to the old files any more: gc_media removes them
+        stored = {new for new in moved.values() if new}
+        self.stdout.write(f'Moved {sum(1 for new in moved.values() if new)} file(s) to {len(stored)} content name(s)')
+        # the API and the cached feeds show the URLs of logos and photos
+        UserProfile.touch(logo__in=stored)
+        UserProfile.touch(images__image__in=stored)
+        invalidate_categories([value for value, _ in SERVICE_TYPE_CHOICES])
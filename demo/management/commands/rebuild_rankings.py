@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from demo import ranking
+
+
+class Command(BaseCommand):
+    help = ('Rescore every profile with the Bayesian, time-decayed ranking and rewrite the top providers '
+            'of each category; run daily, as the decay changes the scores without any new rating')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        profiles = ranking.rebuild_rankings()
+        engine = 'NumPy' if ranking.np is not None else 'Python'
+        self.stdout.write(self.style.SUCCESS(
+            f'Ranked {profiles} profile(s) in {time.perf_counter() - started:.2f}s ({engine})'
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from demo.facets import rebuild_facets
+from demo.ratings import find_rating_aggregate_drift, rebuild_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or verify with --check) the rating aggregates stored on UserProfile'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only report profiles whose stored aggregates are out of date; exit non-zero if any are found',
+        )
+
+    def handle(self, *args, **options):
+        if options['check']:
+            drifted = find_rating_aggregate_drift()
+            for row in drifted:
+                self.stdout.write(self.style.WARNING(
+                    f"{row['company_name']} (id={row['pk']}): stored "
+                    f"{row['rating_sum']}/{row['rating_count']}/{row['avg_rating']:.3f}, actual "
+                    f"{row['actual_sum']}/{row['actual_count']}/{row['actual_avg']:.3f} (sum/count/avg)"
+                ))
+            if drifted:
+                raise CommandError(f'{len(drifted)} profile(s) have stale rating aggregates')
+            self.stdout.write(self.style.SUCCESS('Rating aggregates are consistent'))
+            return
+
+        updated = rebuild_rating_aggregates()
+        # the min_rating facet buckets are derived from the averages
+        rebuild_facets()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rating aggregates for {updated} profile(s)'))
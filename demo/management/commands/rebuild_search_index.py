@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from demo.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index used by the service feeds'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        started = time.perf_counter()
+        with transaction.atomic():
+            indexed = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'{type(backend).__name__}: indexed {indexed} profile(s) in {time.perf_counter() - started:.2f}s'
+        ))
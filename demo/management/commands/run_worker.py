@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from demo import worker_process
+from demo.jobs import claim, prune_finished, requeue_crashed, requeue_stale, run_job
+from demo.models import Job
+
+# seconds between two prunings of finished jobs
+PRUNE_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background jobs (image processing) in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Pool size (default: number of CPUs); 0 runs jobs in this process')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait before checking an empty queue again (default 2)')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+        parser.add_argument('--keep-days', type=float, default=None,
+                            help='Delete jobs finished more than this many days ago (default JOB_RETENTION_DAYS)')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        keep_days = settings.JOB_RETENTION_DAYS if options['keep_days'] is None else options['keep_days']
+        self.retention = timedelta(days=keep_days)
+        self.pruned_at = None
+        requeue_stale()
+        self._prune()
+        if options['processes'] <= 0:
+            self._run_inline(options)
+            return
+        self.processes = options['processes']
+        pool = self._pool()
+        running = {}
+        # jobs that were in a pool that crashed, with others: they run one at a time until
+        # each has had its turn, so the one that crashes it gets the blame (see _restart)
+        self.suspects = set()
+        try:
+            while True:
+                limit = 1 if self.suspects else self.processes * 2
+                claimed = claim(limit - len(running)) if len(running) < limit else []
+                if self.suspects and claimed:
+                    # claim() takes the lowest due ids: suspects below these are no longer queued
+                    self.suspects = {job_id for job_id in self.suspects if job_id >= min(claimed)}
+                try:
+                    for job_id in claimed:
+                        running[pool.submit(worker_process.run, job_id)] = job_id
+                except BrokenProcessPool as exc:
+                    pool = self._restart(pool, running, set(claimed) - set(running.values()), exc)
+                    continue
+                if not running:
+                    if options['once']:
+                        break
+                    close_old_connections()
+                    time.sleep(options['poll_interval'])
+                    requeue_stale()
+                    self._prune()
+                    continue
+                done, _ = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                broken = None
+                for future in done:
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        broken = future.exception()
+                        continue
+                    job_id = running.pop(future)
+                    self.suspects.discard(job_id)
+                    self._report(job_id, future)
+                if broken:
+                    pool = self._restart(pool, running, (), broken)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping, waiting for the running jobs...')
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            cancelled = [job_id for future, job_id in running.items() if future.cancelled()]
+            # claimed but never started: hand them back instead of waiting for requeue_stale
+            Job.objects.filter(pk__in=cancelled, status=Job.RUNNING).update(status=Job.PENDING, claimed_at=None)
+
+    def _pool(self):
+        # spawn rather than fork: a forked child would share the parent's database connection
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=worker_process.initialize,
+        )
+
+    def _restart(self, pool, running, unsubmitted, exc):
+        """Replace a pool that lost a process (e.g. to the OOM killer) and requeue its jobs.
+
+        Every job submitted to a broken pool fails with BrokenProcessPool, and which
+        of them killed the process is unknown: a job that was alone in the pool is
+        blamed, the others get their attempt back and become suspects.
+        """
+        job_ids = {*running.values(), *unsubmitted}
+        running.clear()
+        pool.shutdown(wait=True, cancel_futures=True)
+        error = f'The worker process running this job died: {exc!r}'
+        blame = len(job_ids) == 1
+        requeue_crashed(job_ids, error, blame=blame)
+        if blame:
+            self.suspects -= job_ids
+        else:
+            self.suspects |= job_ids
+        ids = ', '.join(f'#{job_id}' for job_id in sorted(job_ids))
+        self.stderr.write(self.style.ERROR(f'A worker process died running job(s) {ids}; restarting the pool'))
+        return self._pool()
+
+    def _run_inline(self, options):
+        while True:
+            job_ids = claim(1)
+            if not job_ids:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                requeue_stale()
+                self._prune()
+                continue
+            self._log(*run_job(job_ids[0]))
+
+    def _prune(self):
+        """Delete old finished jobs, at most every PRUNE_INTERVAL while idle."""
+        now = time.monotonic()
+        if self.pruned_at is not None and now - self.pruned_at < PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        pruned = prune_finished(timezone.now() - self.retention)
+        if pruned and self.verbosity > 1:
+            self.stdout.write(f'Pruned {pruned} finished job(s)')
+
+    def _report(self, job_id, future):
+        try:
+            self._log(*future.result())
+        except Exception as exc:
+            # run_job itself failed (e.g. lost the database); requeue_stale will retry the job
+            self.stderr.write(self.style.ERROR(f'Job #{job_id} could not be run: {exc!r}'))
+
+    def _log(self, job_id, status):
+        if status == Job.FAILED:
+            self.stderr.write(self.style.ERROR(f'Job #{job_id} failed'))
+        elif status == Job.PENDING:
+            self.stderr.write(self.style.WARNING(f'Job #{job_id} raised an error, will be retried'))
+        elif self.verbosity > 1:
+            self.stdout.write(f'Job #{job_id} done')
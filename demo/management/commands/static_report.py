@@ -0,0 +1,43 @@
+import json
+
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from demo.staticfiles import REPORT_NAME
+
+
+def _served(entry):
+    """Smallest representation a client can get: optimized file, WebP/MP4 variant or precompressed sibling."""
+    return min(entry.get(key, entry['optimized']) for key in ('optimized', 'webp', 'mp4', 'gz', 'br'))
+
+
+class Command(BaseCommand):
+    help = 'Show the bytes collectstatic saved per static asset (recompression, variants, gzip/brotli)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=30, help='Assets to list, largest saving first (0 for all)')
+
+    def handle(self, *args, **options):
+        try:
+            with staticfiles_storage.open(REPORT_NAME) as file:
+                report = json.load(file)
+        except (FileNotFoundError, AttributeError):
+            raise CommandError(f'{REPORT_NAME} not found: run collectstatic first')
+
+        report.sort(key=lambda entry: entry['original'] - _served(entry), reverse=True)
+        shown = report[:options['limit']] if options['limit'] else report
+        width = max((len(entry['name']) for entry in shown), default=10)
+        self.stdout.write(f"{'asset':<{width}}  {'original':>10}  {'served':>10}  {'saved':>10}  via")
+        for entry in shown:
+            served = _served(entry)
+            via = [key for key in ('optimized', 'webp', 'mp4', 'gz', 'br') if entry.get(key) == served]
+            self.stdout.write(
+                f"{entry['name']:<{width}}  {entry['original']:>10,}  {served:>10,}  "
+                f"{entry['original'] - served:>10,}  {via[0] if served < entry['original'] else '-'}"
+            )
+        original = sum(entry['original'] for entry in report)
+        served = sum(_served(entry) for entry in report)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(report)} assets: {original:,} -> {served:,} bytes ({(original - served) / original:.0%} saved)'
+            if original else 'No assets processed'
+        ))
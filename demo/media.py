@@ -0,0 +1,177 @@
+"""Serving uploaded media (``MEDIA_URL``) from Django.
+
+``serve_media`` answers for any file in ``MEDIA_ROOT`` with
+
+  - a strong ``ETag`` and ``Last-Modified``, and ``304 Not Modified`` for a
+    matching ``If-None-Match``/``If-Modified-Since``;
+  - single ``bytes=`` ranges (``206``, ``416``, ``If-Range``), so clients can
+    resume or fetch parts of large gallery images;
+  - a long-lived ``Cache-Control``: files under a content name
+    (``demo.storage``) and their derivatives never change under that name and
+    are ``immutable`` for a year; files stored under client names are cached
+    for ``MEDIA_CACHE_MAX_AGE`` seconds.
+
+The body is never read into Python memory by the view. ``MediaResponse``
+hands the open file, positioned at the start of the range and with the exact
+``Content-Length``, to the WSGI server's ``wsgi.file_wrapper``; gunicorn and
+uWSGI send it with ``os.sendfile``. Other servers read it in
+``MediaResponse.block_size`` chunks. With ``MEDIA_SENDFILE_HEADER`` set to
+``'X-Accel-Redirect'`` (nginx, which must serve ``MEDIA_ACCEL_REDIRECT_PREFIX``
+as an ``internal`` location aliased to ``MEDIA_ROOT``) or ``'X-Sendfile'``
+(Apache mod_xsendfile, lighttpd), Django only checks the request and the
+front-end server sends the file and handles the ranges.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from .images import is_derivative
+from .storage import is_content_name
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """``length`` bytes of an open file, from its current position.
+
+    ``fileno()`` lets a sendfile-capable ``wsgi.file_wrapper`` send them from
+    the file's offset; reading stops at the end of the range.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class MediaResponse(FileResponse):
+    # chunk size where the server reads the file itself (ASGI, wsgiref)
+    block_size = 256 * 1024
+
+
+def media_etag(name, stat):
+    if is_content_name(name) and not is_derivative(name):
+        # the name is the SHA-256 of the content: the same on every server
+        return '"%s"' % os.path.splitext(os.path.basename(name))[0]
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """``(start, end)`` (inclusive) of a ``Range: bytes=`` header, ``None`` to send
+    the whole file, or ``False`` if it cannot be satisfied."""
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        # malformed, or several ranges: answering with the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        return (max(size - suffix, 0), size - 1) if suffix and size else False
+    start, end = int(first), int(last) if last else None
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        return False
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def _if_range_passes(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        # only strong validators can make a range request conditional
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _offload(name, path):
+    if settings.MEDIA_SENDFILE_HEADER == 'X-Accel-Redirect':
+        return settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(name)
+    return path
+
+
+@require_safe
+def serve_media(request, path):
+    """Serve the file ``path`` of ``MEDIA_ROOT``; see the module docstring."""
+    name = path.replace('\\', '/')
+    # dot files are temporary (demo.storage) or not meant to be published
+    if any(part.startswith('.') for part in name.split('/')):
+        raise Http404
+    try:
+        full_path = default_storage.path(name)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    etag = media_etag(name, stat)
+    last_modified = int(stat.st_mtime)
+    max_age = IMMUTABLE_MAX_AGE if is_content_name(name) else settings.MEDIA_CACHE_MAX_AGE
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': f'public, max-age={max_age}' + (', immutable' if max_age == IMMUTABLE_MAX_AGE else ''),
+    }
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        for header, value in headers.items():
+            conditional[header] = value
+        return conditional
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    if settings.MEDIA_SENDFILE_HEADER:
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response[settings.MEDIA_SENDFILE_HEADER] = _offload(name, full_path)
+        return response
+
+    size = stat.st_size
+    requested = None
+    if 'Range' in request.headers and _if_range_passes(request, etag, last_modified):
+        requested = parse_range(request.headers['Range'], size)
+    if requested is False:
+        return HttpResponse(status=416, headers={'Content-Range': f'bytes */{size}'})
+
+    file = open(full_path, 'rb')
+    start, end = requested or (0, size - 1)
+    if start:
+        file.seek(start)
+    response = MediaResponse(FileRange(file, end - start + 1), content_type=content_type, headers=headers)
+    response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if requested:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:24
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    UserProfile = apps.get_model('demo', 'UserProfile')
+    Rating = apps.get_model('demo', 'Rating')
+    totals = Rating.objects.values('profile_id').annotate(s=Sum('rating'), c=Count('id'))
+    for row in totals:
+        UserProfile.objects.filter(pk=row['profile_id']).update(
+            rating_sum=row['s'],
+            rating_count=row['c'],
+            avg_rating=row['s'] / row['c'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0003_alter_userprofile_service_type_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='avg_rating',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:26
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0004_userprofile_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['profile', 'rating'], name='rating_profile_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('city'), name='user_city_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='user_email_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(django.db.models.functions.text.Lower('service_type'), models.OrderBy(models.F('avg_rating'), descending=True), models.F('company_name'), name='profile_feed_order_idx'),
+        ),
+    ]
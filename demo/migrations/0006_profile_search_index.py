@@ -0,0 +1,66 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SEARCH_TABLE = 'demo_profile_search'
+
+SQLITE_SQL = [
+    f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+    "company_name, company_description, city, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    f"INSERT INTO {SEARCH_TABLE} (rowid, company_name, company_description, city) "
+    "SELECT p.id, p.company_name, p.company_description, u.city "
+    "FROM demo_userprofile p INNER JOIN demo_user u ON u.id = p.user_id",
+]
+
+POSTGRES_SQL = [
+    f"CREATE TABLE {SEARCH_TABLE} ("
+    "profile_id bigint PRIMARY KEY REFERENCES demo_userprofile (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)",
+    f"CREATE INDEX {SEARCH_TABLE}_document_idx ON {SEARCH_TABLE} USING gin (document)",
+    f"INSERT INTO {SEARCH_TABLE} (profile_id, document) "
+    "SELECT p.id, to_tsvector('simple', coalesce(p.company_name, '') || ' ' "
+    "|| coalesce(p.company_description, '') || ' ' || coalesce(u.city, '')) "
+    "FROM demo_userprofile p INNER JOIN demo_user u ON u.id = p.user_id",
+]
+
+
+def create_search_index(apps, schema_editor):
+    statements = {
+        'sqlite': SQLITE_SQL,
+        'postgresql': POSTGRES_SQL,
+    }.get(schema_editor.connection.vendor, [])
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0005_feed_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.CreateModel(
+            name='ProfileSearchEntry',
+            fields=[
+                ('profile', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='demo.userprofile')),
+                ('company_name', models.TextField()),
+                ('company_description', models.TextField()),
+                ('city', models.TextField()),
+                ('document', models.TextField(db_column='demo_profile_search')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'demo_profile_search',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:37
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import Lower
+
+
+def backfill_feed_facets(apps, schema_editor):
+    UserProfile = apps.get_model('demo', 'UserProfile')
+    FeedFacet = apps.get_model('demo', 'FeedFacet')
+    profiles = UserProfile.objects.annotate(category=Lower('service_type'))
+    rows = [
+        FeedFacet(service_type=entry['category'], facet='city', value=entry['user__city'], count=entry['n'])
+        for entry in profiles.exclude(user__city='').values('category', 'user__city').annotate(n=Count('pk')).order_by()
+    ]
+    buckets = profiles.values('category').annotate(**{
+        f'at_least_{k}': Count('pk', filter=Q(avg_rating__gte=k)) for k in range(1, 6)
+    }).order_by()
+    for entry in buckets:
+        rows.extend(
+            FeedFacet(service_type=entry['category'], facet='min_rating', value=str(k), count=entry[f'at_least_{k}'])
+            for k in range(1, 6)
+        )
+    FeedFacet.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0006_profile_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_type', models.CharField(max_length=100)),
+                ('facet', models.CharField(choices=[('city', 'City'), ('min_rating', 'Minimum rating')], max_length=20)),
+                ('value', models.CharField(max_length=50)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('service_type', 'facet', 'value'), name='feedfacet_unique_value')],
+            },
+        ),
+        migrations.RunPython(backfill_feed_facets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:45
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def queue_existing_images(apps, schema_editor):
+    ProfileImage = apps.get_model('demo', 'ProfileImage')
+    Job = apps.get_model('demo', 'Job')
+    Job.objects.bulk_create([
+        Job(task='demo.tasks.process_image', payload={'model': 'demo.profileimage', 'pk': pk, 'field': 'image'})
+        for pk in ProfileImage.objects.exclude(image='').values_list('pk', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0007_feed_facets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profileimage',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', editable=False, max_length=20),
+        ),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=100)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='job_queue_idx')],
+            },
+        ),
+        migrations.RunPython(queue_existing_images, migrations.RunPython.noop),
+    ]
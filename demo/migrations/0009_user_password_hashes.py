@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0008_background_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='confirm_password',
+            field=models.CharField(max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='create_password',
+            field=models.CharField(max_length=128),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.1 on 2026-10-18 14:59
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def disambiguate_duplicate_emails(apps, schema_editor):
+    """Keep each email on its oldest account; later duplicates get ``+duplicate<pk>`` added.
+
+    Those accounts can still log in by name and fix their email in edit_account.
+    """
+    User = apps.get_model('demo', 'User')
+    seen = set()
+    for pk, email in User.objects.order_by('pk').values_list('pk', 'email'):
+        key = email.lower()
+        if key in seen:
+            local, _, domain = email.partition('@')
+            User.objects.filter(pk=pk).update(email=f'{local}+duplicate{pk}@{domain}')
+        seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0009_user_password_hashes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_email_lower_idx',
+        ),
+        migrations.RunPython(disambiguate_duplicate_emails, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='user',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name='user_email_lower_uniq'),
+        ),
+    ]
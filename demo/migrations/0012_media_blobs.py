@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:28
+
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+IMAGE_FIELDS = [('ProfileImage', 'image'), ('UserProfile', 'logo'), ('Product', 'banner'), ('Images', 'images')]
+
+
+def count_references(apps, schema_editor):
+    MediaBlob = apps.get_model('demo', 'MediaBlob')
+    counts = Counter()
+    for model_name, field in IMAGE_FIELDS:
+        model = apps.get_model('demo', model_name)
+        counts.update(model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                      .values_list(field, flat=True))
+    rows = []
+    for name, refcount in counts.items():
+        try:
+            size = default_storage.size(name)
+        except OSError:
+            size = 0
+        rows.append(MediaBlob(name=name, size=size, refcount=refcount))
+    MediaBlob.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0011_userprofile_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 5.2.1 on 2026-10-18 15:45
+
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+import demo.models
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+
+def score_profiles(apps, schema_editor):
+    # demo.ranking.rebuild_rankings, without NumPy
+    UserProfile = apps.get_model('demo', 'UserProfile')
+    Rating = apps.get_model('demo', 'Rating')
+    ProviderRank = apps.get_model('demo', 'ProviderRank')
+    epoch = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)  # demo.ranking.DECAY_EPOCH
+    half_life = settings.RANKING_HALF_LIFE_DAYS
+    counts, sums = defaultdict(float), defaultdict(float)
+    for profile_id, rating, created_at in Rating.objects.values_list('profile_id', 'rating', 'created_at').iterator():
+        weight = 2 ** ((created_at - epoch).total_seconds() / 86400 / half_life)
+        counts[profile_id] += weight
+        sums[profile_id] += weight * rating
+    scale = 2 ** ((timezone.now() - epoch).total_seconds() / 86400 / half_life)
+    prior_weight, prior = settings.RANKING_PRIOR_WEIGHT, settings.RANKING_PRIOR_WEIGHT * settings.RANKING_PRIOR_MEAN
+    profiles = []
+    for profile in UserProfile.objects.only('pk'):
+        profile.decayed_count, profile.decayed_sum = counts[profile.pk], sums[profile.pk]
+        profile.rank_score = (prior + profile.decayed_sum / scale) / (prior_weight + profile.decayed_count / scale)
+        profiles.append(profile)
+    UserProfile.objects.bulk_update(profiles, ['decayed_count', 'decayed_sum', 'rank_score'], batch_size=500)
+
+    ranked = (UserProfile.objects.annotate(category=Lower('service_type'))
+              .order_by('category', '-rank_score', 'company_name', 'pk'))
+    positions = defaultdict(int)
+    rows = []
+    for pk, category, score in ranked.values_list('pk', 'category', 'rank_score'):
+        positions[category] += 1
+        if positions[category] <= settings.RANKING_TOP_N:
+            rows.append(ProviderRank(service_type=category, position=positions[category], profile_id=pk, score=score))
+    ProviderRank.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0012_media_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProviderRank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_type', models.CharField(max_length=100)),
+                ('position', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='userprofile',
+            name='profile_feed_order_idx',
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='rank_score',
+            field=models.FloatField(default=demo.models._prior_rank_score, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='decayed_count',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='decayed_sum',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(django.db.models.functions.text.Lower('service_type'), models.OrderBy(models.F('rank_score'), descending=True), models.F('company_name'), name='profile_feed_order_idx'),
+        ),
+        migrations.AddField(
+            model_name='providerrank',
+            name='profile',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranks', to='demo.userprofile'),
+        ),
+        migrations.AddConstraint(
+            model_name='providerrank',
+            constraint=models.UniqueConstraint(fields=('service_type', 'position'), name='providerrank_unique_position'),
+        ),
+        migrations.RunPython(score_profiles, migrations.RunPython.noop),
+    ]
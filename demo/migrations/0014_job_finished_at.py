@@ -0,0 +1,26 @@
+# Generated by Django 5.2.1 on 2026-10-18 16:04
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_finished_at(apps, schema_editor):
+    # the time of their last run, so jobs finished before this migration are pruned too
+    Job = apps.get_model('demo', 'Job')
+    Job.objects.filter(status__in=['done', 'failed']).update(finished_at=F('run_after'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('demo', '0013_provider_ranking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_finished_at, migrations.RunPython.noop),
+    ]
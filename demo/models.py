@@ -1,5 +1,13 @@
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Lower
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+from .images import Derivatives
 
 SERVICE_TYPE_CHOICES = [
     ('Builders', 'Builders'),
@@ -13,16 +21,85 @@ SERVICE_TYPE_CHOICES = [
     ('Others', 'Others'),
 ]
 
+class StoredFilesMixin:
+    """Remember the stored names of the file fields, so a save can tell a replaced file (demo.signals)."""
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        stored = dict(zip(field_names, values))
+        instance._loaded_files = {
+            field.attname: stored[field.attname] or None
+            for field in cls._meta.concrete_fields
+            if isinstance(field, models.FileField) and field.attname in stored
+        }
+        return instance
+
+
 class User(models.Model):
     name = models.CharField(max_length=100, unique=True)
     contact = models.IntegerField()
     email = models.EmailField()
     city = models.CharField(max_length=50)
-    create_password = models.CharField(max_length=50)
-    confirm_password = models.CharField(max_length=50)
+    # both hold the same password hash (see set_password); rows from before
+    # hashing hold the plain text until the user's next login
+    create_password = models.CharField(max_length=128)
+    confirm_password = models.CharField(max_length=128)
     user_type = models.CharField(max_length=20, choices=[('user', 'User'), ('service_provider', 'Service Provider')])
 
-class UserProfile(models.Model):
+    class Meta:
+        indexes = [
+            # case-normalized lookup for the feed city filter
+            models.Index(Lower('city'), name='user_city_lower_idx'),
+        ]
+        constraints = [
+            # one account per email, in any letter case; also serves login by email
+            models.UniqueConstraint(Lower('email'), name='user_email_lower_uniq'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored city so a change can refresh the feed facets
+        instance._loaded_city = dict(zip(field_names, values)).get('city')
+        return instance
+
+    def set_password(self, raw_password):
+        self.create_password = self.confirm_password = make_password(raw_password)
+
+    def check_password(self, raw_password):
+        """Whether ``raw_password`` is correct.
+
+        A correct password stored in plain text or with outdated hasher
+        parameters is rehashed and saved on the spot.
+        """
+        def upgrade(raw_password):
+            self.set_password(raw_password)
+            User.objects.filter(pk=self.pk).update(
+                create_password=self.create_password, confirm_password=self.confirm_password,
+            )
+
+        try:
+            identify_hasher(self.confirm_password)
+        except ValueError:
+            # stored before passwords were hashed
+            valid = raw_password is not None and constant_time_compare(raw_password, self.confirm_password)
+            if valid:
+                upgrade(raw_password)
+            return valid
+        return check_password(raw_password, self.confirm_password, upgrade)
+
+
+# written by demo.ratings and demo.ranking only
+RATING_COLUMNS = ('rating_sum', 'rating_count', 'avg_rating', 'rank_score', 'decayed_count', 'decayed_sum')
+
+
+def _prior_rank_score():
+    # the score of a profile without ratings (demo.ranking)
+    return settings.RANKING_PRIOR_MEAN
+
+
+class UserProfile(StoredFilesMixin, models.Model):
     user = models.ForeignKey('User', on_delete=models.CASCADE)
     company_name = models.CharField(max_length=100, unique=True)
     office_address = models.CharField(max_length=200)
@@ -33,30 +110,173 @@ class UserProfile(models.Model):
     company_description = models.TextField()
     # optional logo for the company/profile
     logo = models.ImageField(upload_to="Img/logo", blank=True, null=True)
+    # denormalized rating aggregates, kept in sync with Rating by demo.signals
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    avg_rating = models.FloatField(default=0, editable=False)
+    # Bayesian, time-decayed score the feeds are ordered by and the decayed ratings it is
+    # computed from, weighted relative to demo.ranking.DECAY_EPOCH; written by demo.ranking
+    rank_score = models.FloatField(default=_prior_rank_score, editable=False)
+    decayed_count = models.FloatField(default=0, editable=False)
+    decayed_sum = models.FloatField(default=0, editable=False)
+    # bumped by every change to the profile, its owner, photos or ratings: the JSON API's ETag (demo.api)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # matches the service feed: WHERE lower(service_type) = ... ORDER BY -rank_score, company_name
+            models.Index(Lower('service_type'), F('rank_score').desc(), 'company_name', name='profile_feed_order_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored category so a change of service_type invalidates both feeds
+        instance._loaded_service_type = dict(zip(field_names, values)).get('service_type')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # The rating aggregates are only written by demo.ratings with F() updates (and
+        # the ranking columns by demo.ranking); saving them back from a possibly stale
+        # instance would undo concurrent ratings.
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in RATING_COLUMNS
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def touch(cls, **filters):
+        """Bump ``updated_at`` of the profiles matching ``filters`` after a change stored elsewhere."""
+        return cls.objects.filter(**filters).update(updated_at=timezone.now())
+
+    @property
+    def logo_derivatives(self):
+        return Derivatives(self.logo)
 
     def __str__(self):
         return self.company_name
     
 
     # photo =models.ImageField()
-class Product(models.Model):
+class Product(StoredFilesMixin, models.Model):
     title = models.CharField(max_length=70)
     banner = models.ImageField(upload_to="Img/banner")
+
+    @property
+    def banner_derivatives(self):
+        return Derivatives(self.banner)
     
     def _str_(self):
         return self.title
     
 
-class Images(models.Model):
+class Images(StoredFilesMixin, models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, blank=True)
     images = models.ImageField(upload_to="Img/images")
 
 
-class ProfileImage(models.Model):
-    """Images/photos uploaded for a UserProfile (service provider)."""
+class ProfileSearchEntry(models.Model):
+    """Row of the SQLite FTS5 table behind feed search (see demo.search).
+
+    Unmanaged: the virtual table is created by migration 0006. The model only
+    exists so feed queries can join the index and order by its bm25 ``rank``.
+    """
+    profile = models.OneToOneField(
+        UserProfile, primary_key=True, db_column='rowid', db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='search_entry',
+    )
+    company_name = models.TextField()
+    company_description = models.TextField()
+    city = models.TextField()
+    # FTS5 hidden columns: the one named after the table takes MATCH, "rank" is the bm25 score
+    document = models.TextField(db_column='demo_profile_search')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'demo_profile_search'
+
+
+class FeedFacet(models.Model):
+    """Precomputed filter options of a service feed (see demo.facets).
+
+    For each category (lower-cased ``service_type``) stores the number of
+    profiles per owner city and, for every ``min_rating`` option, the number of
+    profiles rated at least that much.
+    """
+    CITY = 'city'
+    MIN_RATING = 'min_rating'
+
+    service_type = models.CharField(max_length=100)
+    facet = models.CharField(max_length=20, choices=[(CITY, 'City'), (MIN_RATING, 'Minimum rating')])
+    value = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['service_type', 'facet', 'value'], name='feedfacet_unique_value'),
+        ]
+
+    def __str__(self):
+        return f"{self.service_type} {self.facet}={self.value}: {self.count}"
+
+
+class Job(models.Model):
+    """A unit of background work queued in the database (see demo.jobs)."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=20, default=PENDING,
+        choices=[(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')],
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # set when the job is done or failed for good; run_worker prunes old ones
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # the worker's poll: WHERE status = 'pending' AND run_after <= now ORDER BY id
+            models.Index(fields=['status', 'run_after'], name='job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
+
+
+class ProfileImage(StoredFilesMixin, models.Model):
+    """Images/photos uploaded for a UserProfile (service provider).
+
+    The upload is stored as is; the ``demo.tasks.process_image`` job run by
+    ``manage.py run_worker`` strips its metadata and generates the derivatives,
+    tracked by ``processing_status``.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+
     profile = models.ForeignKey(UserProfile, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='Img/profile')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    processing_status = models.CharField(
+        max_length=20, default=PENDING, editable=False,
+        choices=[(PENDING, 'Pending'), (PROCESSING, 'Processing'), (READY, 'Ready'), (FAILED, 'Failed')],
+    )
+
+    @property
+    def derivatives(self):
+        return Derivatives(self.image)
 
     def __str__(self):
         return f"Image for {self.profile.company_name}"
@@ -76,18 +296,77 @@ class Rating(models.Model):
 
     class Meta:
         unique_together = ('profile', 'user')
+        indexes = [
+            models.Index(fields=['profile', 'rating'], name='rating_profile_rating_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored profile/rating so the aggregate signals can apply a delta
+        loaded = dict(zip(field_names, values))
+        instance._loaded_rating = (loaded.get('profile_id'), loaded.get('rating'))
+        return instance
+
+    @staticmethod
+    def check_values(profile, user_id, rating):
+        """Validate a rating of ``profile`` by ``user_id`` in memory, from the loaded profile."""
+        if profile.user_id == user_id:
+            raise ValidationError("You cannot rate your own profile.")
+        if rating < 1 or rating > 5:
+            raise ValidationError("Rating must be between 1 and 5.")
 
     def clean(self):
         """Ensure a user cannot rate their own profile."""
-        if self.profile and self.user and self.profile.user_id == self.user_id:
-            raise ValidationError("You cannot rate your own profile.")
-        if self.rating < 1 or self.rating > 5:
+        if self.profile_id and self.user_id:
+            self.check_values(self.profile, self.user_id, self.rating)
+        elif self.rating < 1 or self.rating > 5:
             raise ValidationError("Rating must be between 1 and 5.")
 
     def save(self, *args, **kwargs):
-        # Run full validation before saving (defensive: prevents bypassing view checks)
-        self.full_clean()
-        super().save(*args, **kwargs)
+        # Run full validation before saving (defensive: prevents bypassing view checks).
+        # The (profile, user) pair is left to the unique index: checking it first is
+        # one more SELECT per save. The atomic block keeps the row and the profile
+        # aggregates updated together. Views write through demo.ratings.upsert_rating.
+        with transaction.atomic():
+            self.full_clean(validate_unique=False)
+            super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.user.name} -> {self.profile.company_name}: {self.rating}★"
+
+class ProviderRank(models.Model):
+    """One of the ``RANKING_TOP_N`` best-ranked profiles of a category (see demo.ranking)."""
+    # lower-cased, like FeedFacet
+    service_type = models.CharField(max_length=100)
+    position = models.PositiveSmallIntegerField()
+    profile = models.ForeignKey(UserProfile, related_name='ranks', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['service_type', 'position'], name='providerrank_unique_position'),
+        ]
 
     def __str__(self):
-        return f"{self.user.name} -> {self.profile.company_name}: {self.rating}★"
\ No newline at end of file
+        return f"{self.service_type} #{self.position}: {self.profile_id} ({self.score:.3f})"
+
+
+class MediaBlob(models.Model):
+    """A stored media file and the number of image field values referring to it (see demo.storage)."""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
+
+
+# every image field whose files are stored in MEDIA_ROOT, reference-counted by MediaBlob
+IMAGE_FIELDS = [
+    (ProfileImage, 'image'),
+    (UserProfile, 'logo'),
+    (Product, 'banner'),
+    (Images, 'images'),
+]
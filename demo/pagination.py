@@ -0,0 +1,103 @@
+"""Keyset (cursor) pagination for the service feeds.
+
+Page-number pagination needs a ``COUNT(*)`` and an ``OFFSET`` scan, both of
+which grow with the size of the category. A cursor page instead continues
+from the last row shown: the opaque ``after``/``before`` token encodes that
+row's ``(rank_score, company_name, id)`` and the next page is a range read on
+``profile_feed_order_idx``, so every page costs O(page size) however deep it is.
+There is no total count, only next/previous links.
+"""
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'demo.feed-cursor'
+
+
+def encode_cursor(profile):
+    """Cursor token of a profile instance or a ``values()`` row with ``rank_score``, ``company_name`` and ``pk``."""
+    if isinstance(profile, dict):
+        key = [profile['rank_score'], profile['company_name'], profile['pk']]
+    else:
+        key = [profile.rank_score, profile.company_name, profile.pk]
+    # a plain Signer, not dumps(): no timestamp, so a row always gets the same token
+    # and pages linked from cached fragments/ETagged API responses stay byte-identical
+    return signing.Signer(salt=CURSOR_SALT).sign_object(key, compress=True)
+
+
+def decode_cursor(token):
+    """Return ``(rank_score, company_name, id)`` or None for a missing/invalid token."""
+    if not token:
+        return None
+    try:
+        rank_score, company_name, pk = signing.Signer(salt=CURSOR_SALT).unsign_object(token)
+        return float(rank_score), str(company_name), int(pk)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+class CursorPage:
+    """One page of a feed ordered by ``-rank_score, company_name, id``.
+
+    Exposes the parts of Django's ``Page`` the feed template uses, plus
+    ``next_cursor``/``previous_cursor`` tokens for the navigation links.
+    """
+
+    def __init__(self, queryset, per_page, after=None, before=None):
+        self.per_page = per_page
+        after = decode_cursor(after)
+        before = decode_cursor(before) if after is None else None
+        rows = list(self.window(queryset, per_page, after, before))
+        if before is not None:
+            self.has_previous_page = len(rows) > per_page
+            self.has_next_page = True
+            self.object_list = rows[:per_page][::-1]
+        else:
+            self.has_previous_page = after is not None
+            self.has_next_page = len(rows) > per_page
+            self.object_list = rows[:per_page]
+
+    @staticmethod
+    def window(queryset, per_page, after=None, before=None):
+        """The rows (plus one to detect another page) following ``after`` or, in reverse, preceding ``before``.
+
+        ``after``/``before`` are decoded cursors.
+        """
+        if before is not None:
+            rank_score, company_name, pk = before
+            # the redundant rank_score bound lets the index seek instead of scanning from the top
+            return queryset.filter(rank_score__gte=rank_score).filter(
+                Q(rank_score__gt=rank_score)
+                | Q(rank_score=rank_score, company_name__lt=company_name)
+                | Q(rank_score=rank_score, company_name=company_name, pk__lt=pk)
+            ).order_by('rank_score', '-company_name', '-pk')[:per_page + 1]
+        if after is not None:
+            rank_score, company_name, pk = after
+            queryset = queryset.filter(rank_score__lte=rank_score).filter(
+                Q(rank_score__lt=rank_score)
+                | Q(rank_score=rank_score, company_name__gt=company_name)
+                | Q(rank_score=rank_score, company_name=company_name, pk__gt=pk)
+            )
+        return queryset.order_by('-rank_score', 'company_name', 'pk')[:per_page + 1]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.has_next_page and bool(self.object_list)
+
+    def has_previous(self):
+        return self.has_previous_page and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.has_next() else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.has_previous() else None
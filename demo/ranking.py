@@ -0,0 +1,273 @@
+"""Bayesian, time-decayed ranking of the service providers.
+
+Ordering by the raw average put a profile with one 5-star rating above one
+with two hundred ratings of 4.8. A profile's rank score is instead the
+average of its ratings and ``RANKING_PRIOR_WEIGHT`` virtual ratings of
+``RANKING_PRIOR_MEAN``. Each real rating counts by its age (``created_at``),
+half as much every ``RANKING_HALF_LIFE_DAYS``::
+
+    score = (C * m + sum(w * rating)) / (C + sum(w)),    w = 0.5 ** (age / half-life)
+
+A few ratings barely move a profile away from the prior, two hundred outweigh
+it, and ratings from years ago count less than this month's.
+
+Scores are materialized. ``UserProfile.rank_score`` orders the feeds, so a
+feed page is still a range read on ``profile_feed_order_idx``. ``ProviderRank``
+holds the ``RANKING_TOP_N`` first profiles of each category for the home and
+explore pages.
+
+The sums are stored too, as ``decayed_count`` and ``decayed_sum``. Their
+weights are relative to a fixed date (``DECAY_EPOCH``) instead of today: a
+rating counts ``2 ** (days since the epoch / half-life)``, and dividing by the
+weight of a rating made now gives the decayed sums above. A new, changed or
+deleted rating therefore only adds its own weight, whatever the number of
+ratings of the profile. Everything is kept current by
+
+  - every rating write, which shifts its profile's sums and score
+    (``store_profile`` or ``shift_profiles``) and rewrites its category's
+    ProviderRank rows if the profile is or gets among them;
+  - ``manage.py rebuild_rankings``, which recomputes every profile from the
+    Rating table in one vectorized pass (with NumPy when it is installed) and
+    rewrites all the rows. Decay changes the scores without any write, so run
+    it daily. Until it runs, a profile rescored by a new rating is compared
+    with scores up to a day older, which shifts the weights by less than half
+    a percent. Run it as well after changing ``RANKING_HALF_LIFE_DAYS``: the
+    stored sums depend on it.
+
+The weights grow without bound and would overflow a float ``MAX_WEIGHT_EXPONENT``
+half-lives after the epoch (in 2493 with the default half-life of 180 days,
+in 2025 with one of 2). Past that point they stop growing, so the newest
+ratings are no longer told apart by age; the ``demo.W001``/``demo.E001``
+system checks warn ahead of it. Moving ``DECAY_EPOCH`` forward and running
+``rebuild_rankings`` starts the count again.
+"""
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from . import feed_cache
+from .models import SERVICE_TYPE_CHOICES, ProviderRank, Rating, UserProfile
+
+try:
+    import numpy as np
+except ImportError:  # optional: aggregates are summed in a Python loop
+    np = None
+
+SECONDS_PER_DAY = 24 * 60 * 60
+BATCH_SIZE = 1000
+# the weights stored in decayed_count/decayed_sum are relative to this date
+DECAY_EPOCH = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+# weights stop growing at 2 ** 960: floats end at 2 ** 1024, which leaves room
+# for the sums of up to 2 ** 64 ratings
+MAX_WEIGHT_EXPONENT = 960
+
+
+def _category(service_type):
+    return (service_type or '').lower()
+
+
+def _epoch_days(moment):
+    return (moment - DECAY_EPOCH).total_seconds() / SECONDS_PER_DAY
+
+
+def rating_weight(created_at):
+    """Stored weight of a rating made at ``created_at``: doubles every half-life after ``DECAY_EPOCH``."""
+    return 2.0 ** min(_epoch_days(created_at) / settings.RANKING_HALF_LIFE_DAYS, MAX_WEIGHT_EXPONENT)
+
+
+def weight_limit_reached_at():
+    """When the weights stop growing (``MAX_WEIGHT_EXPONENT``) with the current half-life."""
+    return DECAY_EPOCH + timedelta(days=MAX_WEIGHT_EXPONENT * settings.RANKING_HALF_LIFE_DAYS)
+
+
+def bayesian_score(weighted_sum, weight):
+    """Score of ratings adding up to ``weighted_sum`` with a total weight of ``weight``.
+
+    Also takes NumPy arrays of sums and weights.
+    """
+    prior_weight = settings.RANKING_PRIOR_WEIGHT
+    return (prior_weight * settings.RANKING_PRIOR_MEAN + weighted_sum) / (prior_weight + weight)
+
+
+def rank_score(decayed_count, decayed_sum, now=None):
+    """Score as of ``now`` of a profile with these stored aggregates (also NumPy arrays)."""
+    # a rating made now weighs 1: dividing by its stored weight turns the others into 0.5 ** (age / half-life)
+    scale = rating_weight(now or timezone.now())
+    return bayesian_score(decayed_sum / scale, decayed_count / scale)
+
+
+def decayed_aggregates(groups, ratings, days, size):
+    """``(decayed counts, decayed sums)`` of ``size`` profiles from their ratings, given as parallel sequences.
+
+    ``groups`` holds the index (``0`` to ``size - 1``) of each rating's
+    profile, ``days`` its ``created_at`` in days since ``DECAY_EPOCH``.
+    """
+    half_life = settings.RANKING_HALF_LIFE_DAYS
+    if np is not None:
+        groups = np.asarray(groups, dtype=np.intp)
+        weights = np.exp2(np.minimum(np.asarray(days, dtype=float) / half_life, MAX_WEIGHT_EXPONENT))
+        counts = np.bincount(groups, weights=weights, minlength=size)
+        sums = np.bincount(groups, weights=weights * np.asarray(ratings, dtype=float), minlength=size)
+        return counts, sums
+    counts, sums = [0.0] * size, [0.0] * size
+    for group, rating, day in zip(groups, ratings, days):
+        weight = 2.0 ** min(day / half_life, MAX_WEIGHT_EXPONENT)
+        counts[group] += weight
+        sums[group] += weight * rating
+    return counts, sums
+
+
+def aggregate_profiles(profile_ids=None, now=None):
+    """``{profile id: (decayed count, decayed sum, score)}`` from the Rating table, for ``profile_ids`` or all."""
+    ratings = Rating.objects.order_by()
+    if profile_ids is None:
+        profile_ids = UserProfile.objects.order_by().values_list('pk', flat=True)
+    else:
+        ratings = ratings.filter(profile_id__in=list(profile_ids))
+    index = {pk: i for i, pk in enumerate(profile_ids)}
+    groups, values, days = array('q'), array('b'), array('d')
+    for profile_id, rating, created_at in ratings.values_list('profile_id', 'rating', 'created_at').iterator(10000):
+        group = index.get(profile_id)
+        if group is not None:
+            groups.append(group)
+            values.append(rating)
+            days.append(_epoch_days(created_at))
+    counts, sums = decayed_aggregates(groups, values, days, len(index))
+    if np is not None:
+        scores = rank_score(counts, sums, now)
+        counts, sums, scores = counts.tolist(), sums.tolist(), scores.tolist()
+    else:
+        scores = [rank_score(count, total, now) for count, total in zip(counts, sums)]
+    return dict(zip(index, zip(counts, sums, scores)))
+
+
+def _store_aggregates(aggregates):
+    qn = connection.ops.quote_name
+    columns = ', '.join(
+        f'{qn(UserProfile._meta.get_field(name).column)} = %s'
+        for name in ('decayed_count', 'decayed_sum', 'rank_score')
+    )
+    rows = [(*values, profile_id) for profile_id, values in aggregates.items()]
+    with connection.cursor() as cursor:
+        # one prepared UPDATE per row: bulk_update's CASE expressions grow with the batch
+        for start in range(0, len(rows), BATCH_SIZE):
+            cursor.executemany(
+                f'UPDATE {qn(UserProfile._meta.db_table)} SET {columns} WHERE {qn(UserProfile._meta.pk.column)} = %s',
+                rows[start:start + BATCH_SIZE],
+            )
+
+
+def rebuild_top(service_types=None):
+    """Rewrite the ProviderRank rows of the given categories (all when None) from the stored scores."""
+    profiles = UserProfile.objects.alias(category=Lower('service_type'))
+    if service_types is None:
+        categories = set(UserProfile.objects.order_by().values_list(Lower('service_type'), flat=True).distinct())
+    else:
+        categories = {_category(service_type) for service_type in service_types if service_type}
+        if not categories:
+            return 0
+    # joins the caller's transaction without a savepoint
+    with transaction.atomic(savepoint=False):
+        rows = []
+        for category in categories:
+            best = (profiles.filter(category=category).order_by('-rank_score', 'company_name', 'pk')
+                    .values_list('pk', 'rank_score')[:settings.RANKING_TOP_N])
+            rows.extend(
+                ProviderRank(service_type=category, position=position, profile_id=pk, score=score)
+                for position, (pk, score) in enumerate(best, 1)
+            )
+        stale = ProviderRank.objects.all()
+        if service_types is not None:
+            stale = stale.filter(service_type__in=categories)
+        stale.delete()
+        ProviderRank.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _refresh_top(scores):
+    """Rewrite the ProviderRank rows of the categories that ``{profile id: (service_type, score)}`` enter or are in."""
+    top = defaultdict(dict)
+    ranks = ProviderRank.objects.filter(service_type__in={_category(s) for s, _ in scores.values()})
+    for category, pk, score in ranks.values_list('service_type', 'profile_id', 'score'):
+        top[category][pk] = score
+    stale = set()
+    for pk, (service_type, score) in scores.items():
+        ranked = top[_category(service_type)]
+        if pk in ranked or len(ranked) < settings.RANKING_TOP_N or score >= min(ranked.values()):
+            stale.add(service_type)
+    rebuild_top(stale)
+
+
+def store_profile(profile_id, service_type, decayed_count, decayed_sum):
+    """Store a profile's new aggregates and score and update its category's ProviderRank rows.
+
+    For a caller holding the profile's row lock, which read the old
+    aggregates in the same transaction (``demo.ratings.upsert_rating``).
+    """
+    score = rank_score(decayed_count, decayed_sum)
+    with transaction.atomic(savepoint=False):
+        UserProfile.objects.filter(pk=profile_id).update(
+            decayed_count=decayed_count, decayed_sum=decayed_sum, rank_score=score,
+        )
+        _refresh_top({profile_id: (service_type, score)})
+
+
+def shift_profiles(deltas):
+    """Add ``{profile id: (count delta, sum delta)}`` to the stored aggregates and rescore those profiles.
+
+    The deltas are weighted like ``rating_weight``; each profile is one F()
+    UPDATE, so concurrent ratings are not lost.
+    """
+    deltas = {pk: delta for pk, delta in deltas.items() if pk is not None}
+    if not deltas:
+        return
+    scale = rating_weight(timezone.now())
+    prior_weight = settings.RANKING_PRIOR_WEIGHT
+    with transaction.atomic(savepoint=False):
+        for pk, (delta_count, delta_sum) in deltas.items():
+            count, total = F('decayed_count') + delta_count, F('decayed_sum') + delta_sum
+            UserProfile.objects.filter(pk=pk).update(
+                decayed_count=count, decayed_sum=total,
+                # rank_score() in SQL
+                rank_score=(Value(prior_weight * settings.RANKING_PRIOR_MEAN) + total / scale)
+                / (Value(float(prior_weight)) + count / scale),
+            )
+        profiles = UserProfile.objects.filter(pk__in=deltas).values_list('pk', 'service_type', 'rank_score')
+        _refresh_top({pk: (service_type, score) for pk, service_type, score in profiles})
+
+
+def rescore_profiles(profile_ids):
+    """Recompute the aggregates and scores of ``profile_ids`` from the Rating table."""
+    aggregates = aggregate_profiles(profile_ids)
+    with transaction.atomic(savepoint=False):
+        _store_aggregates(aggregates)
+        service_types = UserProfile.objects.filter(pk__in=list(aggregates)).values_list('pk', 'service_type')
+        _refresh_top({pk: (service_type, aggregates[pk][2]) for pk, service_type in service_types})
+
+
+def rebuild_rankings(now=None):
+    """Recompute every profile from the Rating table and rewrite all ProviderRank rows; returns the profile count."""
+    aggregates = aggregate_profiles(now=now)
+    with transaction.atomic():
+        _store_aggregates(aggregates)
+        rebuild_top()
+    # the feeds are ordered by the scores
+    feed_cache.invalidate_categories([label for label, _ in SERVICE_TYPE_CHOICES])
+    return len(aggregates)
+
+
+def top_providers(limit=None):
+    """``[(service label, [ProviderRank, ...]), ...]`` of the ranked categories, profiles and owners loaded."""
+    ranks = ProviderRank.objects.select_related('profile__user').order_by('service_type', 'position')
+    if limit is not None:
+        ranks = ranks.filter(position__lte=limit)
+    by_category = defaultdict(list)
+    for rank in ranks:
+        by_category[rank.service_type].append(rank)
+    return [(label, by_category[_category(label)]) for label, _ in SERVICE_TYPE_CHOICES if by_category[_category(label)]]
@@ -0,0 +1,51 @@
+"""Token-bucket rate limiting backed by a Django cache.
+
+A bucket holds up to ``capacity`` tokens and refills at ``rate`` tokens per
+second; every attempt takes one token and is rejected when none is left. So
+short bursts up to ``capacity`` pass, sustained traffic is held to ``rate``.
+
+The state of each bucket is one cache entry in ``settings.RATELIMIT_CACHE_ALIAS``:
+with the default ``LocMemCache`` every process limits on its own (a limit of
+N per process), with a shared backend such as Redis or Memcached the limit
+holds across processes. The read-modify-write is not atomic, so concurrent
+attempts may occasionally both get the last token; that is acceptable for
+keeping floods away from the database.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class TokenBucket:
+
+    def __init__(self, name, capacity, rate):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+
+    def _cache_key(self, key):
+        # the key may be user input (an account name): hash it into a valid cache key
+        digest = hashlib.sha256(str(key).encode()).hexdigest()[:32]
+        return f'ratelimit:{self.name}:{digest}'
+
+    def consume(self, key, tokens=1):
+        """Take ``tokens`` from the bucket of ``key``; False if there are not enough."""
+        cache = caches[settings.RATELIMIT_CACHE_ALIAS]
+        cache_key = self._cache_key(key)
+        now = time.time()
+        available, updated = cache.get(cache_key, (self.capacity, now))
+        available = min(self.capacity, available + (now - updated) * self.rate)
+        allowed = available >= tokens
+        if allowed:
+            available -= tokens
+        # a bucket that would be full again carries no information: let it expire
+        cache.set(cache_key, (available, now), timeout=max(1, int((self.capacity - available) / self.rate) + 1))
+        return allowed
+
+
+def login_buckets():
+    """The ``(per-IP, per-account)`` buckets configured by ``settings.LOGIN_RATE_LIMITS``."""
+    limits = settings.LOGIN_RATE_LIMITS
+    return TokenBucket('login-ip', *limits['ip']), TokenBucket('login-account', *limits['account'])
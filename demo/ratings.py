@@ -0,0 +1,216 @@
+"""Maintenance of the denormalized rating aggregates stored on UserProfile.
+
+``rating_sum``, ``rating_count`` and ``avg_rating`` are adjusted incrementally by
+the Rating signals in ``demo.signals``; the helpers here apply those deltas and
+rebuild/verify the columns from the Rating table.
+
+``upsert_rating`` is the write path of the views: it stores a rating and
+adjusts the aggregates in two statements, without the signals. Both paths
+then shift the profile's decayed sums and score of the feed ranking
+(``demo.ranking``).
+"""
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Abs, Cast, Coalesce, NullIf
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .facets import move_rating_buckets
+from .feed_cache import invalidate_categories
+from .models import Rating, UserProfile
+from .ranking import rating_weight, store_profile
+
+
+def _average(sum_expr, count_expr):
+    return Coalesce(Cast(sum_expr, FloatField()) / NullIf(count_expr, 0), Value(0.0))
+
+
+def apply_rating_delta(profile_id, delta_sum, delta_count=0):
+    """Atomically shift the stored aggregates of one profile.
+
+    Returns ``(service_type, old_avg, new_avg)`` so callers can update data
+    derived from the average, or None if the profile does not exist.
+    """
+    with transaction.atomic():
+        row = (UserProfile.objects.select_for_update().filter(pk=profile_id)
+               .values_list('service_type', 'rating_sum', 'rating_count', 'avg_rating').first())
+        if row is None:
+            return None
+        service_type, rating_sum, rating_count, old_avg = row
+        if not delta_sum and not delta_count:
+            return service_type, old_avg, old_avg
+        new_sum = F('rating_sum') + delta_sum
+        new_count = F('rating_count') + delta_count
+        UserProfile.objects.filter(pk=profile_id).update(
+            rating_sum=new_sum,
+            rating_count=new_count,
+            avg_rating=_average(new_sum, new_count),
+            updated_at=timezone.now(),
+        )
+    count = rating_count + delta_count
+    return service_type, old_avg, (rating_sum + delta_sum) / count if count else 0.0
+
+
+def rating_averages_changed(changes):
+    """Move profiles between rating facet buckets and invalidate their cached feeds.
+
+    ``changes`` are ``(service_type, old_avg, new_avg)`` tuples as returned by
+    ``apply_rating_delta``; None entries are skipped.
+    """
+    changes = [change for change in changes if change is not None]
+    for service_type, old_avg, new_avg in changes:
+        move_rating_buckets(service_type, old_avg, new_avg)
+    invalidate_categories({service_type for service_type, _, _ in changes})
+
+
+def _upsert_statements():
+    """The aggregate UPDATE and the rating INSERT ... ON CONFLICT of ``upsert_rating``."""
+    qn = connection.ops.quote_name
+
+    def column(model, name):
+        return qn(model._meta.get_field(name).column)
+
+    profiles, ratings = qn(UserProfile._meta.db_table), qn(Rating._meta.db_table)
+    rating_sum, rating_count = column(UserProfile, 'rating_sum'), column(UserProfile, 'rating_count')
+    avg_rating = column(UserProfile, 'avg_rating')
+    profile_id, user_id, rating = column(Rating, 'profile'), column(Rating, 'user'), column(Rating, 'rating')
+    comment, updated_at = column(Rating, 'comment'), column(Rating, 'updated_at')
+    created_at = column(Rating, 'created_at')
+
+    # the user's current rating of the profile, read through the (profile, user) unique index
+    where = f'FROM {ratings} WHERE {profile_id} = %(profile_id)s AND {user_id} = %(user_id)s'
+    old = f'SELECT {rating} {where}'
+    new_sum = f'{rating_sum} + %(rating)s - COALESCE(({old}), 0)'
+    new_count = f'{rating_count} + CASE WHEN EXISTS ({old}) THEN 0 ELSE 1 END'
+    # runs before the INSERT, so the RETURNING subquery still sees the old rating
+    update = (
+        f'UPDATE {profiles} SET {rating_sum} = {new_sum}, {rating_count} = {new_count}, '
+        f'{avg_rating} = CAST({new_sum} AS {connection.data_types["FloatField"]}) / ({new_count}), '
+        f'{column(UserProfile, "updated_at")} = %(now)s '
+        f'WHERE {column(UserProfile, "id")} = %(profile_id)s '
+        f'RETURNING {column(UserProfile, "service_type")}, {rating_sum}, {rating_count}, ({old}), '
+        f'(SELECT {created_at} {where}), {column(UserProfile, "decayed_count")}, {column(UserProfile, "decayed_sum")}'
+    )
+    insert = (
+        f'INSERT INTO {ratings} ({profile_id}, {user_id}, {rating}, {comment}, '
+        f'{created_at}, {updated_at}) '
+        f'VALUES (%(profile_id)s, %(user_id)s, %(rating)s, %(comment)s, %(now)s, %(now)s) '
+        f'ON CONFLICT ({profile_id}, {user_id}) DO UPDATE SET {rating} = excluded.{rating}, '
+        f'{comment} = excluded.{comment}, {updated_at} = excluded.{updated_at}'
+    )
+    return update, insert
+
+
+def _datetime(value):
+    # SQLite returns the RETURNING subquery's datetime as text, in UTC
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def supports_upsert():
+    """INSERT ... ON CONFLICT and UPDATE ... RETURNING: PostgreSQL and SQLite 3.35+."""
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+def upsert_rating(profile, user, rating, comment=None):
+    """Create or update ``user``'s rating of ``profile``; returns True if it was created.
+
+    ``profile`` and ``user`` are the instances the caller already loaded; the
+    rating is validated against them in memory (``Rating.check_values``, which
+    raises ValidationError). One UPDATE shifts the profile's aggregates by the
+    difference to the user's previous rating, one INSERT ... ON CONFLICT DO
+    UPDATE writes the rating: two statements in a short transaction, which
+    holds the write lock from its first statement. Concurrent ratings of the
+    same profile queue on its row instead of failing on a lock upgrade.
+
+    Backends without these statements fall back to ``update_or_create`` and
+    the Rating signals.
+    """
+    Rating.check_values(profile, user.pk, rating)
+    if not supports_upsert():
+        _, created = Rating.objects.update_or_create(
+            profile=profile, user=user, defaults={'rating': rating, 'comment': comment},
+        )
+        return created
+
+    update, insert = _upsert_statements()
+    now = timezone.now()
+    params = {
+        'profile_id': profile.pk, 'user_id': user.pk, 'rating': rating, 'comment': comment,
+        'now': connection.ops.adapt_datetimefield_value(now),
+    }
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(update, params)
+        row = cursor.fetchone()
+        if row is None:
+            raise UserProfile.DoesNotExist('Profile %s does not exist' % profile.pk)
+        cursor.execute(insert, params)
+        service_type, new_sum, new_count, old_rating, created_at, decayed_count, decayed_sum = row
+        old_sum = new_sum - rating + (old_rating or 0)
+        old_count = new_count - (old_rating is None)
+        rating_averages_changed([(
+            service_type, old_sum / old_count if old_count else 0.0, new_sum / new_count,
+        )])
+        # the row is locked since the UPDATE: the decayed sums it returned are current
+        if old_rating is None:
+            weight = rating_weight(now)
+            decayed_count, decayed_sum = decayed_count + weight, decayed_sum + weight * rating
+        else:
+            decayed_sum += rating_weight(_datetime(created_at)) * (rating - old_rating)
+        store_profile(profile.pk, service_type, decayed_count, decayed_sum)
+    return old_rating is None
+
+
+def _actual_aggregates():
+    """Correlated subqueries computing the true sum/count for each profile."""
+    ratings = Rating.objects.filter(profile=OuterRef('pk')).order_by().values('profile')
+    actual_sum = Coalesce(Subquery(ratings.annotate(s=Sum('rating')).values('s')), 0)
+    actual_count = Coalesce(Subquery(ratings.annotate(c=Count('id')).values('c')), 0)
+    return actual_sum, actual_count
+
+
+def rebuild_rating_aggregates(profile_ids=None):
+    """Recompute the aggregates from the Rating table; returns the number of profiles updated."""
+    qs = UserProfile.objects.all()
+    if profile_ids is not None:
+        qs = qs.filter(pk__in=profile_ids)
+    actual_sum, actual_count = _actual_aggregates()
+    return qs.update(
+        rating_sum=actual_sum,
+        rating_count=actual_count,
+        avg_rating=_average(actual_sum, actual_count),
+        updated_at=timezone.now(),
+    )
+
+
+def find_rating_aggregate_drift():
+    """Return profiles whose stored aggregates disagree with the Rating table.
+
+    Each entry is a dict with the stored and the actual sum/count/average.
+    """
+    actual_sum, actual_count = _actual_aggregates()
+    qs = UserProfile.objects.annotate(
+        actual_sum=actual_sum,
+        actual_count=actual_count,
+    ).annotate(
+        actual_avg=_average(F('actual_sum'), F('actual_count')),
+    ).annotate(
+        avg_error=Abs(F('avg_rating') - F('actual_avg')),
+    )
+    drifted = qs.exclude(
+        rating_sum=F('actual_sum'),
+        rating_count=F('actual_count'),
+        avg_error__lte=1e-9,
+    )
+    return list(drifted.values(
+        'pk', 'company_name',
+        'rating_sum', 'actual_sum',
+        'rating_count', 'actual_count',
+        'avg_rating', 'actual_avg',
+    ).order_by('pk'))
@@ -0,0 +1,175 @@
+"""Full-text search over service provider profiles.
+
+The feed's ``q`` parameter is matched against a search index of
+``company_name``, ``company_description`` and the owner's city instead of
+three ``LIKE '%q%'`` scans. The index lives in the ``demo_profile_search``
+side table (created by migration 0006) whose key is the profile id, and is
+kept in sync by the UserProfile/User signals in ``demo.signals``.
+
+Backends:
+  - ``SQLiteFTSBackend``: an FTS5 virtual table, ranked with bm25.
+  - ``PostgresSearchBackend``: a ``tsvector`` column with a GIN index, ranked with ts_rank.
+  - ``LikeSearchBackend``: the original ``icontains`` filter, for other databases.
+
+``settings.SEARCH_BACKEND`` may name a backend class by dotted path; by
+default one is picked from the database vendor.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Lookup, Q, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import ProfileSearchEntry
+
+SEARCH_TABLE = 'demo_profile_search'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_terms(query):
+    """Split free text into word tokens; punctuation never reaches the index syntax."""
+    return _TOKEN_RE.findall(query.lower())
+
+
+class LikeSearchBackend:
+    """Substring matching with ``icontains``; needs no index and returns unranked results."""
+    ranked = False
+
+    def filter(self, queryset, query):
+        return queryset.filter(
+            Q(company_name__icontains=query)
+            | Q(company_description__icontains=query)
+            | Q(user__city__icontains=query)
+        )
+
+    def update(self, profile_ids):
+        pass
+
+    def remove(self, profile_ids):
+        pass
+
+    def rebuild(self):
+        return 0
+
+
+class _IndexedSearchBackend(LikeSearchBackend):
+    """Common bookkeeping for backends that keep a row per profile in SEARCH_TABLE.
+
+    Results are annotated with ``search_rank``, where lower means more relevant.
+    """
+    ranked = True
+    key_column = None
+    insert_sql = None
+
+    def filter(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            # nothing indexable (e.g. only punctuation) can match a word index
+            return queryset.none().annotate(search_rank=Value(0.0))
+        return self.match(queryset, terms)
+
+    def match(self, queryset, terms):
+        raise NotImplementedError
+
+    def _in_clause(self, profile_ids):
+        profile_ids = [int(pk) for pk in profile_ids]
+        return ', '.join(['%s'] * len(profile_ids)), profile_ids
+
+    def remove(self, profile_ids):
+        if not profile_ids:
+            return
+        placeholders, params = self._in_clause(profile_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE {self.key_column} IN ({placeholders})', params)
+
+    def update(self, profile_ids):
+        if not profile_ids:
+            return
+        self.remove(profile_ids)
+        placeholders, params = self._in_clause(profile_ids)
+        with connection.cursor() as cursor:
+            cursor.execute(f'{self.insert_sql} WHERE p.id IN ({placeholders})', params)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+            cursor.execute(self.insert_sql)
+            return cursor.rowcount
+
+
+@ProfileSearchEntry._meta.get_field('document').register_lookup
+class FTS5Match(Lookup):
+    """``document__match``: an FTS5 ``MATCH`` against the whole search table."""
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+class SQLiteFTSBackend(_IndexedSearchBackend):
+    """SQLite FTS5 table; every term is matched as a word prefix so partial input still hits.
+
+    The index is joined through ProfileSearchEntry so SQLite drives the query
+    from the MATCH and computes each row's bm25 ``rank`` once.
+    """
+    key_column = 'rowid'
+    insert_sql = (
+        f'INSERT INTO {SEARCH_TABLE} (rowid, company_name, company_description, city) '
+        'SELECT p.id, p.company_name, p.company_description, u.city '
+        'FROM demo_userprofile p INNER JOIN demo_user u ON u.id = p.user_id'
+    )
+
+    def match(self, queryset, terms):
+        expression = ' '.join('"%s"*' % term for term in terms)
+        # FTS5's rank is more negative for more relevant rows
+        return queryset.filter(search_entry__document__match=expression).annotate(
+            search_rank=F('search_entry__rank'),
+        )
+
+
+class PostgresSearchBackend(_IndexedSearchBackend):
+    """PostgreSQL ``tsvector`` table with a GIN index; terms are prefix-matched with ``:*``."""
+    key_column = 'profile_id'
+    insert_sql = (
+        f'INSERT INTO {SEARCH_TABLE} (profile_id, document) '
+        "SELECT p.id, to_tsvector('simple', coalesce(p.company_name, '') || ' ' "
+        "|| coalesce(p.company_description, '') || ' ' || coalesce(u.city, '')) "
+        'FROM demo_userprofile p INNER JOIN demo_user u ON u.id = p.user_id'
+    )
+
+    def match(self, queryset, terms):
+        expression = ' & '.join('%s:*' % term for term in terms)
+        table = queryset.model._meta.db_table
+        # the GIN index finds the hits; ts_rank is then read per hit by primary key
+        return queryset.filter(
+            pk__in=RawSQL(
+                f"SELECT profile_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', %s)",
+                [expression],
+            ),
+        ).annotate(
+            # negated so that, as with FTS5, ascending order is most relevant first
+            search_rank=RawSQL(
+                f"SELECT -ts_rank(document, to_tsquery('simple', %s)) FROM {SEARCH_TABLE} "
+                f'WHERE profile_id = "{table}"."id"',
+                [expression],
+            ),
+        )
+
+
+_VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTSBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    """Return the configured search backend (``settings.SEARCH_BACKEND``) or the vendor default."""
+    path = getattr(settings, 'SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return _VENDOR_BACKENDS.get(connection.vendor, LikeSearchBackend)()
@@ -0,0 +1,164 @@
+"""Session backend for read-heavy traffic.
+
+Almost every page reads the four login flags (``demo.context_processors.user_flags``)
+and hardly anything else, so:
+
+  - the flags are mirrored into a signed cookie, bound to the session key, from
+    which ``SessionStore.display_flags()`` answers without touching the cache
+    or the database (``SessionMiddleware`` reads and refreshes that cookie);
+  - everything else goes through ``cached_db``: reads are served from the
+    ``SESSION_CACHE_ALIAS`` cache, writes go to the database and the cache;
+  - assigning a value a key already has does not mark the session modified,
+    so views that re-set the same flags on every visit cause no UPDATE.
+
+The cookie is only good for display. It stays valid for ``SESSION_COOKIE_AGE``
+even if its session is deleted out of band (an admin logging users out, the
+row expiring), so ``session[key]``, ``get()`` and ``aget()`` always load the
+session, and access decisions must go through them. Loading the session
+replaces a stale cookie; flushing or deleting the session removes it, and a
+missing, expired or foreign cookie only means loading the session.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.middleware import SessionMiddleware as BaseSessionMiddleware
+from django.core import signing
+
+FLAG_KEYS = frozenset({'logged_in_username', 'logged_in_user_id', 'is_service_provider', 'is_user'})
+FLAGS_COOKIE_NAME = 'session_flags'
+FLAGS_COOKIE_SALT = 'demo.session-flags'
+
+_missing = object()
+
+
+class SessionStore(CachedDBStore):
+
+    def __init__(self, session_key=None, flags=None):
+        super().__init__(session_key)
+        # the flags from a verified cookie, then those of the loaded session; None until known
+        self._flags = flags
+        self.flags_changed = False
+
+    def display_flags(self):
+        """The login flags for rendering (greetings, menus), from the cookie if there is one.
+
+        Not for access decisions: the cookie can outlive its session.
+        """
+        if self._flags is None:
+            return self._load_flags(self._session)
+        # the page depends on the cookie like on any session read (Vary: Cookie)
+        self.accessed = True
+        return self._flags
+
+    def _load_flags(self, data):
+        flags = {key: data[key] for key in FLAG_KEYS if key in data}
+        if flags != self._flags:
+            # issue (or replace, or clear) the cookie so it matches the session
+            self._flags = flags
+            self.flags_changed = True
+        return flags
+
+    def load(self):
+        data = super().load()
+        self._load_flags(data)
+        return data
+
+    async def aload(self):
+        data = await super().aload()
+        self._load_flags(data)
+        return data
+
+    def __setitem__(self, key, value):
+        if self._session.get(key, _missing) == value:
+            # unchanged: nothing to save
+            return
+        super().__setitem__(key, value)
+
+    async def aset(self, key, value):
+        if (await self._aget_session()).get(key, _missing) == value:
+            return
+        await super().aset(key, value)
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        if session_key is None or session_key == self.session_key:
+            # neither the cookie nor later reads may keep the flags of a deleted session
+            # (flush() deletes too)
+            self._forget()
+
+    async def adelete(self, session_key=None):
+        await super().adelete(session_key)
+        if session_key is None or session_key == self.session_key:
+            self._forget()
+
+    def _forget(self):
+        self._session_cache = {}
+        self._flags = {}
+        self.flags_changed = True
+
+    def cycle_key(self):
+        super().cycle_key()
+        # the cookie is bound to the old key
+        self.flags_changed = True
+
+    def sync_flags(self):
+        """Mirror the flags of a modified session into the cookie (any write path, e.g. ``update()``)."""
+        if not self.modified or not hasattr(self, '_session_cache'):
+            return
+        flags = {key: self._session_cache[key] for key in FLAG_KEYS if key in self._session_cache}
+        if flags != self._flags:
+            self._flags = flags
+            self.flags_changed = True
+
+
+def load_flags(cookie, session_key):
+    """The flags in a signed ``cookie`` if it is valid and was issued for ``session_key``."""
+    if not cookie or not session_key:
+        return None
+    try:
+        payload = signing.loads(cookie, salt=FLAGS_COOKIE_SALT, max_age=settings.SESSION_COOKIE_AGE)
+    except signing.BadSignature:
+        return None
+    if payload.get('key') != session_key:
+        return None
+    return payload.get('flags', {})
+
+
+class SessionMiddleware(BaseSessionMiddleware):
+    """SessionMiddleware that also reads and writes the flags cookie of ``demo.sessions.SessionStore``."""
+
+    def process_request(self, request):
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if issubclass(self.SessionStore, SessionStore):
+            flags = load_flags(request.COOKIES.get(FLAGS_COOKIE_NAME), session_key)
+            request.session = self.SessionStore(session_key, flags=flags)
+        else:
+            request.session = self.SessionStore(session_key)
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        if not isinstance(session, SessionStore):
+            return super().process_response(request, response)
+        session.sync_flags()
+        response = super().process_response(request, response)
+        if not session.flags_changed:
+            return response
+        if session.session_key and session._flags:
+            value = signing.dumps({'key': session.session_key, 'flags': session._flags}, salt=FLAGS_COOKIE_SALT)
+            response.set_cookie(
+                FLAGS_COOKIE_NAME, value,
+                max_age=settings.SESSION_COOKIE_AGE,
+                expires=None if session.get_expire_at_browser_close() else time.time() + settings.SESSION_COOKIE_AGE,
+                domain=settings.SESSION_COOKIE_DOMAIN,
+                path=settings.SESSION_COOKIE_PATH,
+                secure=settings.SESSION_COOKIE_SECURE or None,
+                httponly=settings.SESSION_COOKIE_HTTPONLY or None,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        elif FLAGS_COOKIE_NAME in request.COOKIES:
+            response.delete_cookie(
+                FLAGS_COOKIE_NAME, path=settings.SESSION_COOKIE_PATH,
+                domain=settings.SESSION_COOKIE_DOMAIN, samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        return response
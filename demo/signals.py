@@ -0,0 +1,180 @@
+"""Signal handlers keeping denormalized data in sync with the source tables."""
+from collections import Counter
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .facets import rebuild_facets
+from .feed_cache import invalidate_categories
+from .images import Derivatives
+from .models import IMAGE_FIELDS, Product, ProfileImage, Rating, User, UserProfile
+from .ranking import rating_weight, rebuild_top, rescore_profiles, shift_profiles
+from .ratings import apply_rating_delta, rating_averages_changed, rebuild_rating_aggregates
+from .search import get_search_backend
+from .storage import adjust_blob_references
+from .tasks import queue_image_processing
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, raw=False, **kwargs):
+    """Apply the change of a created/updated Rating to its profile's aggregates."""
+    if raw:
+        # fixture loading: rebuild_rating_aggregates fixes the columns afterwards
+        return
+    loaded = getattr(instance, '_loaded_rating', None)
+    # decayed count and sum deltas of the ranking (demo.ranking)
+    weight = rating_weight(instance.created_at)
+    if created:
+        changes = [apply_rating_delta(instance.profile_id, instance.rating, 1)]
+        deltas = {instance.profile_id: (weight, weight * instance.rating)}
+    elif loaded is None:
+        # saved from an instance that was not loaded from the database
+        rebuild_rating_aggregates([instance.profile_id])
+        service_type = UserProfile.objects.filter(pk=instance.profile_id).values_list('service_type', flat=True).first()
+        rebuild_facets([service_type])
+        rescore_profiles([instance.profile_id])
+        changes, deltas = [], {}
+    else:
+        old_profile_id, old_rating = loaded
+        if old_profile_id == instance.profile_id:
+            changes = [apply_rating_delta(instance.profile_id, instance.rating - old_rating)]
+            deltas = {instance.profile_id: (0, weight * (instance.rating - old_rating))}
+        else:
+            changes = [
+                apply_rating_delta(old_profile_id, -old_rating, -1),
+                apply_rating_delta(instance.profile_id, instance.rating, 1),
+            ]
+            deltas = {
+                old_profile_id: (-weight, -weight * old_rating),
+                instance.profile_id: (weight, weight * instance.rating),
+            }
+    instance._loaded_rating = (instance.profile_id, instance.rating)
+    rating_averages_changed(changes)
+    shift_profiles(deltas)
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    """Remove a deleted Rating from its profile's aggregates."""
+    profile_id, rating = getattr(instance, '_loaded_rating', (instance.profile_id, instance.rating))
+    rating_averages_changed([apply_rating_delta(profile_id, -rating, -1)])
+    weight = rating_weight(instance.created_at)
+    shift_profiles({profile_id: (-weight, -weight * rating)})
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_saved(sender, instance, created, raw=False, **kwargs):
+    """Re-index a created/edited profile for feed search and refresh its feed."""
+    if raw:
+        return
+    get_search_backend().update([instance.pk])
+    categories = {instance.service_type, getattr(instance, '_loaded_service_type', None)}
+    if created or instance.service_type != getattr(instance, '_loaded_service_type', None):
+        # rebuild_facets also invalidates the cached feeds
+        rebuild_facets(categories)
+        # a new profile starts at the prior score, a moved one leaves its old category's ranking
+        rebuild_top(categories)
+    else:
+        invalidate_categories(categories)
+    instance._loaded_service_type = instance.service_type
+
+
+@receiver(post_delete, sender=UserProfile)
+def profile_deleted(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+    categories = {instance.service_type, getattr(instance, '_loaded_service_type', None)}
+    rebuild_facets(categories)
+    rebuild_top(categories)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    """The owner's city and email appear in search and feeds, so refresh their profiles."""
+    if raw or created:
+        return
+    profiles = list(UserProfile.objects.filter(user=instance).values_list('pk', 'service_type'))
+    if profiles:
+        UserProfile.touch(user=instance)
+    get_search_backend().update([pk for pk, _ in profiles])
+    categories = {service_type for _, service_type in profiles}
+    if instance.city != getattr(instance, '_loaded_city', None):
+        rebuild_facets(categories)
+    else:
+        invalidate_categories(categories)
+    instance._loaded_city = instance.city
+
+
+def _queue_derivatives(instance, field):
+    """Queue the processing of a newly stored image (see demo.tasks).
+
+    Saves that keep the same file find its derivatives already in place.
+    """
+    fieldfile = getattr(instance, field)
+    if fieldfile and not Derivatives(fieldfile).exists():
+        queue_image_processing([instance], field)
+
+
+@receiver(post_save, sender=ProfileImage)
+def profile_image_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    UserProfile.touch(pk=instance.profile_id)
+    if not created or not instance.image:
+        return
+    if Derivatives(instance.image).exists():
+        # the same bytes were uploaded and processed before (demo.storage)
+        ProfileImage.objects.filter(pk=instance.pk).update(processing_status=ProfileImage.READY)
+    else:
+        queue_image_processing([instance], 'image')
+
+
+@receiver(post_delete, sender=ProfileImage)
+def profile_image_deleted(sender, instance, **kwargs):
+    UserProfile.touch(pk=instance.profile_id)
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_logo_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _queue_derivatives(instance, 'logo')
+
+
+@receiver(post_save, sender=Product)
+def product_banner_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _queue_derivatives(instance, 'banner')
+
+
+_IMAGE_FIELD_NAMES = {}
+for _model, _field in IMAGE_FIELDS:
+    _IMAGE_FIELD_NAMES.setdefault(_model, []).append(_field)
+
+
+def _stored_files(instance):
+    return {field: getattr(instance, field).name or None for field in _IMAGE_FIELD_NAMES[type(instance)]}
+
+
+def image_files_saved(sender, instance, raw=False, **kwargs):
+    """Count the references of newly stored image files and release the files they replaced."""
+    if raw:
+        # fixture loading: rebuild_media_blobs recounts afterwards
+        return
+    loaded = getattr(instance, '_loaded_files', {})
+    stored = _stored_files(instance)
+    changes = Counter()
+    for field, name in stored.items():
+        if name != loaded.get(field):
+            changes[name] += 1
+            changes[loaded.get(field)] -= 1
+    adjust_blob_references(changes)
+    instance._loaded_files = {**loaded, **stored}
+
+
+def image_files_deleted(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_files', None) or _stored_files(instance)
+    adjust_blob_references(Counter({name: -1 for name in loaded.values()}))
+
+
+for _model in _IMAGE_FIELD_NAMES:
+    post_save.connect(image_files_saved, sender=_model, dispatch_uid=f'image_files_saved_{_model.__name__}')
+    post_delete.connect(image_files_deleted, sender=_model, dispatch_uid=f'image_files_deleted_{_model.__name__}')
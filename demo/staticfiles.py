@@ -0,0 +1,174 @@
+"""Static files storage that fingerprints, compresses and slims assets at collectstatic time.
+
+On top of ``ManifestStaticFilesStorage`` (content-hashed names such as
+``css/app.3f2a9c.css`` plus ``staticfiles.json``, which ``{% static %}`` reads so
+templates get the hashed URLs without changes), ``post_process`` also:
+
+  - downsizes raster images wider than ``STATICFILES_MAX_IMAGE_WIDTH`` and
+    recompresses JPEGs/PNGs, keeping the result only if it is smaller;
+  - converts GIFs to animated WebP (and to MP4 when ``ffmpeg`` is on the PATH),
+    registered in the manifest as ``<name>.webp``/``<name>.mp4`` next to the
+    GIF so templates can offer them with ``{% static_variant %}``;
+  - writes ``.gz`` and, if the ``brotli`` package is installed, ``.br``
+    siblings of text assets for servers that serve precompressed files
+    (nginx ``gzip_static``/``brotli_static``).
+
+Only the hashed copies are optimized: their content hash is that of the
+source file, so it still changes whenever the source does. What was saved is
+recorded per asset in ``REPORT_NAME`` (see ``manage.py static_report``).
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from PIL import Image, ImageSequence
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip siblings are written
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.map', '.svg', '.json', '.txt', '.html', '.xml', '.ttf', '.eot'}
+RASTER_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+REPORT_NAME = 'staticfiles-report.json'
+# keep a recompressed image only if it saves at least this fraction
+MIN_SAVING = 0.05
+
+
+def _extension(name):
+    return os.path.splitext(name)[1].lower()
+
+
+def optimize_raster(content, max_width):
+    """Downsize/recompress JPEG or PNG bytes; returns the new bytes or None if not worth it."""
+    with Image.open(BytesIO(content)) as image:
+        image_format = image.format
+        if image.width > max_width:
+            size = (max_width, round(image.height * max_width / image.width))
+            image.draft('RGB', size)
+            resized = image.resize(size, Image.LANCZOS)
+        else:
+            resized = image.copy()
+        options = {'icc_profile': image.info.get('icc_profile')}
+    buffer = BytesIO()
+    if image_format == 'JPEG':
+        resized.convert('RGB').save(buffer, format='JPEG', quality=80, optimize=True, progressive=True, **options)
+    elif image_format == 'PNG':
+        resized.save(buffer, format='PNG', optimize=True, **options)
+    else:
+        return None
+    optimized = buffer.getvalue()
+    return optimized if len(optimized) <= len(content) * (1 - MIN_SAVING) else None
+
+
+def gif_to_webp(content):
+    """Animated WebP with the frames and timing of a GIF."""
+    with Image.open(BytesIO(content)) as image:
+        durations = [frame.info.get('duration', 100) for frame in ImageSequence.Iterator(image)]
+        image.seek(0)
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP', save_all=True, quality=75, method=4,
+                   loop=image.info.get('loop', 0), duration=durations)
+    return buffer.getvalue()
+
+
+def gif_to_mp4(path):
+    """H.264 MP4 of a GIF file using ffmpeg; None if ffmpeg is not installed or fails."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, 'out.mp4')
+        result = subprocess.run(
+            [ffmpeg, '-loglevel', 'error', '-i', path, '-movflags', 'faststart', '-pix_fmt', 'yuv420p',
+             # yuv420p needs even dimensions
+             '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-an', target],
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            return None
+        with open(target, 'rb') as output:
+            return output.read()
+
+
+def compress_text(content):
+    """``{'.gz': bytes, '.br': bytes}`` for the encodings that make ``content`` smaller."""
+    siblings = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        siblings['.br'] = brotli.compress(content, quality=11)
+    return {suffix: data for suffix, data in siblings.items() if len(data) < len(content)}
+
+
+class OptimizingManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def hashed_name(self, name, content=None, filename=None):
+        try:
+            return super().hashed_name(name, content, filename)
+        except ValueError:
+            if content is not None or _extension(name.strip()) != '.map':
+                raise
+            # a sourceMappingURL of a vendor file whose map is not shipped: browsers only
+            # ask for it with the developer tools open, so the reference is left alone
+            logger.warning('Source map %s is referenced but does not exist; leaving the reference', name.strip())
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        report = []
+        for name in sorted(paths):
+            hashed_name = self.hashed_files.get(self.hash_key(self.clean_name(name)))
+            if hashed_name:
+                entry = self._optimize(name, hashed_name)
+                if entry:
+                    report.append(entry)
+        # the GIF variants were added to hashed_files
+        self.save_manifest()
+        self._save(REPORT_NAME, ContentFile(json.dumps(report, indent=1).encode()))
+
+    def _replace(self, name, content):
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(content))
+
+    def _optimize(self, name, hashed_name):
+        extension = _extension(name)
+        if extension not in COMPRESSIBLE_EXTENSIONS | RASTER_EXTENSIONS | {'.gif'}:
+            return None
+        with self.open(hashed_name) as file:
+            content = file.read()
+        entry = {'name': name, 'hashed_name': hashed_name, 'original': len(content), 'optimized': len(content)}
+
+        if extension in RASTER_EXTENSIONS:
+            try:
+                optimized = optimize_raster(content, getattr(settings, 'STATICFILES_MAX_IMAGE_WIDTH', 1920))
+            except OSError:
+                optimized = None
+            if optimized is not None:
+                self._replace(hashed_name, optimized)
+                entry['optimized'] = len(optimized)
+        elif extension == '.gif':
+            stem = os.path.splitext(hashed_name)[0]
+            variants = {'.webp': gif_to_webp(content), '.mp4': gif_to_mp4(self.path(hashed_name))}
+            for suffix, data in variants.items():
+                # only offered when smaller than the GIF itself
+                if data is not None and len(data) < len(content):
+                    self._replace(stem + suffix, data)
+                    self.hashed_files[self.hash_key(os.path.splitext(name)[0] + suffix)] = stem + suffix
+                    entry[suffix.lstrip('.')] = len(data)
+        else:
+            for suffix, data in compress_text(content).items():
+                self._replace(hashed_name + suffix, data)
+                entry[suffix.lstrip('.')] = len(data)
+        return entry
@@ -0,0 +1,200 @@
+"""Content-addressed storage for uploaded media.
+
+Providers upload the same catalogue photos again with every edit, and
+``FileSystemStorage`` kept each copy under its client file name
+(``Img/banner/Screenshot_9_VjEwEIo.png``). ``ContentAddressedStorage``
+hashes an upload while copying it to disk and stores it under its SHA-256::
+
+    Img/banner/Screenshot_9.png -> blobs/3f/a2/3fa2...c9.png
+
+An upload whose content is already stored is discarded once hashed, and the
+field gets the existing name. Derivatives (``demo.images``) are named after
+their original, so a deduplicated upload finds them already generated.
+
+Each stored name has a ``MediaBlob`` row counting the ``IMAGE_FIELDS`` values
+that refer to it, kept up to date by ``demo.signals`` and rebuilt by
+``manage.py rebuild_media_blobs``. When a transaction that released
+references commits, the files whose count dropped to zero are deleted with
+their derivatives (``release_blobs``). A file stored or reused less than
+``MEDIA_ORPHAN_GRACE`` seconds ago is kept: the upload that wrote it may not
+have saved its row yet. ``manage.py gc_media`` removes those later, along with
+files nothing has a count for.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .images import derivative_names, is_derivative
+from .models import IMAGE_FIELDS, MediaBlob
+
+CONTENT_DIR = 'blobs'
+HASH_ALGORITHM = 'sha256'
+
+
+def content_name(digest, extension):
+    return f'{CONTENT_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def is_content_name(name):
+    return name.replace(os.sep, '/').startswith(f'{CONTENT_DIR}/')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """``FileSystemStorage`` that stores uploads once per content (see the module docstring).
+
+    Derivatives are stored under the name they are given. Names of files
+    stored before keep working for reading and deleting.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        if is_derivative(name):
+            return super().get_available_name(name, max_length)
+        # _save names the file after its content
+        return name
+
+    def _save(self, name, content):
+        if is_derivative(name):
+            return super()._save(name, content)
+        if getattr(content, 'content_name', None):
+            # stored while it was received (demo.uploads.ImageUploadHandler)
+            return content.content_name
+        temporary, digest = self.temporary_file(), hashlib.new(HASH_ALGORITHM)
+        # hash while copying: the upload is read once, whatever its size
+        with temporary:
+            try:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    temporary.write(chunk)
+            except BaseException:
+                temporary.close()
+                os.unlink(temporary.name)
+                raise
+        return self.store(temporary.name, digest.hexdigest(), os.path.splitext(name)[1].lower())
+
+    def temporary_file(self):
+        """A new file in the storage's file system to write an upload to, for ``store``."""
+        directory = self.path(CONTENT_DIR)
+        os.makedirs(directory, exist_ok=True)
+        # a dot file: serve_media never serves it
+        return tempfile.NamedTemporaryFile(dir=directory, prefix='.upload-', delete=False)
+
+    def store(self, temporary_path, digest, extension):
+        """Move the complete file ``temporary_path`` to its content name, or drop it
+        if that content is stored already; returns the name."""
+        stored = content_name(digest, extension)
+        path = self.path(stored)
+        try:
+            # a recent modification time keeps it from release_blobs and gc_media until the row is saved
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            os.unlink(temporary_path)
+            return stored
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # temporary files are private to the user; the front-end server may need to read it
+        os.chmod(temporary_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        # atomic: a concurrent upload of the same bytes replaces it with the same content
+        os.replace(temporary_path, path)
+        return stored
+
+
+def _size(name):
+    try:
+        return default_storage.size(name)
+    except OSError:
+        return 0
+
+
+def adjust_blob_references(changes):
+    """Apply ``{name: delta}`` to the ``MediaBlob`` reference counts.
+
+    Empty names (no file) and zero deltas are ignored. Names seen for the first
+    time get a row, with the size of the stored file.
+    """
+    changes = {name: delta for name, delta in Counter(changes).items() if name and delta}
+    if not changes:
+        return
+    by_delta = defaultdict(list)
+    for name, delta in changes.items():
+        by_delta[delta].append(name)
+    with transaction.atomic():
+        MediaBlob.objects.bulk_create(
+            [MediaBlob(name=name, size=_size(name)) for name, delta in changes.items() if delta > 0],
+            ignore_conflicts=True,
+        )
+        for delta, names in by_delta.items():
+            # names stored before the counts existed may be released without a row or below zero
+            MediaBlob.objects.filter(name__in=names).update(refcount=Greatest(F('refcount') + delta, 0))
+    released = [name for name, delta in changes.items() if delta < 0]
+    if released:
+        # a rollback brings the references back: only delete files once they are gone for good
+        transaction.on_commit(partial(release_blobs, released), robust=True)
+
+
+def _modified(name):
+    try:
+        return os.path.getmtime(default_storage.path(name))
+    except OSError:
+        return 0
+
+
+def delete_stored_file(name):
+    """Delete the stored file ``name`` and its derivatives (missing files are ignored)."""
+    for stored in [name, *derivative_names(name)]:
+        default_storage.delete(stored)
+
+
+def release_blobs(names):
+    """Delete the files of ``names`` no image field refers to any more; returns their names.
+
+    Files modified within ``MEDIA_ORPHAN_GRACE`` seconds are kept for
+    ``gc_media``: an upload may have reused them for a row not saved yet.
+    Names without a ``MediaBlob`` row are left alone.
+    """
+    cutoff = time.time() - settings.MEDIA_ORPHAN_GRACE
+    with transaction.atomic():
+        unreferenced = MediaBlob.objects.select_for_update().filter(name__in=names, refcount=0)
+        stale = [name for name in unreferenced.values_list('name', flat=True) if _modified(name) < cutoff]
+        MediaBlob.objects.filter(name__in=stale, refcount=0).delete()
+        # referenced again in the meantime
+        kept = set(MediaBlob.objects.filter(name__in=stale).values_list('name', flat=True))
+    stale = [name for name in stale if name not in kept]
+    for name in stale:
+        delete_stored_file(name)
+    return stale
+
+
+def referenced_names():
+    """``Counter`` of the stored names referred to by the ``IMAGE_FIELDS`` of all rows."""
+    counts = Counter()
+    for model, field in IMAGE_FIELDS:
+        counts.update(model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                      .values_list(field, flat=True).iterator())
+    return counts
+
+
+def rebuild_blob_references():
+    """Recount the references of every stored name from the rows; returns the number of names."""
+    counts = referenced_names()
+    by_count = defaultdict(list)
+    for name, count in counts.items():
+        by_count[count].append(name)
+    with transaction.atomic():
+        known = set(MediaBlob.objects.values_list('name', flat=True))
+        MediaBlob.objects.bulk_create(
+            [MediaBlob(name=name, size=_size(name)) for name in counts if name not in known], batch_size=500,
+        )
+        MediaBlob.objects.exclude(name__in=list(counts)).update(refcount=0)
+        for count, names in by_count.items():
+            MediaBlob.objects.filter(name__in=names).update(refcount=count)
+    return len(counts)
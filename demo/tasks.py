@@ -0,0 +1,64 @@
+"""Background tasks run by ``manage.py run_worker`` (see demo.jobs)."""
+from django.apps import apps
+from PIL import Image
+
+from .feed_cache import invalidate_categories
+from .images import Derivatives, generate_derivatives, strip_metadata
+from .jobs import enqueue_many, task
+from .models import ProfileImage, UserProfile
+from .storage import adjust_blob_references
+
+
+def _set_status(model, pk, status):
+    if model is ProfileImage:
+        ProfileImage.objects.filter(pk=pk).update(processing_status=status)
+        # the API lists the derivatives of ready photos
+        UserProfile.touch(images__pk=pk)
+
+
+def _image_failed(model, pk, field):
+    _set_status(apps.get_model(model), pk, ProfileImage.FAILED)
+
+
+@task(on_failure=_image_failed)
+def process_image(model, pk, field):
+    """Strip the metadata of an uploaded image and generate its derivatives.
+
+    ``model`` is the model label (``demo.profileimage``), ``field`` the image field.
+    """
+    model = apps.get_model(model)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        # deleted before the worker got to it
+        return
+    fieldfile = getattr(instance, field)
+    if not fieldfile:
+        return
+    _set_status(model, pk, ProfileImage.PROCESSING)
+    try:
+        # uploads are stored once per content (demo.storage): the same bytes
+        # uploaded again find their derivatives already generated
+        if not Derivatives(fieldfile).exists():
+            name = strip_metadata(fieldfile)
+            if name != fieldfile.name and model.objects.filter(pk=pk, **{field: fieldfile.name}).update(**{field: name}):
+                adjust_blob_references({name: 1, fieldfile.name: -1})
+                fieldfile.name = name
+            if not Derivatives(fieldfile).exists():
+                generate_derivatives(fieldfile)
+    except (OSError, Image.DecompressionBombError):
+        # not a readable image (or a missing file): retrying would not help
+        _set_status(model, pk, ProfileImage.FAILED)
+        return
+    _set_status(model, pk, ProfileImage.READY)
+    if model is UserProfile:
+        # cached feed fragments and API responses still point at the original logo
+        invalidate_categories([instance.service_type])
+        UserProfile.touch(pk=pk)
+
+
+def queue_image_processing(instances, field):
+    """Queue ``process_image`` for the ``field`` image of each of ``instances``."""
+    return enqueue_many(process_image, [
+        {'model': instance._meta.label_lower, 'pk': instance.pk, 'field': field}
+        for instance in instances
+    ])
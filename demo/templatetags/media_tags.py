@@ -0,0 +1,58 @@
+import os
+
+from django import template
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from demo.images import Derivatives
+from demo.models import ProfileImage
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(fieldfile, fmt='webp'):
+    """The ``srcset`` of an uploaded image's ``fmt`` derivatives (see demo.images).
+
+    Empty until they were generated for the file, so the browser falls back
+    to the ``src`` of the ``<img>``::
+
+        <picture style="display: contents">
+          <source type="image/webp" srcset="{% srcset photo.image %}" sizes="80vw">
+          <img src="{{ photo.image.url }}" srcset="{% srcset photo.image 'jpeg' %}" sizes="80vw" alt="">
+        </picture>
+
+    ``display: contents`` keeps CSS written for a bare ``<img>`` working.
+    """
+    derivatives = Derivatives(fieldfile)
+    status = getattr(fieldfile.instance, 'processing_status', None)
+    if status is not None:
+        # tracked by the background processing, no file system check needed
+        ready = status == ProfileImage.READY
+    else:
+        ready = derivatives.exists()
+    if not ready:
+        return ''
+    return derivatives.srcset(fmt)
+
+
+@register.simple_tag
+def static_variant(path, extension):
+    """URL of the ``extension`` version collectstatic made of a static file, or ''.
+
+    ``demo.staticfiles`` converts GIFs to WebP/MP4 and registers them in the
+    manifest; this offers them only where they exist::
+
+        <source type="image/webp" srcset="{% static_variant 'assets/images/garden.gif' 'webp' %}">
+
+    During development (``DEBUG``) files are served from the app directories,
+    which have no variants, so it is always empty there.
+    """
+    if settings.DEBUG:
+        return ''
+    variant = f'{os.path.splitext(path)[0]}.{extension}'
+    # storages without a manifest have no variants either
+    hashed_files = getattr(staticfiles_storage, 'hashed_files', None)
+    if hashed_files is None or staticfiles_storage.hash_key(variant) not in hashed_files:
+        return ''
+    return staticfiles_storage.url(variant)
@@ -0,0 +1,26 @@
+"""Test runner for the demo app (``TEST_RUNNER`` in settings).
+
+Tests run with ``DEBUG = False``, where ``{% static %}`` looks every file up in
+the ``staticfiles.json`` that collectstatic writes, and a missing entry is an
+error (see ``demo.staticfiles``). Pages are rendered against the plain static
+storage instead, so the suite does not need a collectstatic run; the tests of
+the optimizing storage configure it themselves.
+"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class DemoTestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._static_storage = override_settings(STORAGES={
+            **settings.STORAGES,
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        })
+        self._static_storage.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._static_storage.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1924 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import html
+import json
+import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import nullcontext
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
+from urllib.parse import urlencode
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, identify_hasher
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import (
+    Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
+from PIL import Image
+
+from . import checks, feed_cache, instrumentation, ranking, staticfiles, views, worker_process
+from .facets import get_facets, rebuild_facets
+from .images import (
+    DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS, Derivatives, derivative_name, derivative_names, generate_derivatives,
+    render_derivatives,
+)
+from .jobs import CLAIM_TIMEOUT, MAX_ATTEMPTS, claim, enqueue, requeue_stale, run_job, task
+from .models import (
+    RATING_COLUMNS, SERVICE_TYPE_CHOICES, FeedFacet, Job, MediaBlob, ProfileImage, ProviderRank, Rating, User,
+    UserProfile,
+)
+from .pagination import CURSOR_SALT, CursorPage, encode_cursor
+from .ratings import find_rating_aggregate_drift, rebuild_rating_aggregates, upsert_rating
+from .search import SEARCH_TABLE, get_search_backend
+from .sessions import FLAGS_COOKIE_NAME, FLAGS_COOKIE_SALT, SessionMiddleware, SessionStore, load_flags
+from .staticfiles import OptimizingManifestStaticFilesStorage
+from .storage import is_content_name, rebuild_blob_references
+from .tasks import process_image
+from .templatetags import media_tags
+from .views import _save_profile_photos, _service_feed_queryset
+
+
+def make_user(name, user_type='user', **extra):
+    fields = {
+        'contact': 9999999999,
+        'email': f'{name}@example.com',
+        'city': 'Ahmedabad',
+        'create_password': 'x',
+        'confirm_password': 'x',
+        'user_type': user_type,
+    }
+    fields.update(extra)
+    return User.objects.create(name=name, **fields)
+
+
+def make_profile(owner, company_name, service_type='Builders', **extra):
+    fields = {
+        'office_address': 'CG road',
+        'office_number': '0100200340',
+        'gst_number': 'GST',
+        'pan_number': 'PAN',
+        'company_description': f'{company_name} description',
+    }
+    fields.update(extra)
+    return UserProfile.objects.create(user=owner, company_name=company_name, service_type=service_type, **fields)
+
+
+def populate(profile, size):
+    """Give ``profile`` ``size`` photos and ``size`` ratings."""
+    for i in range(size):
+        ProfileImage.objects.create(profile=profile, image=f'Img/profile/photo{i}.jpg')
+        rater = make_user(f'{profile.company_name}-rater{i}')
+        Rating.objects.create(profile=profile, user=rater, rating=i % 5 + 1)
+
+
+class ProfilePageQueryTests(TestCase):
+    """profile_detail/companyprofile must not issue per-photo or per-rating queries."""
+
+    def setUp(self):
+        self.small = make_profile(make_user('small-owner', 'service_provider'), 'Small Co')
+        self.large = make_profile(make_user('large-owner', 'service_provider'), 'Large Co')
+        populate(self.small, 1)
+        populate(self.large, 25)
+        self.visitor = make_user('visitor')
+        Rating.objects.create(profile=self.small, user=self.visitor, rating=4)
+        Rating.objects.create(profile=self.large, user=self.visitor, rating=2)
+
+    def login(self, user):
+        session = self.client.session
+        session['logged_in_user_id'] = user.id
+        session['logged_in_username'] = user.name
+        session.save()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+
+    def test_profile_detail_query_count_is_constant(self):
+        self.login(self.visitor)
+        small, _ = self.count_queries(reverse('profile_detail', args=[self.small.pk]))
+        large, response = self.count_queries(reverse('profile_detail', args=[self.large.pk]))
+        self.assertEqual(small, large)
+        self.assertTrue(response.context['can_rate'])
+        self.assertEqual(response.context['user_rating'], 2)
+        self.assertEqual(len(response.context['photos']), 25)
+
+    def test_companyprofile_query_count_is_constant(self):
+        self.login(self.small.user)
+        small, _ = self.count_queries(reverse('companyprofile'))
+        self.login(self.large.user)
+        large, response = self.count_queries(reverse('companyprofile'))
+        self.assertEqual(small, large)
+        self.assertTrue(response.context['is_owner'])
+        self.assertFalse(response.context['can_rate'])
+
+    def test_loader_uses_at_most_three_queries(self):
+        from .views import _profile_page_context
+
+        self.login(self.visitor)
+        request = self.client.get(reverse('index')).wsgi_request
+        request.session = self.client.session
+        request.session.keys()  # the session row is not part of the loader's budget
+        with self.assertNumQueries(3):
+            context = _profile_page_context(request, pk=self.large.pk)
+        self.assertEqual(context['rating_count'], 26)
+
+
+class RatingAggregateTests(TestCase):
+    """The rating aggregates stored on UserProfile follow every change to the Rating table."""
+
+    def setUp(self):
+        owner = make_user('owner', 'service_provider')
+        self.first, self.second = make_profile(owner, 'First Co'), make_profile(owner, 'Second Co')
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+
+    def aggregates(self, profile):
+        profile.refresh_from_db()
+        return profile.rating_sum, profile.rating_count, profile.avg_rating
+
+    def test_created_changed_moved_and_deleted(self):
+        Rating.objects.create(profile=self.first, user=self.alice, rating=5)
+        Rating.objects.update_or_create(profile=self.first, user=self.bob, defaults={'rating': 2})
+        self.assertEqual(self.aggregates(self.first), (7, 2, 3.5))
+
+        Rating.objects.update_or_create(profile=self.first, user=self.bob, defaults={'rating': 4})
+        self.assertEqual(self.aggregates(self.first), (9, 2, 4.5))
+
+        rating = Rating.objects.get(profile=self.first, user=self.bob)
+        rating.profile = self.second
+        rating.save()
+        self.assertEqual(self.aggregates(self.first), (5, 1, 5.0))
+        self.assertEqual(self.aggregates(self.second), (4, 1, 4.0))
+
+        Rating.objects.filter(user=self.alice).delete()
+        self.assertEqual(self.aggregates(self.first), (0, 0, 0.0))
+        rating.delete()
+        self.assertEqual(self.aggregates(self.second), (0, 0, 0.0))
+        self.assertEqual(find_rating_aggregate_drift(), [])
+
+    def test_profile_save_keeps_the_aggregates(self):
+        stale = UserProfile.objects.get(pk=self.first.pk)
+        Rating.objects.create(profile=self.first, user=self.alice, rating=4)
+        columns = UserProfile.objects.filter(pk=self.first.pk).values(*RATING_COLUMNS).get()
+        # a profile edit from an instance loaded before the rating
+        stale.company_description = 'Edited'
+        stale.save()
+        self.assertEqual(UserProfile.objects.filter(pk=self.first.pk).values(*RATING_COLUMNS).get(), columns)
+        self.assertEqual(self.aggregates(self.first), (4, 1, 4.0))
+        self.assertEqual(self.first.company_description, 'Edited')
+
+    def test_rebuild_command_fixes_drift(self):
+        Rating.objects.create(profile=self.first, user=self.alice, rating=3)
+        UserProfile.objects.filter(pk=self.first.pk).update(rating_sum=99)
+        self.assertEqual([row['pk'] for row in find_rating_aggregate_drift()], [self.first.pk])
+        with self.assertRaisesMessage(CommandError, '1 profile(s) have stale rating aggregates'):
+            call_command('rebuild_rating_aggregates', '--check', stdout=StringIO())
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        self.assertEqual(self.aggregates(self.first), (3, 1, 3.0))
+        call_command('rebuild_rating_aggregates', '--check', stdout=StringIO())
+
+
+class SearchIndexTests(TestCase):
+    """The full-text index of the feed's ``q`` follows profile and owner edits (demo.search)."""
+
+    def setUp(self):
+        self.acme_owner = make_user('acme-owner', 'service_provider', city='Pune')
+        self.zeta_owner = make_user('zeta-owner', 'service_provider', city='Surat')
+        self.acme = make_profile(self.acme_owner, 'Acme Builders', company_description='concrete homes')
+        self.zeta = make_profile(self.zeta_owner, 'Zeta', company_description='wood concrete concrete')
+
+    def search(self, q):
+        return [profile.company_name for profile in _service_feed_queryset('Builders', q)]
+
+    def test_prefix_matches_ranked_by_relevance(self):
+        self.assertEqual(self.search('acm'), ['Acme Builders'])
+        self.assertEqual(self.search('concrete'), ['Zeta', 'Acme Builders'])
+        self.assertEqual(self.search('sur'), ['Zeta'])
+
+    def test_follows_profile_and_owner_edits(self):
+        self.zeta_owner.city = 'Pune'
+        self.zeta_owner.save()
+        self.assertEqual(self.search('sur'), [])
+        self.assertEqual(sorted(self.search('pune')), ['Acme Builders', 'Zeta'])
+
+        self.acme.company_name = 'Beta'
+        self.acme.save()
+        self.assertEqual(self.search('acme'), [])
+        self.assertEqual(self.search('beta'), ['Beta'])
+
+        self.acme.delete()
+        self.assertEqual(self.search('concrete'), ['Zeta'])
+        self.zeta_owner.delete()
+        self.assertEqual(self.search('concrete'), [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE}')
+            self.assertEqual(cursor.fetchone(), (0,))
+
+    def test_punctuation_is_not_match_syntax(self):
+        for q in ('!!!', '"; drop', '*', 'NEAR(', '"', '-'):
+            with self.subTest(q=q):
+                self.assertEqual(self.search(q), [])
+        self.assertEqual(self.search('"acme" ('), ['Acme Builders'])
+        response = self.client.get(reverse('builderfeed'), {'q': '"(*'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rebuild_repopulates_the_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        self.assertEqual(self.search('concrete'), [])
+        self.assertEqual(get_search_backend().rebuild(), 2)
+        self.assertEqual(self.search('concrete'), ['Zeta', 'Acme Builders'])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.search('concrete'), ['Zeta', 'Acme Builders'])
+        response = self.client.get(reverse('builderfeed'), {'q': 'conc', 'city': 'SURAT'})
+        self.assertContains(response, 'Zeta')
+        self.assertNotContains(response, 'Acme Builders')
+
+
+class CursorPaginationTests(TestCase):
+    """Cursor pages of a feed (demo.pagination) cover every profile once, ties on the score included."""
+
+    def setUp(self):
+        owner = make_user('owner', 'service_provider')
+        for i in range(25):
+            make_profile(owner, f'C{i:02d}')
+        # three scores for 25 profiles: long runs of equal rank_score
+        for profile in UserProfile.objects.all():
+            UserProfile.objects.filter(pk=profile.pk).update(rank_score=int(profile.company_name[1:]) % 3)
+        self.queryset = _service_feed_queryset('Builders')
+        self.expected = [profile.company_name for profile in self.queryset]
+
+    def names(self, page):
+        return [profile.company_name for profile in page]
+
+    def test_after_and_before_round_trip(self):
+        pages = [CursorPage(self.queryset, 9)]
+        while pages[-1].has_next():
+            pages.append(CursorPage(self.queryset, 9, after=pages[-1].next_cursor))
+        self.assertEqual([self.names(page) for page in pages],
+                         [self.expected[:9], self.expected[9:18], self.expected[18:]])
+        self.assertFalse(pages[0].has_previous())
+
+        back = [pages[-1]]
+        while back[-1].has_previous():
+            back.append(CursorPage(self.queryset, 9, before=back[-1].previous_cursor))
+        self.assertEqual([self.names(page) for page in back[::-1]], [self.names(page) for page in pages])
+        self.assertTrue(back[-1].has_next())
+
+    def test_pk_breaks_ties(self):
+        profile = self.queryset[4]
+        # a row with the same score and name but a lower id comes first
+        key = {'rank_score': profile.rank_score, 'company_name': profile.company_name, 'pk': profile.pk - 1}
+        page = CursorPage(self.queryset, 3, after=encode_cursor(key))
+        self.assertEqual(self.names(page), self.expected[4:7])
+        page = CursorPage(self.queryset, 3, before=encode_cursor(profile))
+        self.assertEqual(self.names(page), self.expected[1:4])
+
+    def test_feed_links(self):
+        url, seen = reverse('builderfeed'), []
+        path = f'{url}?pagination=cursor'
+        while path is not None:
+            response = self.client.get(path)
+            seen += re.findall(r'>(C\d\d)</a>', response.content.decode())
+            link = re.search(r'href="(\?after=[^"]+)"', response.content.decode())
+            path = url + html.unescape(link.group(1)) if link else None
+        self.assertEqual(seen, self.expected)
+
+    def test_invalid_cursors_give_the_first_page(self):
+        token = CursorPage(self.queryset, 9).next_cursor
+        signer = signing.Signer(salt=CURSOR_SALT)
+        invalid = {
+            'garbage': 'garbage',
+            'tampered': token[:-1] + ('A' if token[-1] != 'A' else 'B'),
+            'other salt': signing.Signer(salt='other').sign_object([1.0, 'C00', 1]),
+            'wrong shape': signer.sign_object(['C00']),
+            'wrong types': signer.sign_object([None, 'C00', 'x']),
+        }
+        for label, cursor in invalid.items():
+            for key in ('after', 'before'):
+                with self.subTest(label, key=key):
+                    self.assertEqual(self.names(CursorPage(self.queryset, 9, **{key: cursor})), self.expected[:9])
+                    response = self.client.get(reverse('builderfeed'), {key: cursor})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(re.findall(r'>(C\d\d)</a>', response.content.decode()), self.expected[:9])
+
+
+class FeedCacheTests(TestCase):
+    """Rendered feed fragments are reused until their category changes (demo.feed_cache)."""
+
+    def setUp(self):
+        feed_cache.get_feed_cache().clear()
+        feed_cache.stats.reset()
+        self.owner = make_user('owner', 'service_provider')
+        self.profile = make_profile(self.owner, 'Alpha', service_type='Architects')
+
+    def test_repeated_request_makes_no_queries(self):
+        url = reverse('architectfeed')
+        self.assertContains(self.client.get(url), 'Alpha')
+        # the same normalized parameters: the fragment and the facets come from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'q': ' '})
+        self.assertContains(response, 'Alpha')
+        self.assertEqual(feed_cache.stats.snapshot()['Architects']['hits'], 1)
+
+    def test_page_links_carry_the_normalized_filters(self):
+        for i in range(5):
+            make_profile(self.owner, f'A&B Co {i}', service_type='Architects')
+        # matches "a" but not "b": what a link that cut q at the "&" would find too
+        make_profile(self.owner, 'A Co', service_type='Architects')
+        url, seen = reverse('architectfeed'), []
+        path = f"{url}?{urlencode({'q': 'A&B', 'city': ' AHMEDABAD', 'pagination': 'page', 'per_page': 2})}"
+        while path is not None:
+            content = self.client.get(path).content.decode()
+            names = [html.unescape(name) for name in re.findall(r'>([^<>]+ Co(?: \d)?)</a>', content)]
+            self.assertLessEqual(len(names), 2)
+            seen += names
+            # the lowercased q and city the fragment is cached under, urlencoded
+            self.assertIn('q=a%26b&amp;city=ahmedabad&amp;pagination=page&amp;per_page=2', content)
+            link = re.search(r'href="(\?page=[^"]+)" aria-label="Next"', content)
+            path = url + html.unescape(link.group(1)) if link else None
+        self.assertEqual(sorted(seen), [f'A&B Co {i}' for i in range(5)])
+
+    def test_changes_bump_only_their_category(self):
+        rater = make_user('rater')
+
+        def rename():
+            self.profile.company_name = 'Beta'
+            self.profile.save()
+
+        def replace_logo():
+            self.profile.logo = 'Img/profile/logo.png'
+            self.profile.save()
+
+        changes = {
+            'profile': rename,
+            'owner': lambda: User.objects.filter(pk=self.owner.pk).get().save(),
+            'rating': lambda: Rating.objects.create(profile=self.profile, user=rater, rating=4),
+            'rating upsert': lambda: upsert_rating(self.profile, rater, 2),
+            'logo': replace_logo,
+        }
+        for label, change in changes.items():
+            with self.subTest(label):
+                architects, builders = (feed_cache.category_version(label) for label in ('Architects', 'Builders'))
+                with self.captureOnCommitCallbacks(execute=True):
+                    change()
+                self.assertNotEqual(feed_cache.category_version('Architects'), architects)
+                self.assertEqual(feed_cache.category_version('Builders'), builders)
+
+        self.assertContains(self.client.get(reverse('architectfeed')), '2.0 / 5')
+        self.profile.service_type = 'Builders'
+        self.profile.save()
+        self.assertNotContains(self.client.get(reverse('architectfeed')), 'Beta')
+        self.assertContains(self.client.get(reverse('builderfeed')), 'Beta')
+
+
+class FeedFacetTests(TestCase):
+    """The city and rating options of the feeds follow profile, owner and rating changes (demo.facets)."""
+
+    def setUp(self):
+        feed_cache.get_feed_cache().clear()
+        self.pune = make_user('pune-owner', 'service_provider', city='Pune')
+        self.surat = make_user('surat-owner', 'service_provider', city='Surat')
+        self.first = make_profile(self.pune, 'First Co')
+        self.second = make_profile(self.surat, 'Second Co')
+
+    def assertMatchesRebuild(self):
+        stored = sorted(FeedFacet.objects.filter(count__gt=0).values_list('service_type', 'facet', 'value', 'count'))
+        rebuild_facets()
+        self.assertEqual(
+            sorted(FeedFacet.objects.filter(count__gt=0).values_list('service_type', 'facet', 'value', 'count')),
+            stored,
+        )
+
+    def test_cities_follow_profiles_and_owners(self):
+        self.assertEqual(get_facets('Builders')['cities'], [('Pune', 1), ('Surat', 1)])
+        third = make_profile(self.surat, 'Third Co')
+        self.assertEqual(get_facets('Builders')['cities'], [('Pune', 1), ('Surat', 2)])
+
+        self.pune.city = 'Surat'
+        self.pune.save()
+        self.assertEqual(get_facets('Builders')['cities'], [('Surat', 3)])
+
+        third.service_type = 'Architects'
+        third.save()
+        self.assertEqual(get_facets('Builders')['cities'], [('Surat', 2)])
+        self.assertEqual(get_facets('Architects')['cities'], [('Surat', 1)])
+
+        self.first.delete()
+        self.assertEqual(get_facets('Builders')['cities'], [('Surat', 1)])
+        self.assertMatchesRebuild()
+
+    def test_cities_are_case_insensitive(self):
+        make_profile(make_user('lower-owner', 'service_provider', city='pune'), 'Lower Co')
+        make_profile(make_user('upper-owner', 'service_provider', city='PUNE'), 'Upper Co')
+        self.assertEqual(get_facets('Builders')['cities'], [('PUNE', 3), ('Surat', 1)])
+        response = self.client.get(reverse('builderfeed'), {'city': 'PUNE'})
+        self.assertContains(response, 'PUNE (3)')
+        for name in ('First Co', 'Lower Co', 'Upper Co'):
+            self.assertContains(response, name)
+        self.assertNotContains(response, 'Second Co')
+
+    def test_rating_buckets(self):
+        alice, bob = make_user('alice'), make_user('bob')
+        Rating.objects.create(profile=self.first, user=alice, rating=5)
+        rating = Rating.objects.create(profile=self.first, user=bob, rating=2)
+        Rating.objects.create(profile=self.second, user=bob, rating=4)
+        self.assertEqual(get_facets('Builders')['min_rating'], {1: 2, 2: 2, 3: 2, 4: 1, 5: 0})
+        rating.rating = 5
+        rating.save()
+        self.assertEqual(get_facets('Builders')['min_rating'], {1: 2, 2: 2, 3: 2, 4: 2, 5: 1})
+        self.second.service_type = 'Architects'
+        self.second.save()
+        self.assertEqual(get_facets('Architects')['min_rating'], {1: 1, 2: 1, 3: 1, 4: 1, 5: 0})
+        self.assertMatchesRebuild()
+
+        self.client.get(reverse('architectfeed'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('architectfeed'))
+        self.assertContains(response, 'Surat (1)')
+        self.assertContains(response, '4+ (1)')
+
+
+class UpsertRatingTests(TestCase):
+    """upsert_rating keeps the aggregates and rating facets exactly as the signals would."""
+
+    def setUp(self):
+        self.profile = make_profile(make_user('owner', 'service_provider'), 'Rated Co')
+        self.first, self.second = make_user('first'), make_user('second')
+
+    def facets(self):
+        return sorted(FeedFacet.objects.values_list('service_type', 'facet', 'value', 'count'))
+
+    def test_create_update_and_second_rater(self):
+        self.assertTrue(upsert_rating(self.profile, self.first, 4, 'good'))
+        self.assertFalse(upsert_rating(self.profile, self.first, 2))
+        self.assertTrue(upsert_rating(self.profile, self.second, 5))
+
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.rating_sum, self.profile.rating_count, self.profile.avg_rating), (7, 2, 3.5))
+        self.assertEqual(Rating.objects.get(profile=self.profile, user=self.first).rating, 2)
+        self.assertEqual(find_rating_aggregate_drift(), [])
+        facets = self.facets()
+        rebuild_facets()
+        self.assertEqual(self.facets(), facets)
+
+    def test_validated_in_memory(self):
+        with self.assertNumQueries(0), self.assertRaisesMessage(ValidationError, 'You cannot rate your own profile.'):
+            upsert_rating(self.profile, self.profile.user, 4)
+        with self.assertNumQueries(0), self.assertRaisesMessage(ValidationError, 'Rating must be between 1 and 5.'):
+            upsert_rating(self.profile, self.first, 6)
+
+
+class RankingTests(TestCase):
+    """The feeds and top lists order profiles by the Bayesian, time-decayed score of demo.ranking."""
+
+    def setUp(self):
+        self.owner = make_user('owner', 'service_provider')
+        self.raters = [make_user(f'rater{i}') for i in range(40)]
+
+    def stored(self, profile):
+        profile.refresh_from_db()
+        return profile.decayed_count, profile.decayed_sum, profile.rank_score
+
+    def ranks(self):
+        return list(ProviderRank.objects.order_by('service_type', 'position')
+                    .values_list('service_type', 'position', 'profile_id'))
+
+    def assertStoredAsRebuilt(self, *profiles):
+        """The incrementally kept columns and ProviderRank rows equal a rebuild from the ratings."""
+        stored, ranks = [self.stored(profile) for profile in profiles], self.ranks()
+        ranking.rebuild_rankings()
+        for profile, values in zip(profiles, stored):
+            for value, rebuilt in zip(values, self.stored(profile)):
+                self.assertAlmostEqual(value / rebuilt if rebuilt else value, 1.0 if rebuilt else 0.0, places=6)
+        self.assertEqual(self.ranks(), ranks)
+
+    def test_many_good_ratings_outrank_one_perfect_rating(self):
+        single = make_profile(self.owner, 'Single Co')
+        popular = make_profile(make_user('owner2', 'service_provider'), 'Popular Co')
+        Rating.objects.create(profile=single, user=self.raters[0], rating=5)
+        for i, rater in enumerate(self.raters):
+            Rating.objects.create(profile=popular, user=rater, rating=4 if i % 5 == 0 else 5)
+
+        single.refresh_from_db()
+        popular.refresh_from_db()
+        self.assertGreater(single.avg_rating, popular.avg_rating)
+        self.assertGreater(popular.rank_score, single.rank_score)
+        self.assertEqual(list(_service_feed_queryset('Builders').values_list('pk', flat=True)), [popular.pk, single.pk])
+        self.assertEqual(self.ranks(), [('builders', 1, popular.pk), ('builders', 2, single.pk)])
+        self.assertStoredAsRebuilt(single, popular)
+
+    def test_older_ratings_weigh_less(self):
+        fading = make_profile(self.owner, 'Fading Co')
+        rising = make_profile(make_user('owner2', 'service_provider'), 'Rising Co')
+        half_life = timedelta(days=settings.RANKING_HALF_LIFE_DAYS)
+        for profile, old, new in ((fading, 5, 1), (rising, 1, 5)):
+            rating = Rating.objects.create(profile=profile, user=self.raters[0], rating=old)
+            Rating.objects.filter(pk=rating.pk).update(created_at=rating.created_at - 2 * half_life)
+            Rating.objects.create(profile=profile, user=self.raters[1], rating=new)
+        ranking.rebuild_rankings()
+
+        prior = settings.RANKING_PRIOR_WEIGHT * settings.RANKING_PRIOR_MEAN
+        # the old rating counts a quarter
+        self.assertAlmostEqual(self.stored(fading)[2], (prior + 5 / 4 + 1) / (settings.RANKING_PRIOR_WEIGHT + 5 / 4), 4)
+        self.assertAlmostEqual(self.stored(rising)[2], (prior + 1 / 4 + 5) / (settings.RANKING_PRIOR_WEIGHT + 5 / 4), 4)
+        self.assertEqual(self.ranks(), [('builders', 1, rising.pk), ('builders', 2, fading.pk)])
+
+    def test_rating_writes_shift_the_stored_sums(self):
+        first = make_profile(self.owner, 'First Co')
+        second = make_profile(make_user('owner2', 'service_provider'), 'Second Co', service_type='Plumbing')
+        upsert_rating(first, self.raters[0], 2)
+        upsert_rating(first, self.raters[1], 5)
+        upsert_rating(first, self.raters[0], 4)
+        self.assertStoredAsRebuilt(first, second)
+
+        rating = Rating.objects.create(profile=first, user=self.raters[2], rating=1)
+        # backdated ratings are changed, moved and deleted with their own weight
+        Rating.objects.filter(pk=rating.pk).update(created_at=rating.created_at - timedelta(days=400))
+        ranking.rebuild_rankings()
+        rating = Rating.objects.get(pk=rating.pk)
+        rating.rating = 3
+        rating.save()
+        self.assertStoredAsRebuilt(first, second)
+        rating.profile = second
+        rating.save()
+        self.assertStoredAsRebuilt(first, second)
+        upsert_rating(second, self.raters[2], 5)
+        self.assertStoredAsRebuilt(first, second)
+        Rating.objects.get(pk=rating.pk).delete()
+        self.assertStoredAsRebuilt(first, second)
+        self.assertEqual(self.stored(second), (0, 0, settings.RANKING_PRIOR_MEAN))
+
+    def test_pages_list_the_top_providers(self):
+        profile = make_profile(self.owner, 'Listed Co')
+        Rating.objects.create(profile=profile, user=self.raters[0], rating=5)
+        for name in ('index', 'explore'):
+            with self.subTest(name):
+                response = self.client.get(reverse(name))
+                self.assertEqual([(label, [rank.profile for rank in ranks])
+                                  for label, ranks in response.context['top_providers']], [('Builders', [profile])])
+                self.assertContains(response, 'Listed Co')
+
+    @override_settings(RANKING_HALF_LIFE_DAYS=2)
+    def test_weights_stop_growing_instead_of_overflowing(self):
+        profile = make_profile(self.owner, 'Lasting Co')
+        # 2 ** (days / 2) overflows a float about 5.6 years after DECAY_EPOCH
+        far_future = ranking.DECAY_EPOCH + timedelta(days=365 * 1000)
+        self.assertEqual(ranking.rating_weight(far_future), 2.0 ** ranking.MAX_WEIGHT_EXPONENT)
+        for rater, rating, age in ((self.raters[0], 5, timedelta(days=1)), (self.raters[1], 4, timedelta(0))):
+            created = Rating.objects.create(profile=profile, user=rater, rating=rating)
+            Rating.objects.filter(pk=created.pk).update(created_at=far_future - age)
+        # past the limit every rating weighs the same
+        expected = (settings.RANKING_PRIOR_WEIGHT * settings.RANKING_PRIOR_MEAN + 9) / (settings.RANKING_PRIOR_WEIGHT + 2)
+        for label, numpy in (('numpy', ranking.np), ('python', None)):
+            with self.subTest(label), mock.patch.object(ranking, 'np', numpy):
+                ranking.rebuild_rankings(now=far_future)
+                count, total, score = self.stored(profile)
+                self.assertEqual(count, 2 * 2.0 ** ranking.MAX_WEIGHT_EXPONENT)
+                self.assertAlmostEqual(total / count, 4.5)
+                self.assertAlmostEqual(score, expected)
+        upsert_rating(profile, self.raters[2], 3)
+        self.assertStoredAsRebuilt(profile)
+
+    def test_half_life_system_check(self):
+        def check(half_life):
+            with self.settings(RANKING_HALF_LIFE_DAYS=half_life):
+                return [message.id for message in checks.check_ranking_half_life(None)]
+
+        self.assertEqual(check(settings.RANKING_HALF_LIFE_DAYS), [])
+        self.assertEqual(check(2), ['demo.E001'])
+        # the weights stop growing in a year
+        self.assertEqual(check((ranking._epoch_days(timezone.now()) + 365) / ranking.MAX_WEIGHT_EXPONENT), ['demo.W001'])
+        for invalid in (0, -30, '180', None):
+            with self.subTest(invalid):
+                self.assertEqual(check(invalid), ['demo.E002'])
+
+    @skipIf(ranking.np is None, 'NumPy is not installed')
+    def test_numpy_matches_the_python_loop(self):
+        groups, ratings, days = [0, 1, 1, 2, 0], [5, 1, 4, 3, 2], [-30.5, 0, 900, 2400.25, 12]
+        counts, sums = ranking.decayed_aggregates(groups, ratings, days, 4)
+        numpy = ranking.np
+        ranking.np = None
+        try:
+            expected = ranking.decayed_aggregates(groups, ratings, days, 4)
+        finally:
+            ranking.np = numpy
+        for values, expected_values in zip((counts.tolist(), sums.tolist()), expected):
+            for value, expected_value in zip(values, expected_values):
+                self.assertAlmostEqual(value, expected_value)
+
+
+def png(color, name='photo.png'):
+    buffer = BytesIO()
+    Image.new('RGB', (40, 30), color).save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class TemporaryMediaMixin:
+    """Store the test's files in a MEDIA_ROOT of their own."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = self.settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+
+def jpeg(size=(1600, 1000), name='photo.jpg'):
+    buffer = BytesIO()
+    Image.linear_gradient('L').resize(size).convert('RGB').save(buffer, format='JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class ImageDerivativeTests(TemporaryMediaMixin, TestCase):
+    """Resized derivatives of uploads in every format and width, and uploads that are no images (demo.images)."""
+
+    def setUp(self):
+        super().setUp()
+        self.profile = make_profile(make_user('owner', 'service_provider'), 'Photo Co')
+
+    def test_every_format_and_width(self):
+        photo = ProfileImage.objects.create(profile=self.profile, image=jpeg())
+        names = generate_derivatives(photo.image)
+        self.assertEqual(sorted(names), sorted(derivative_names(photo.image.name)))
+        for width in DERIVATIVE_WIDTHS:
+            for fmt in DERIVATIVE_FORMATS:
+                name = derivative_name(photo.image.name, width, fmt)
+                with self.subTest(width=width, fmt=fmt), default_storage.open(name) as file, Image.open(file) as image:
+                    self.assertEqual(image.format, fmt.upper())
+                    # the aspect ratio is kept
+                    self.assertEqual(image.size, (width, round(width * 1000 / 1600)))
+
+    def test_small_images_are_not_upscaled(self):
+        photo = ProfileImage.objects.create(profile=self.profile, image=png('red'))
+        generate_derivatives(photo.image)
+        for width in DERIVATIVE_WIDTHS:
+            with default_storage.open(derivative_name(photo.image.name, width, 'webp')) as file, Image.open(file) as image:
+                self.assertEqual(image.size, (40, 30))
+
+    def test_srcset_lists_the_files(self):
+        photo = ProfileImage.objects.create(profile=self.profile, image=jpeg())
+        derivatives = Derivatives(photo.image)
+        self.assertFalse(derivatives.exists())
+        generate_derivatives(photo.image)
+        self.assertTrue(derivatives.exists())
+        for fmt in DERIVATIVE_FORMATS:
+            candidates = [candidate.rsplit(' ', 1) for candidate in derivatives.srcset(fmt).split(', ')]
+            self.assertEqual([width for _, width in candidates], [f'{width}w' for width in DERIVATIVE_WIDTHS])
+            for url, _ in candidates:
+                with self.subTest(url):
+                    self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_unreadable_images_are_marked_failed(self):
+        truncated = jpeg()
+        uploads = {
+            'not an image': SimpleUploadedFile('notes.png', b'plain text', content_type='image/png'),
+            'truncated': SimpleUploadedFile('cut.jpg', truncated.read()[:200], content_type='image/jpeg'),
+        }
+        for label, upload in uploads.items():
+            with self.subTest(label):
+                photo = ProfileImage.objects.create(profile=self.profile, image=upload)
+                process_image('demo.profileimage', photo.pk, 'image')
+                photo.refresh_from_db()
+                self.assertEqual(photo.processing_status, ProfileImage.FAILED)
+                self.assertFalse(Derivatives(photo.image).exists())
+        with self.assertRaises(OSError):
+            render_derivatives(BytesIO(b'plain text'))
+
+
+FAILED_PAYLOADS = []
+
+
+@task(on_failure=lambda **payload: FAILED_PAYLOADS.append(payload))
+def failing_task(**payload):
+    raise RuntimeError('always fails')
+
+
+@task(on_failure=lambda **payload: FAILED_PAYLOADS.append(payload))
+def crashing_task(**payload):
+    # takes its pool process down, as the OOM killer would
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+@task
+def quiet_task(**payload):
+    pass
+
+
+def run_in_test_database(job_id):
+    """``worker_process.run`` for spawned pool processes, which load the settings without the test database."""
+    connections['default'].settings_dict['NAME'] = os.environ['DEMO_TEST_DATABASE']
+    return worker_process.run(job_id)
+
+
+class JobQueueTests(TemporaryMediaMixin, TestCase):
+    """Jobs are claimed, run, retried and pruned by the database-backed queue (demo.jobs)."""
+
+    def setUp(self):
+        super().setUp()
+        self.profile = make_profile(make_user('owner', 'service_provider'), 'Photo Co')
+        FAILED_PAYLOADS.clear()
+
+    def test_image_job_is_claimed_and_run(self):
+        photo = ProfileImage.objects.create(profile=self.profile, image=jpeg())
+        job = Job.objects.get()
+        self.assertEqual((job.status, photo.processing_status), (Job.PENDING, ProfileImage.PENDING))
+
+        self.assertEqual(claim(10), [job.pk])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.RUNNING, 1))
+        self.assertIsNotNone(job.claimed_at)
+        # claimed once only
+        self.assertEqual(claim(10), [])
+
+        self.assertEqual(run_job(job.pk), (job.pk, Job.DONE))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertIsNotNone(job.finished_at)
+        photo.refresh_from_db()
+        self.assertEqual(photo.processing_status, ProfileImage.READY)
+        self.assertTrue(Derivatives(photo.image).exists())
+
+    def test_failing_job_is_retried_then_failed(self):
+        job = enqueue(failing_task, attempt='x')
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.assertEqual(claim(10), [job.pk])
+            status = Job.PENDING if attempt < MAX_ATTEMPTS else Job.FAILED
+            self.assertEqual(run_job(job.pk), (job.pk, status))
+            job.refresh_from_db()
+            self.assertIn('RuntimeError: always fails', job.last_error)
+            if status == Job.PENDING:
+                # backed off: not due yet
+                self.assertGreater(job.run_after, timezone.now())
+                self.assertEqual(claim(10), [])
+                Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, MAX_ATTEMPTS))
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(FAILED_PAYLOADS, [{'attempt': 'x'}])
+
+        unknown = enqueue('demo.tasks.missing')
+        claim(10)
+        self.assertEqual(run_job(unknown.pk), (unknown.pk, Job.FAILED))
+
+    def test_stale_claims_are_requeued(self):
+        job = enqueue(failing_task)
+        claim(10)
+        self.assertEqual(requeue_stale(), 0)
+        Job.objects.filter(pk=job.pk).update(claimed_at=timezone.now() - CLAIM_TIMEOUT - timedelta(seconds=1))
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(claim(10), [job.pk])
+
+    def test_run_worker_runs_the_queue_and_prunes_finished_jobs(self):
+        long_ago = timezone.now() - timedelta(days=settings.JOB_RETENTION_DAYS + 1)
+        old = Job.objects.create(task='demo.tasks.process_image', status=Job.DONE, finished_at=long_ago)
+        old_failure = Job.objects.create(task='demo.tasks.process_image', status=Job.FAILED, finished_at=long_ago)
+        recent = Job.objects.create(task='demo.tasks.process_image', status=Job.DONE, finished_at=timezone.now())
+        photo = ProfileImage.objects.create(profile=self.profile, image=jpeg())
+
+        call_command('run_worker', processes=0, once=True, stdout=StringIO())
+        photo.refresh_from_db()
+        self.assertEqual(photo.processing_status, ProfileImage.READY)
+        self.assertFalse(Job.objects.filter(pk__in=[old.pk, old_failure.pk]).exists())
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 2)
+        self.assertTrue(Job.objects.filter(pk=recent.pk).exists())
+
+        call_command('run_worker', processes=0, once=True, keep_days=0, stdout=StringIO())
+        self.assertFalse(Job.objects.exists())
+
+
+class WorkerCrashTests(TransactionTestCase):
+    """run_worker survives a pool process that dies, and blames only the job that killed it."""
+
+    def run_worker(self):
+        err = StringIO()
+        environ = {'DEMO_TEST_DATABASE': str(connection.settings_dict['NAME'])}
+        with mock.patch.dict(os.environ, environ), mock.patch('demo.worker_process.run', run_in_test_database):
+            call_command('run_worker', processes=1, once=True, poll_interval=0.1, stdout=StringIO(), stderr=err)
+        return err.getvalue()
+
+    def test_killed_process_is_replaced(self):
+        FAILED_PAYLOADS.clear()
+        crash, quiet = enqueue(crashing_task, photo=1), enqueue(quiet_task)
+        err = self.run_worker()
+        self.assertIn(f'A worker process died running job(s) #{crash.pk}, #{quiet.pk}', err)
+        # both were in the pool: their attempts were given back, then each ran alone
+        self.assertIn(f'A worker process died running job(s) #{crash.pk}; restarting', err)
+        crash.refresh_from_db()
+        quiet.refresh_from_db()
+        self.assertEqual((quiet.status, quiet.attempts), (Job.DONE, 1))
+        self.assertEqual((crash.status, crash.attempts), (Job.PENDING, 1))
+        self.assertIn('BrokenProcessPool', crash.last_error)
+        self.assertGreater(crash.run_after, timezone.now())
+
+        # the last attempt fails it for good
+        Job.objects.filter(pk=crash.pk).update(attempts=MAX_ATTEMPTS - 1, run_after=timezone.now())
+        self.run_worker()
+        crash.refresh_from_db()
+        self.assertEqual((crash.status, crash.attempts), (Job.FAILED, MAX_ATTEMPTS))
+        self.assertEqual(FAILED_PAYLOADS, [{'photo': 1}])
+
+
+class ContentAddressedStorageTests(TemporaryMediaMixin, TestCase):
+    """Uploads are stored once per content and reference-counted from the image fields."""
+
+    def setUp(self):
+        super().setUp()
+        self.profile = make_profile(make_user('owner', 'service_provider'), 'Photo Co')
+
+    def refcounts(self):
+        return dict(MediaBlob.objects.values_list('name', 'refcount'))
+
+    def test_identical_uploads_share_one_file(self):
+        first = ProfileImage.objects.create(profile=self.profile, image=png('red', 'IMG_0001.PNG'))
+        second = ProfileImage.objects.create(profile=self.profile, image=png('red', 'copy of IMG_0001.png'))
+        other = ProfileImage.objects.create(profile=self.profile, image=png('blue'))
+
+        self.assertTrue(is_content_name(first.image.name))
+        self.assertTrue(first.image.name.endswith('.png'))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertNotEqual(first.image.name, other.image.name)
+        self.assertEqual(self.refcounts(), {first.image.name: 2, other.image.name: 1})
+        self.assertEqual(MediaBlob.objects.get(name=first.image.name).size, first.image.size)
+
+        second.delete()
+        self.assertEqual(self.refcounts()[first.image.name], 1)
+        # nothing else refers to the file: it is still there
+        self.assertTrue(first.image.storage.exists(first.image.name))
+
+    def test_replaced_logo_is_released(self):
+        self.profile.logo = png('red', 'logo.png')
+        self.profile.save()
+        old = self.profile.logo.name
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        profile.logo = png('green', 'logo.png')
+        profile.save()
+        profile.save()
+        self.assertEqual(self.refcounts(), {old: 0, profile.logo.name: 1})
+        rebuild_blob_references()
+        self.assertEqual(self.refcounts(), {old: 0, profile.logo.name: 1})
+
+    def test_processed_bytes_are_not_processed_again(self):
+        first, = _save_profile_photos(self.profile, [png('red')])
+        self.assertEqual(Job.objects.count(), 1)
+        generate_derivatives(first.image)
+
+        again, = _save_profile_photos(self.profile, [png('red', 'again.png')])
+        self.assertEqual(again.image.name, first.image.name)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(ProfileImage.objects.get(pk=again.pk).processing_status, ProfileImage.READY)
+        created = ProfileImage.objects.create(profile=self.profile, image=png('red', 'once more.png'))
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(ProfileImage.objects.get(pk=created.pk).processing_status, ProfileImage.READY)
+        self.assertEqual(self.refcounts(), {first.image.name: 3})
+
+
+class MediaServingTests(TemporaryMediaMixin, TestCase):
+    """serve_media: validators, ranges and caching without reading the file in the view."""
+
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 40
+        self.name = default_storage.save('gallery.jpg', ContentFile(self.content))
+        self.url = reverse('media', args=[self.name])
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file_and_revalidation(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        # the content name is the SHA-256 of the content
+        self.assertEqual(response['ETag'], '"%s"' % hashlib.sha256(self.content).hexdigest())
+
+        revalidated = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_ranges(self):
+        cases = {
+            'bytes=10-19': (206, 'bytes 10-19/10240', self.content[10:20]),
+            'bytes=10240-': (416, 'bytes */10240', None),
+            'bytes=-5': (206, 'bytes 10235-10239/10240', self.content[-5:]),
+            'bytes=10000-': (206, 'bytes 10000-10239/10240', self.content[10000:]),
+            'bytes=10000-99999': (206, 'bytes 10000-10239/10240', self.content[10000:]),
+        }
+        for header, (status, content_range, body) in cases.items():
+            with self.subTest(header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(response['Content-Range'], content_range)
+                if body is not None:
+                    self.assertEqual(response['Content-Length'], str(len(body)))
+                    self.assertEqual(self.body(response), body)
+        for header in ('bytes=0-1,5-6', 'bytes=9-3', 'items=0-1'):
+            with self.subTest(header):
+                self.assertEqual(self.client.get(self.url, HTTP_RANGE=header).status_code, 200)
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag).status_code, 206)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"old"').status_code, 200)
+
+    def test_client_named_files_and_offload(self):
+        # stored before content names
+        os.makedirs(default_storage.path('Img'))
+        with open(default_storage.path('Img/logo.png'), 'wb') as logo:
+            logo.write(b'png')
+        response = self.client.get(reverse('media', args=['Img/logo.png']))
+        self.assertEqual(response['Cache-Control'], f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}')
+        with self.settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect'):
+            response = self.client.get(self.url)
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.name}')
+            self.assertEqual(response.content, b'')
+        for path in ('Img', 'missing.jpg', f'{self.name}/x', 'blobs/.upload-x'):
+            with self.subTest(path):
+                self.assertEqual(self.client.get(reverse('media', args=[path])).status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+
+@override_settings(UPLOAD_MAX_FILE_SIZE=64 * 1024, UPLOAD_MAX_REQUEST_SIZE=256 * 1024, UPLOAD_MAX_FILES=3)
+class ImageUploadHandlerTests(TemporaryMediaMixin, TestCase):
+    """Uploads are streamed to their content name within the quotas, or rejected with a message."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner', 'service_provider')
+        self.profile = make_profile(self.owner, 'Upload Co')
+
+    def post(self, **files):
+        # a fresh session each time: the edit page does not show (and so keeps) the messages
+        self.client.cookies.clear()
+        session = self.client.session
+        session['logged_in_user_id'] = self.owner.id
+        session['logged_in_username'] = self.owner.name
+        session.save()
+        form = {
+            'company_name': 'Upload Co', 'office_address': 'CG road', 'office_number': '0100200340',
+            'gst_number': 'GST', 'pan_number': 'PAN', 'service_type': 'Builders', 'company_description': 'Photos',
+        }
+        return self.client.post(reverse('editprofile'), {**form, **files})
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), settings.MEDIA_ROOT)
+            for directory, _, names in os.walk(settings.MEDIA_ROOT) for name in names
+        )
+
+    def errors(self, response):
+        return [str(message) for message in response.context['messages']]
+
+    @override_settings(UPLOAD_MAX_FILES=4)
+    def test_photos_are_stored_by_content(self):
+        response = self.post(photos=[png('red', 'a.jpg'), png('red', 'b.png'), png('blue', 'c.png')],
+                             logo=png('red', 'logo.gif'))
+        self.assertEqual(response.status_code, 302)
+        names = sorted(self.profile.images.values_list('image', flat=True))
+        self.profile.refresh_from_db()
+        # named after the sniffed format, whatever the client called them
+        self.assertTrue(all(is_content_name(name) and name.endswith('.png') for name in names))
+        self.assertEqual(len(set(names)), 2)
+        self.assertIn(self.profile.logo.name, names)
+        # no temporary files left behind
+        self.assertEqual(self.stored_files(), sorted(set(names)))
+        self.assertEqual(dict(MediaBlob.objects.values_list('name', 'refcount')),
+                         Counter(names + [self.profile.logo.name]))
+
+    def test_rejected_uploads(self):
+        text = SimpleUploadedFile('notes.png', b'just some text, not an image')
+        tiny = SimpleUploadedFile('tiny.png', b'GIF8')
+        huge = SimpleUploadedFile('huge.png', b'\x89PNG\r\n\x1a\n' + bytes(100 * 1024))
+        cases = {
+            'not an image': ([text], ['notes.png: not a JPEG, PNG, GIF or WebP image.']),
+            'too short to tell': ([tiny], ['tiny.png: not a JPEG, PNG, GIF or WebP image.']),
+            'file too large': ([huge], ['huge.png: larger than 0.0625 MB.']),
+            'too many files': ([png(color) for color in ('red', 'green', 'blue', 'white')],
+                               ['photo.png: at most 3 files can be uploaded at once.']),
+        }
+        for label, (photos, errors) in cases.items():
+            with self.subTest(label):
+                response = self.post(photos=photos)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(self.errors(response), errors)
+                self.assertFalse(self.profile.images.exists())
+                self.assertFalse(any('.upload-' in name for name in self.stored_files()))
+
+    def test_request_over_quota_is_not_read(self):
+        photos = [SimpleUploadedFile(f'{i}.png', b'\x89PNG\r\n\x1a\n' + os.urandom(60 * 1024)) for i in range(5)]
+        response = self.post(photos=photos)
+        self.assertEqual(self.errors(response), ['The upload is larger than 0.25 MB in total.'])
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(UPLOAD_MAX_FILE_SIZE=64 * 1024 * 1024, UPLOAD_MAX_REQUEST_SIZE=64 * 1024 * 1024)
+    def test_memory_does_not_grow_with_the_upload(self):
+        def peak(size):
+            upload = SimpleUploadedFile('big.png', b'\x89PNG\r\n\x1a\n' + bytes(size))
+            request = RequestFactory().post('/', {'photos': upload})
+            tracemalloc.start()
+            try:
+                stored = request.FILES['photos']
+                return tracemalloc.get_traced_memory()[1], stored
+            finally:
+                tracemalloc.stop()
+
+        small, _ = peak(1024 * 1024)
+        large, stored = peak(16 * 1024 * 1024)
+        self.assertEqual(default_storage.size(stored.content_name), 16 * 1024 * 1024 + 8)
+        self.assertLess(large, small + 256 * 1024)
+
+
+class MediaCleanupTests(TemporaryMediaMixin, TestCase):
+    """Files are deleted once no committed row refers to them; gc_media removes what is left."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner', 'service_provider')
+        self.profile = make_profile(self.owner, 'Cleanup Co')
+
+    def stored(self, name):
+        return default_storage.exists(name)
+
+    def age(self, *names):
+        # older than MEDIA_ORPHAN_GRACE
+        for name in names:
+            os.utime(default_storage.path(name), (0, 0))
+
+    def test_released_files_are_deleted_on_commit(self):
+        first, second = _save_profile_photos(self.profile, [png('red'), png('red', 'again.png')])
+        derivatives = generate_derivatives(first.image)
+        self.profile.logo = png('green', 'logo.png')
+        self.profile.save()
+        logo = self.profile.logo.name
+        self.age(first.image.name, logo, *derivatives)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProfileImage.objects.filter(pk=second.pk).delete()
+        # still referenced by the first photo
+        self.assertTrue(self.stored(first.image.name))
+
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                profile.logo = png('blue', 'logo.png')
+                profile.save()
+                raise ValueError
+        # rolled back: the old logo is still in use
+        self.assertTrue(self.stored(logo))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = UserProfile.objects.get(pk=self.profile.pk)
+            profile.logo = png('blue', 'logo.png')
+            profile.save()
+        self.assertFalse(self.stored(logo))
+        self.assertFalse(MediaBlob.objects.filter(name=logo).exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner.delete()
+        # recent: the new logo is left to gc_media
+        self.assertTrue(self.stored(profile.logo.name))
+        self.assertFalse(any(self.stored(name) for name in [first.image.name, *derivatives]))
+
+    def test_gc_media(self):
+        photo, = _save_profile_photos(self.profile, [png('red')])
+        kept = [photo.image.name, *generate_derivatives(photo.image)]
+        orphans = [
+            # a client name with a derivative, as stored before demo.storage
+            FileSystemStorage(settings.MEDIA_ROOT).save('Img/logo/old.png', png('green')),
+            default_storage.save('Img/logo/derivatives/old.png.160w.jpg', ContentFile(b'jpeg')),
+            default_storage.save('blobs/.upload-interrupted', ContentFile(b'partial')),
+        ]
+        recent = default_storage.save('new.png', png('blue'))
+        self.age(*kept, *orphans)
+        quarantine = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, quarantine)
+
+        out = StringIO()
+        call_command('gc_media', '--dry-run', stdout=out)
+        self.assertIn('Would remove 3 orphaned file(s)', out.getvalue())
+        self.assertTrue(all(self.stored(name) for name in orphans))
+
+        call_command('gc_media', '--quarantine', quarantine, '--workers', '2', stdout=StringIO())
+        self.assertFalse(any(self.stored(name) for name in orphans))
+        self.assertTrue(all(self.stored(name) for name in [*kept, recent]))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, 'Img', 'logo', 'old.png')))
+
+        out = StringIO()
+        call_command('gc_media', '--grace', '0', stdout=out)
+        self.assertIn('Removed 1 orphaned file(s)', out.getvalue())
+        self.assertFalse(self.stored(recent))
+        self.assertTrue(all(self.stored(name) for name in kept))
+
+
+class OptimizingStaticFilesTests(SimpleTestCase):
+    """collectstatic fingerprints, compresses and slims the assets; missing files are errors (demo.staticfiles)."""
+
+    def setUp(self):
+        super().setUp()
+        self.source, self.root = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for directory in (self.source, self.root):
+            self.addCleanup(shutil.rmtree, directory)
+        static_settings = self.settings(
+            STATICFILES_DIRS=[self.source], STATIC_ROOT=self.root,
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATICFILES_MAX_IMAGE_WIDTH=100,
+            STORAGES={**settings.STORAGES, 'staticfiles': {
+                'BACKEND': 'demo.staticfiles.OptimizingManifestStaticFilesStorage'}},
+        )
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+        self.write('app.css', b'body { background: url(img/wide.png); }\n' * 50)
+        image = BytesIO()
+        Image.linear_gradient('L').resize((400, 100)).save(image, format='PNG')
+        self.write('img/wide.png', image.getvalue())
+        frames = [Image.effect_noise((64, 64), 80).convert('P') for _ in range(2)]
+        image = BytesIO()
+        frames[0].save(image, format='GIF', save_all=True, append_images=frames[1:], duration=100, loop=0)
+        self.write('anim.gif', image.getvalue())
+
+    def write(self, name, content):
+        path = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+
+    def collect(self):
+        call_command('collectstatic', interactive=False, verbosity=0, stdout=StringIO(), stderr=StringIO())
+        return OptimizingManifestStaticFilesStorage(location=self.root)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as file:
+            return file.read()
+
+    def test_text_assets_get_compressed_siblings(self):
+        storage = self.collect()
+        hashed_name = storage.stored_name('app.css')
+        self.assertNotEqual(hashed_name, 'app.css')
+        content = self.read(hashed_name)
+        self.assertIn(storage.stored_name('img/wide.png').encode(), content)
+        self.assertEqual(gzip.decompress(self.read(hashed_name + '.gz')), content)
+        if staticfiles.brotli is None:
+            self.assertFalse(storage.exists(hashed_name + '.br'))
+        else:
+            self.assertEqual(staticfiles.brotli.decompress(self.read(hashed_name + '.br')), content)
+
+    def test_wide_images_are_downscaled(self):
+        storage = self.collect()
+        with Image.open(os.path.join(self.root, storage.stored_name('img/wide.png'))) as image:
+            self.assertEqual(image.size, (100, 25))
+        with Image.open(os.path.join(self.source, 'img/wide.png')) as image:
+            self.assertEqual(image.size, (400, 100))
+
+    def test_gifs_are_converted_to_webp(self):
+        storage = self.collect()
+        webp_name = storage.stored_name('anim.webp')
+        self.assertEqual(webp_name, os.path.splitext(storage.stored_name('anim.gif'))[0] + '.webp')
+        with Image.open(os.path.join(self.root, webp_name)) as image:
+            self.assertEqual((image.format, image.n_frames), ('WEBP', 2))
+        with self.settings(DEBUG=False), mock.patch('demo.templatetags.media_tags.staticfiles_storage', storage):
+            self.assertEqual(media_tags.static_variant('anim.gif', 'webp'), storage.url('anim.webp'))
+            self.assertEqual(media_tags.static_variant('app.css', 'webp'), '')
+        report = json.loads(self.read(staticfiles.REPORT_NAME))
+        self.assertIn('webp', next(entry for entry in report if entry['name'] == 'anim.gif'))
+
+    def test_missing_manifest_entries_are_errors(self):
+        storage = self.collect()
+        with self.assertRaisesMessage(ValueError, "Missing staticfiles manifest entry for 'missing.css'"):
+            storage.stored_name('missing.css')
+        with self.assertRaises(ValueError):
+            storage.url('missing.css')
+
+    def test_missing_references_fail_collectstatic(self):
+        self.write('broken.css', b'body { background: url(img/missing.png); }')
+        with self.assertRaisesMessage(ValueError, 'img/missing.png'):
+            self.collect()
+
+    def test_missing_source_maps_are_logged(self):
+        self.write('lib.js', b'var lib = 1;\n//# sourceMappingURL=lib.js.map\n')
+        with self.assertLogs('demo.staticfiles', 'WARNING') as logs:
+            storage = self.collect()
+        self.assertIn('Source map lib.js.map is referenced but does not exist', logs.output[0])
+        self.assertIn(b'sourceMappingURL=lib.js.map', self.read(storage.stored_name('lib.js')))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SessionFlagsTests(TestCase):
+    """The login flags are displayed from a signed cookie bound to the session (demo.sessions)."""
+
+    FLAGS = {'logged_in_user_id': 7, 'logged_in_username': 'alice', 'is_user': True, 'is_service_provider': False}
+
+    def setUp(self):
+        self.session = SessionStore()
+        self.session.update({**self.FLAGS, 'theme': 'dark'})
+        self.session.save()
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+
+    def flags_cookie(self, session_key):
+        return signing.dumps({'key': session_key, 'flags': self.FLAGS}, salt=FLAGS_COOKIE_SALT)
+
+    def use_cookies(self, session_key, flags):
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+        self.client.cookies[FLAGS_COOKIE_NAME] = flags
+
+    def test_flags_are_displayed_without_loading_the_session(self):
+        store = SessionStore(self.session.session_key, flags=load_flags(
+            self.flags_cookie(self.session.session_key), self.session.session_key,
+        ))
+        with self.assertNumQueries(0):
+            self.assertEqual(store.display_flags(), self.FLAGS)
+        # reading them from the session itself loads it
+        with self.assertNumQueries(1):
+            self.assertEqual(store['logged_in_username'], 'alice')
+        self.assertTrue(store.get('is_user'))
+        self.assertEqual(store['theme'], 'dark')
+        self.assertFalse(store.flags_changed)
+
+        self.use_cookies(self.session.session_key, self.flags_cookie(self.session.session_key))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('about'))
+        self.assertEqual(response.context['logged_in_username'], 'alice')
+
+    def test_cookie_of_another_session_is_ignored(self):
+        other = SessionStore()
+        other.update({'logged_in_username': 'mallory', 'is_user': True})
+        other.save()
+        self.assertIsNone(load_flags(self.flags_cookie(other.session_key), self.session.session_key))
+        self.assertIsNone(load_flags('garbage', self.session.session_key))
+
+        # mallory's own cookie replayed with alice's session key: the flags come from alice's session
+        self.use_cookies(self.session.session_key, signing.dumps(
+            {'key': other.session_key, 'flags': {'logged_in_username': 'mallory'}}, salt=FLAGS_COOKIE_SALT,
+        ))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('about'))
+        self.assertEqual(response.context['logged_in_username'], 'alice')
+        # and the right cookie is issued
+        self.assertEqual(
+            load_flags(response.cookies[FLAGS_COOKIE_NAME].value, self.session.session_key), self.FLAGS,
+        )
+
+    def test_cookie_of_a_deleted_session_is_not_honoured(self):
+        owner = make_user('owner', 'service_provider')
+        profile = make_profile(owner, 'Rated Co')
+        alice = make_user('alice')
+        session = SessionStore()
+        session.update({**self.FLAGS, 'logged_in_user_id': alice.pk})
+        session.save()
+        flags = signing.dumps(
+            {'key': session.session_key, 'flags': {**self.FLAGS, 'logged_in_user_id': alice.pk}},
+            salt=FLAGS_COOKIE_SALT,
+        )
+        # logged out out of band, e.g. by an admin
+        Session.objects.filter(session_key=session.session_key).delete()
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+
+        self.use_cookies(session.session_key, flags)
+        response = self.client.post(reverse('rate_profile', args=[profile.pk]), {'rating': 5})
+        self.assertRedirects(response, reverse('trending'), fetch_redirect_response=False)
+        self.assertFalse(Rating.objects.exists())
+        # and the stale cookie is deleted
+        cookie = response.cookies[FLAGS_COOKIE_NAME]
+        self.assertEqual((cookie.value, cookie['max-age']), ('', 0))
+
+    def test_unchanged_values_do_not_modify_the_session(self):
+        store = SessionStore(self.session.session_key, flags=dict(self.FLAGS))
+        store['is_user'] = True
+        store['logged_in_username'] = 'alice'
+        store['theme'] = 'dark'
+        self.assertFalse(store.modified)
+        store['theme'] = 'light'
+        self.assertTrue(store.modified)
+        store = SessionStore(self.session.session_key, flags=dict(self.FLAGS))
+        store['is_user'] = False
+        self.assertTrue(store.modified)
+
+    def test_flush_and_delete_clear_the_cookie(self):
+        def respond(action):
+            request = RequestFactory().get('/')
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = self.session.session_key
+            request.COOKIES[FLAGS_COOKIE_NAME] = self.flags_cookie(self.session.session_key)
+
+            def view(request):
+                self.assertEqual(request.session['logged_in_username'], 'alice')
+                action(request.session)
+                self.assertIsNone(request.session.get('logged_in_username'))
+                return HttpResponse()
+
+            return SessionMiddleware(view)(request)
+
+        for label, action in {'flush': lambda session: session.flush(), 'delete': lambda session: session.delete()}.items():
+            with self.subTest(label):
+                self.session = SessionStore()
+                self.session.update(self.FLAGS)
+                self.session.save()
+                cookie = respond(action).cookies[FLAGS_COOKIE_NAME]
+                self.assertEqual((cookie.value, cookie['max-age']), ('', 0))
+                self.assertFalse(SessionStore().exists(self.session.session_key))
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    LOGIN_RATE_LIMITS={'ip': (3, 1 / 60), 'account': (2, 1 / 60)},
+)
+class LoginTests(TestCase):
+    """Logging in through ``trending``: legacy passwords, uniform errors and the token buckets."""
+
+    def setUp(self):
+        caches[settings.RATELIMIT_CACHE_ALIAS].clear()
+        self.alice = make_user('alice')
+        self.alice.set_password('secret')
+        self.alice.save()
+        self.clock = mock.Mock(return_value=1_000_000.0)
+        patcher = mock.patch('demo.ratelimit.time', time=self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, name, password, user_type='user', ip='10.0.0.1'):
+        return self.client.post(
+            reverse('trending'), {'name': name, 'confirm_password': password, 'user_type': user_type},
+            REMOTE_ADDR=ip,
+        )
+
+    def error(self, response):
+        return [str(message) for message in response.context['messages']]
+
+    def test_legacy_plaintext_password_is_rehashed(self):
+        legacy = make_user('bob')
+        User.objects.filter(pk=legacy.pk).update(create_password='hunter2', confirm_password='hunter2')
+
+        response = self.login('bob', 'wrong', ip='10.0.0.2')
+        self.assertEqual(self.error(response), ['Invalid username or password.'])
+        self.assertEqual(User.objects.get(pk=legacy.pk).confirm_password, 'hunter2')
+
+        self.assertRedirects(self.login('bob', 'hunter2', ip='10.0.0.3'), reverse('choose'), fetch_redirect_response=False)
+        legacy.refresh_from_db()
+        self.assertEqual(identify_hasher(legacy.confirm_password).algorithm, 'md5')
+        self.assertEqual(legacy.create_password, legacy.confirm_password)
+        self.assertNotIn('hunter2', legacy.confirm_password)
+
+        # the stored hash now does the checking, and is left alone on the next login
+        self.clock.return_value += 60
+        self.client.cookies.clear()
+        self.assertRedirects(self.login('bob', 'hunter2', ip='10.0.0.4'), reverse('choose'), fetch_redirect_response=False)
+        self.assertEqual(User.objects.get(pk=legacy.pk).confirm_password, legacy.confirm_password)
+
+    def test_wrong_password_and_unknown_user_look_the_same(self):
+        wrong = self.login('alice', 'nope', ip='10.0.0.2')
+        unknown = self.login('nobody', 'nope', ip='10.0.0.3')
+        self.assertEqual((wrong.status_code, self.error(wrong)), (200, ['Invalid username or password.']))
+        self.assertEqual((unknown.status_code, self.error(unknown)), (wrong.status_code, self.error(wrong)))
+        self.assertNotIn('logged_in_username', self.client.session)
+        # the user type is only checked once the password matched
+        self.assertEqual(self.error(self.login('alice', 'secret', 'service_provider', ip='10.0.0.4')), ['Incorrect user type.'])
+        # without the password field, both still cost a hash
+        self.clock.return_value += 60
+        for name, ip in (('alice', '10.0.0.5'), ('nobody', '10.0.0.6')):
+            with self.subTest(name), mock.patch('demo.views.make_password', wraps=views.make_password) as hashed, \
+                    mock.patch('demo.models.check_password', wraps=check_password) as checked:
+                missing = self.client.post(reverse('trending'), {'name': name, 'user_type': 'user'}, REMOTE_ADDR=ip)
+            self.assertEqual((missing.status_code, self.error(missing)), (wrong.status_code, self.error(wrong)))
+            self.assertEqual([call.args[0] for call in hashed.call_args_list + checked.call_args_list], [''])
+
+    def test_account_bucket(self):
+        for ip in ('10.0.0.1', '10.0.0.2'):
+            self.assertEqual(self.login('alice', 'nope', ip=ip).status_code, 200)
+        # the account is drained from any address, and case or padding do not give a fresh bucket
+        with self.assertNumQueries(0):
+            response = self.login(' ALICE ', 'secret', ip='10.0.0.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.error(response), ['Too many login attempts. Please try again later.'])
+        self.assertNotIn('logged_in_username', self.client.session)
+        # other accounts are unaffected
+        self.assertEqual(self.login('carol', 'nope', ip='10.0.0.4').status_code, 200)
+
+        # one token comes back per minute
+        self.clock.return_value += 59
+        self.assertEqual(self.login('alice', 'secret', ip='10.0.0.5').status_code, 429)
+        self.clock.return_value += 1
+        self.assertRedirects(self.login('alice', 'secret', ip='10.0.0.6'), reverse('choose'), fetch_redirect_response=False)
+
+    def test_ip_bucket(self):
+        for name in ('alice', 'bob', 'carol'):
+            self.assertEqual(self.login(name, 'nope').status_code, 200)
+        self.assertEqual(self.login('dave', 'nope').status_code, 429)
+        # the correct password does not get through either
+        self.assertEqual(self.login('alice', 'secret').status_code, 429)
+        self.assertEqual(self.login('alice', 'secret', ip='10.0.0.2').status_code, 302)
+
+        self.clock.return_value += 60
+        self.assertEqual(self.login('erin', 'nope').status_code, 200)
+        self.assertEqual(self.login('erin', 'nope').status_code, 429)
+        # a long pause refills the bucket, but only up to its capacity
+        self.clock.return_value += 3600
+        self.assertEqual([self.login(name, 'nope').status_code for name in ('f', 'g', 'h', 'i')], [200, 200, 200, 429])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SignupConcurrencyTests(TransactionTestCase):
+    """Parallel signups for the same name or email: the unique constraints let exactly one through."""
+
+    def signup_in_parallel(self, forms):
+        barrier = threading.Barrier(len(forms))
+        responses = [None] * len(forms)
+
+        def post(index, form):
+            try:
+                client = Client()
+                barrier.wait()
+                responses[index] = client.post(reverse('signup'), form)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post, args=(i, form)) for i, form in enumerate(forms)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def form(self, name, email):
+        return {
+            'name': name, 'email': email, 'contact': '9999999999', 'city': 'Pune',
+            'create_password': 'secret', 'confirm_password': 'secret', 'user_type': 'user',
+        }
+
+    def assert_one_winner(self, responses, message):
+        created = [response for response in responses if response.status_code == 302]
+        rejected = [response for response in responses if response.status_code == 200]
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len(rejected), len(responses) - 1)
+        for response in rejected:
+            self.assertIn(message, [str(m) for m in response.context['messages']])
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_colliding_names(self):
+        responses = self.signup_in_parallel([self.form('same', f'user{i}@example.com') for i in range(6)])
+        self.assert_one_winner(responses, 'Username already exists. Please choose a different username.')
+
+    def test_colliding_emails(self):
+        # the constraint is on lower(email): case variants collide too
+        emails = ['same@example.com', 'Same@Example.com']
+        responses = self.signup_in_parallel([self.form(f'user{i}', emails[i % 2]) for i in range(6)])
+        self.assert_one_winner(responses, 'Email already registered. Please use a different email.')
+
+
+class ApiTests(TemporaryMediaMixin, TestCase):
+    """ETags and 404s of the read-only JSON API (demo.api)."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner', 'service_provider')
+        self.profile = make_profile(self.owner, 'Acme')
+        self.rater = make_user('rater')
+        self.urls = {
+            'feed': reverse('api_service_feed', args=['builders']),
+            'profile': reverse('api_profile', args=[self.profile.pk]),
+        }
+
+    def test_matching_etag_is_not_modified(self):
+        for label, url in self.urls.items():
+            with self.subTest(label):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Cache-Control'], 'no-cache')
+                etag = response['ETag']
+                revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(revalidated.status_code, 304)
+                self.assertEqual(revalidated.content, b'')
+                self.assertEqual(revalidated['ETag'], etag)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_changes_alter_the_etag(self):
+        def change_owner():
+            self.owner.city = 'Pune'
+            self.owner.save()
+
+        changes = {
+            'rating': lambda: upsert_rating(self.profile, self.rater, 4),
+            'rating change': lambda: upsert_rating(self.profile, self.rater, 2),
+            'photo': lambda: ProfileImage.objects.create(profile=self.profile, image=jpeg()),
+            'photo deleted': lambda: ProfileImage.objects.filter(profile=self.profile).delete(),
+            'owner': change_owner,
+        }
+        for label, change in changes.items():
+            with self.subTest(label):
+                before = {name: self.client.get(url)['ETag'] for name, url in self.urls.items()}
+                change()
+                for name, url in self.urls.items():
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=before[name])
+                    self.assertEqual(response.status_code, 200, name)
+                    self.assertNotEqual(response['ETag'], before[name], name)
+        self.assertEqual(self.client.get(self.urls['profile']).json()['city'], 'Pune')
+
+    def test_unknown_service_and_profile(self):
+        self.assertEqual(self.client.get(reverse('api_service_feed', args=['plumbers'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('api_profile', args=[self.profile.pk + 1])).status_code, 404)
+        # and no 304 for an ETag of something that is not there
+        etag = self.client.get(self.urls['profile'])['ETag']
+        missing = reverse('api_profile', args=[self.profile.pk + 1])
+        self.assertEqual(self.client.get(missing, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+
+class InstrumentationTests(TestCase):
+    """Server-Timing, the N+1 warning and the perf_stats window (demo.instrumentation)."""
+
+    def setUp(self):
+        instrumentation.stats.reset()
+        self.addCleanup(instrumentation.stats.reset)
+        self.profile = make_profile(make_user('owner', 'service_provider'), 'Acme')
+
+    def timed(self, get_response, path='/probe/'):
+        """Run ``get_response`` through the middleware as the request of the URL named ``probe``."""
+        request = RequestFactory().get(path)
+        request.resolver_match = mock.Mock(view_name='probe')
+        return instrumentation.RequestTimingMiddleware(get_response)(request)
+
+    def test_server_timing_counts_the_queries(self):
+        url = reverse('profile_detail', args=[self.profile.pk])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertGreater(len(queries), 0)
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'tpl', 'total'})
+        self.assertRegex(timing['db'], r'^dur=\d+\.\d;desc="%d queries"$' % len(queries))
+        self.assertRegex(timing['total'], r'^dur=\d+\.\d$')
+
+        with override_settings(SERVER_TIMING_HEADER=False):
+            self.assertNotIn('Server-Timing', self.client.get(url))
+
+    def test_duplicate_queries_are_logged(self):
+        def repeat(times):
+            def view(request):
+                for _ in range(times):
+                    list(UserProfile.objects.filter(pk=self.profile.pk))
+                return HttpResponse()
+            return view
+
+        threshold = settings.DUPLICATE_QUERY_THRESHOLD
+        with self.assertNoLogs('demo.instrumentation'):
+            response = self.timed(repeat(threshold - 1))
+        self.assertIn('desc="%d queries"' % (threshold - 1), response['Server-Timing'])
+
+        with self.assertLogs('demo.instrumentation', 'WARNING') as logs:
+            self.timed(repeat(threshold))
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('Possible N+1 in probe (GET /probe/): %d executions of SELECT' % threshold, logs.output[0])
+
+        with override_settings(DUPLICATE_QUERY_THRESHOLD=2), self.assertLogs('demo.instrumentation', 'WARNING'):
+            self.timed(repeat(2))
+
+    @override_settings(REQUEST_STATS_WINDOW=3)
+    def test_perf_stats(self):
+        url = reverse('perf_stats')
+        for _ in range(5):
+            self.client.get(reverse('about'))
+
+        self.assertRedirects(self.client.get(url), f"{reverse('admin:login')}?next={url}", fetch_redirect_response=False)
+        self.client.force_login(get_user_model().objects.create_user('clerk', 'clerk@example.com', 'secret'))
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(get_user_model().objects.create_superuser('staff', 'staff@example.com', 'secret'))
+        report = self.client.get(url).json()
+        self.assertEqual(report['window'], 3)
+        about = report['views']['about']
+        # only the last three of the five requests are kept
+        self.assertEqual(about['requests'], 3)
+        self.assertEqual(sum(about['total_ms_histogram'].values()), 3)
+        self.assertEqual(set(about) - {'requests', 'total_ms_histogram'}, set(instrumentation.METRICS))
+        for metric in instrumentation.METRICS:
+            self.assertLessEqual(about[metric]['p50'], about[metric]['max'])
+        self.assertGreater(about['bytes']['p50'], 0)
+        # the rejected requests above were recorded too
+        self.assertEqual(report['views']['perf_stats']['requests'], 2)
+
+        self.assertEqual(self.client.get(url, {'reset': 1}).json()['views'], {})
+        self.assertEqual(list(self.client.get(url).json()['views']), ['perf_stats'])
+
+
+# string and number literals: a query repeated per row differs only in those
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement(sql):
+    return SQL_LITERALS.sub('?', sql)
+
+
+class QueryBudgetMixin:
+    """``assertQueryBudget``: a request's query count must not grow with the data.
+
+    The request is made once per size in ``SIZES``, each time after ``grow(size)``
+    has brought the related rows up to that size. Caches are cleared before every
+    request so cached fragments and sessions hide nothing, and the response is
+    rendered inside the request, so lazy loads from template attribute lookups
+    count too. Rows added by ``grow`` are rolled back afterwards.
+    """
+
+    SIZES = (1, 10, 1000)
+
+    def assertQueryBudget(self, budget, grow, request, status=200):
+        runs = {}
+        with transaction.atomic():
+            # once unmeasured, so the cookies the first response sets (session flags) are in place
+            request()
+            for size in self.SIZES:
+                grow(size)
+                for cache in caches.all():
+                    cache.clear()
+                with CaptureQueriesContext(connection) as ctx:
+                    response = request()
+                self.assertEqual(response.status_code, status)
+                runs[size] = [query['sql'] for query in ctx.captured_queries]
+            transaction.set_rollback(True)
+
+        first, *larger = self.SIZES
+        for smaller, size in zip(self.SIZES, larger):
+            if len(runs[size]) > len(runs[smaller]):
+                grown = Counter(map(statement, runs[size])) - Counter(map(statement, runs[first]))
+                self.fail(
+                    f'{len(runs[smaller])} queries with {smaller} related rows but {len(runs[size])} with {size}; '
+                    'these ran more often:\n' + '\n'.join(f'{n}x {sql}' for sql, n in grown.most_common())
+                )
+        worst = max(runs.values(), key=len)
+        if len(worst) > budget:
+            self.fail(f'{len(worst)} queries, over the budget of {budget}:\n' + '\n'.join(worst))
+
+
+FEED_URL_NAMES = {
+    'Builders': 'builderfeed', 'Architects': 'architectfeed', 'Bathware Suppliers': 'bathwarefeed',
+    'Interior Designers': 'interiorfeed', 'Furniture Retailers': 'furniturefeed',
+    'Electric Solutions': 'electricfeed', 'Garden Solutions': 'gardenfeed',
+    'Fabrications': 'fabricationsfeed', 'Others': 'othersfeed',
+}
+
+
+class ViewQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Every view's query count at 1, 10 and 1000 related rows (profiles, photos, ratings, users)."""
+
+    def setUp(self):
+        self.owner = make_user('owner', 'service_provider')
+        self.profile = make_profile(self.owner, 'Target Co')
+        self.visitor = make_user('visitor')
+
+    def login(self, user):
+        # a fresh session: the signed session flags cookie of the previous user would win.
+        # Pages only display the flags from that cookie; views that act on the login
+        # load the session, which is one query as the caches are cleared
+        self.client.cookies.clear()
+        session = self.client.session
+        session['logged_in_user_id'] = user.id
+        session['logged_in_username'] = user.name
+        session['is_service_provider'] = user.user_type == 'service_provider'
+        session['is_user'] = user.user_type == 'user'
+        session.save()
+
+    def grow_catalogue(self, service_type='Builders'):
+        """``grow`` for the feeds: ``size`` more profiles in ``service_type`` that match the filters tested."""
+        def grow(size):
+            start = User.objects.filter(name__startswith=f'{service_type}-').count()
+            owners = User.objects.bulk_create(
+                User(name=f'{service_type}-{i}', contact=9999999999, email=f'{i}@{slugify(service_type)}.test',
+                     city=('Mumbai', 'Pune')[i % 2], create_password='x', confirm_password='x',
+                     user_type='service_provider')
+                for i in range(start, size)
+            )
+            UserProfile.objects.bulk_create(
+                UserProfile(user=owner, company_name=f'Company {i}', service_type=service_type,
+                            company_description='Company', rating_sum=5 - i % 5, rating_count=1,
+                            avg_rating=5 - i % 5)
+                for i, owner in zip(range(start, size), owners)
+            )
+            # bulk_create sends no signals
+            get_search_backend().rebuild()
+            rebuild_facets()
+        return grow
+
+    def grow_profile(self, size):
+        """``grow`` for the profile pages: ``size`` photos and ``size`` ratings on the target profile."""
+        start = self.profile.images.count()
+        ProfileImage.objects.bulk_create(
+            ProfileImage(profile=self.profile, image=f'Img/profile/photo{i}.jpg') for i in range(start, size)
+        )
+        raters = User.objects.bulk_create(
+            User(name=f'rater{i}', contact=9999999999, email=f'rater{i}@example.com', city='Pune',
+                 create_password='x', confirm_password='x', user_type='user')
+            for i in range(start, size)
+        )
+        Rating.objects.bulk_create(
+            Rating(profile=self.profile, user=rater, rating=i % 5 + 1) for i, rater in zip(range(start, size), raters)
+        )
+        rebuild_rating_aggregates([self.profile.pk])
+
+    def grow_users(self, size):
+        """``grow`` for the account views: ``size`` other users."""
+        start = User.objects.filter(name__startswith='other').count()
+        User.objects.bulk_create(
+            User(name=f'other{i}', contact=9999999999, email=f'other{i}@example.com', city='Pune',
+                 create_password='x', confirm_password='x', user_type='user')
+            for i in range(start, size)
+        )
+
+    def test_static_pages(self):
+        self.login(self.visitor)
+        budgets = {
+            'about': 0, 'contact': 0, 'inquiry': 0, 'otp': 0, 'test': 0, 'trending': 0, 'signup': 0, 'choose': 0,
+            # the precomputed top providers with their profiles and owners (demo.ranking)
+            'index': 1, 'explore': 1,
+        }
+        for name, budget in budgets.items():
+            with self.subTest(name):
+                self.assertQueryBudget(budget, self.grow_catalogue(), lambda: self.client.get(reverse(name)))
+
+    def test_feeds(self):
+        self.login(self.visitor)
+        variants = {
+            # COUNT(*), the page and the facets; a cursor page needs no count
+            '': 3,
+            'q=Company': 3,
+            'city=Mumbai&min_rating=3': 3,
+            'pagination=page&page=2': 3,
+            'pagination=cursor': 2,
+        }
+        for service_type, _ in SERVICE_TYPE_CHOICES:
+            url = reverse(FEED_URL_NAMES[service_type])
+            for query, budget in variants.items():
+                with self.subTest(service_type, query=query):
+                    self.assertQueryBudget(budget, self.grow_catalogue(service_type),
+                                           lambda: self.client.get(f'{url}?{query}'))
+
+    def test_deep_cursor_page(self):
+        url = reverse('builderfeed')
+
+        def request():
+            after = encode_cursor(_service_feed_queryset('Builders').last())
+            return self.client.get(url, {'before': after})
+
+        # the page, the probe for a later page and the facets
+        self.assertQueryBudget(3, self.grow_catalogue(), request)
+
+    def test_profile_pages(self):
+        pages = {
+            'profile_detail (visitor)': (self.visitor, reverse('profile_detail', args=[self.profile.pk]), 4),
+            'profile_detail (owner)': (self.owner, reverse('profile_detail', args=[self.profile.pk]), 3),
+            'companyprofile': (self.owner, reverse('companyprofile'), 3),
+            'editprofile': (self.owner, reverse('editprofile'), 4),
+        }
+        for label, (user, url, budget) in pages.items():
+            with self.subTest(label):
+                self.login(user)
+                self.assertQueryBudget(budget, self.grow_profile, lambda: self.client.get(url))
+
+    def test_editprofile_post(self):
+        self.login(self.owner)
+        form = {
+            'company_name': 'Target Co', 'office_address': 'CG road', 'office_number': '0100200340',
+            'gst_number': 'GST', 'pan_number': 'PAN', 'service_type': 'Builders', 'company_description': 'Renamed',
+        }
+        self.assertQueryBudget(6, self.grow_profile, lambda: self.client.post(reverse('editprofile'), form),
+                               status=302)
+
+    def test_rate_profile(self):
+        self.login(self.visitor)
+        url = reverse('rate_profile', args=[self.profile.pk])
+        # session, user, profile, then the upsert: UPDATE aggregates + INSERT ... ON CONFLICT in a savepoint,
+        # the profile's new score, its category's ProviderRank rows and, as the profile is among
+        # them, their rewrite (SELECT, DELETE, INSERT)
+        self.assertQueryBudget(12, self.grow_profile, lambda: self.client.post(url, {'rating': 4}), status=302)
+
+    def test_account_pages(self):
+        self.login(self.owner)
+        for name in ('createprof', 'edit_account'):
+            with self.subTest(name):
+                self.assertQueryBudget(2, self.grow_users, lambda: self.client.get(reverse(name)))
+
+    def test_edit_account_post(self):
+        self.login(self.visitor)
+        form = {'name': 'visitor', 'contact': '9999999999', 'email': 'visitor@example.com', 'city': 'Surat'}
+        self.assertQueryBudget(6, self.grow_users, lambda: self.client.post(reverse('edit_account'), form),
+                               status=302)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_login_and_signup(self):
+        self.visitor.set_password('secret')
+        self.visitor.save()
+        login = {'name': 'visitor', 'confirm_password': 'secret', 'user_type': 'user'}
+        with self.subTest('trending'):
+            self.assertQueryBudget(5, self.grow_users, lambda: Client().post(reverse('trending'), login), status=302)
+
+        signups = iter(range(len(self.SIZES) + 1))
+
+        def signup():
+            name = f'new{next(signups)}'
+            return Client().post(reverse('signup'), {
+                'name': name, 'contact': '9999999999', 'email': f'{name}@example.com', 'city': 'Pune',
+                'create_password': 'secret', 'confirm_password': 'secret', 'user_type': 'user',
+            })
+
+        with self.subTest('signup'):
+            self.assertQueryBudget(3, self.grow_users, signup, status=302)
+
+    def test_api(self):
+        with self.subTest('api_service_feed'):
+            self.assertQueryBudget(1, self.grow_catalogue(),
+                                   lambda: self.client.get(reverse('api_service_feed', args=['builders'])))
+        with self.subTest('api_profile'):
+            self.assertQueryBudget(2, self.grow_profile,
+                                   lambda: self.client.get(reverse('api_profile', args=[self.profile.pk])))
+
+    def test_staff_stats(self):
+        staff = get_user_model().objects.create_superuser('staff', 'staff@example.com', 'secret')
+        self.client.force_login(staff)
+        for name in ('feed_cache_stats', 'perf_stats'):
+            with self.subTest(name):
+                # the django.contrib.auth session and user
+                self.assertQueryBudget(2, self.grow_catalogue(), lambda: self.client.get(reverse(name)))
+
+
+class BenchmarkCommandTests(TestCase):
+    """The benchmark commands run end to end on a tiny data set.
+
+    They normally create a throw-away database (demo.benchmarks.benchmark_database);
+    here they run in the test database, inside the test's transaction.
+    """
+
+    def call(self, name, *args):
+        out = StringIO()
+        with mock.patch(f'demo.management.commands.{name}.benchmark_database', nullcontext):
+            call_command(name, *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_explain_feed_queries(self):
+        out = self.call('explain_feed_queries', '--profiles', '60')
+        self.assertIn('Seeded 60 profiles', out)
+        for label in ('feed deep cursor page', 'city/rating facets', 'login by email'):
+            self.assertIn(f'{label}: ', out)
+        self.assertIn('All queries use index scans', out)
+
+    def test_generate_load_data(self):
+        out = self.call('generate_load_data', '--providers', '9', '--users', '12', '--ratings', '40', '--prefix', 'tiny')
+        self.assertIn('Generated 21 users, 9 profiles, 40 ratings', out)
+        self.assertEqual(Rating.objects.count(), 40)
+        self.assertEqual(UserProfile.objects.filter(user__name__startswith='tinyprovider').count(), 9)
+        # the aggregates were computed while generating, the rankings rebuilt at the end
+        self.assertEqual(find_rating_aggregate_drift(), [])
+        self.assertTrue(ProviderRank.objects.exists())
+
+        with self.assertRaisesMessage(CommandError, 'Users named tiny... already exist'):
+            self.call('generate_load_data', '--prefix', 'tiny')
+        with self.assertRaisesMessage(CommandError, '200 ratings need more than 2 providers x 3 users'):
+            self.call('generate_load_data', '--providers', '2', '--users', '3', '--ratings', '200', '--prefix', 'x')
+
+    def test_benchmark_routes(self):
+        baseline = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(baseline))
+
+        def run(*args):
+            # each run seeds the same users; start both from the same database and cold caches
+            with transaction.atomic():
+                for cache in caches.all():
+                    cache.clear()
+                out = self.call('benchmark_routes', '--profiles', '20', '--photos', '2', '--rounds', '2',
+                                '--baseline', baseline, *args)
+                transaction.set_rollback(True)
+            return out
+
+        out = run()
+        self.assertIn('Skipping new: ', out)
+        self.assertIn(f'Baseline written to {baseline}', out)
+        with open(baseline) as file:
+            results = json.load(file)['results']['client']
+        self.assertEqual(results['builderfeed q+city+min_rating']['requests'], 2)
+        self.assertIn('rate_profile', results)
+
+        out = run('--threshold', '1000', '--min-delta-ms', '10000', '--query-threshold', '1000')
+        self.assertIn(f'No regressions against {baseline}', out)
+        with self.assertRaisesMessage(CommandError, 'was recorded with'):
+            run('--rounds', '3')
@@ -0,0 +1,150 @@
+"""Bounded, streaming handling of uploaded images.
+
+Django's default handlers keep small uploads in memory and spool larger ones
+to a temporary file, which ``FileSystemStorage`` then copies into
+``MEDIA_ROOT``. ``ImageUploadHandler`` (the only entry of
+``FILE_UPLOAD_HANDLERS``) instead writes each file part, chunk by chunk, to a
+temporary file next to its final location (``demo.storage``). It hashes the
+bytes as they arrive and moves the complete file to its content name. The
+model field save that follows finds it stored already. Memory use does not
+depend on the size of the upload, and no extra copy is written.
+
+It also enforces the upload quotas:
+
+  - a request whose ``Content-Length`` is over ``UPLOAD_MAX_REQUEST_SIZE`` is
+    rejected at its first file, without reading the rest;
+  - a file is dropped once it grows over ``UPLOAD_MAX_FILE_SIZE``, when its
+    first bytes are not a JPEG, PNG, GIF or WebP header, or when the request
+    already had ``UPLOAD_MAX_FILES`` files.
+
+Rejected files are missing from ``request.FILES`` and a message for each is
+in ``request.upload_errors``, which the views show instead of saving.
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers, StopUpload
+
+from .storage import HASH_ALGORITHM
+
+# leading bytes -> (format, extension); WebP is RIFF....WEBP
+SIGNATURES = [
+    (b'\xff\xd8\xff', ('JPEG', '.jpg')),
+    (b'\x89PNG\r\n\x1a\n', ('PNG', '.png')),
+    (b'GIF87a', ('GIF', '.gif')),
+    (b'GIF89a', ('GIF', '.gif')),
+]
+SNIFF_BYTES = 12
+
+
+def _megabytes(size):
+    return f'{size / (1024 * 1024):g} MB'
+
+
+def sniff_image(header):
+    """``(format, extension)`` of an image starting with ``header``, or ``None``."""
+    for signature, kind in SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP', '.webp'
+    return None
+
+
+class StoredUpload(UploadedFile):
+    """An upload ``ImageUploadHandler`` already stored as ``content_name``."""
+
+    def __init__(self, content_name, name, content_type, size, charset=None, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.content_name = content_name
+
+    def open(self, mode='rb'):
+        self.file = default_storage.open(self.content_name, mode)
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """Stream uploaded images to their content-addressed location; see the module docstring."""
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.errors = []
+        self.files = 0
+        self.request_too_large = False
+        self.temporary = None
+        if request is not None:
+            request.upload_errors = self.errors
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # the fields before the first file (the CSRF token) are still read
+        self.request_too_large = content_length > settings.UPLOAD_MAX_REQUEST_SIZE
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        if self.request_too_large:
+            self.errors.append(
+                f'The upload is larger than {_megabytes(settings.UPLOAD_MAX_REQUEST_SIZE)} in total.'
+            )
+            raise StopUpload(connection_reset=True)
+        self.files += 1
+        if self.files > settings.UPLOAD_MAX_FILES:
+            self._reject(f'{file_name}: at most {settings.UPLOAD_MAX_FILES} files can be uploaded at once.')
+        if content_length is not None and content_length > settings.UPLOAD_MAX_FILE_SIZE:
+            self._reject_too_large()
+        self.temporary = default_storage.temporary_file()
+        self.digest = hashlib.new(HASH_ALGORITHM)
+        self.header = b''
+        self.kind = None
+        raise StopFutureHandlers
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.kind is None:
+            self.header = (self.header + raw_data)[:SNIFF_BYTES]
+            if len(self.header) == SNIFF_BYTES:
+                self.kind = sniff_image(self.header)
+                if self.kind is None:
+                    self._reject(f'{self.file_name}: not a JPEG, PNG, GIF or WebP image.')
+        if start + len(raw_data) > settings.UPLOAD_MAX_FILE_SIZE:
+            self._reject_too_large()
+        self.digest.update(raw_data)
+        self.temporary.write(raw_data)
+        # later handlers get nothing: the file is complete here
+
+    def file_complete(self, file_size):
+        if self.temporary is None:
+            return None
+        self.temporary.close()
+        kind = self.kind or sniff_image(self.header)
+        if kind is None:
+            # shorter than the sniffed header
+            self._discard()
+            self.errors.append(f'{self.file_name}: not a JPEG, PNG, GIF or WebP image.')
+            return None
+        name = default_storage.store(self.temporary.name, self.digest.hexdigest(), kind[1])
+        self.temporary = None
+        return StoredUpload(name, self.file_name, self.content_type, file_size,
+                            self.charset, self.content_type_extra)
+
+    def upload_interrupted(self):
+        self._discard()
+
+    def _discard(self):
+        if self.temporary is not None:
+            self.temporary.close()
+            os.unlink(self.temporary.name)
+            self.temporary = None
+
+    def _reject(self, message):
+        self._discard()
+        self.errors.append(message)
+        raise SkipFile
+
+    def _reject_too_large(self):
+        self._reject(f'{self.file_name}: larger than {_megabytes(settings.UPLOAD_MAX_FILE_SIZE)}.')
@@ -1,38 +1,57 @@
 from django.shortcuts import render,redirect
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.contrib import messages
 from django.urls import reverse_lazy
-from .models import User, UserProfile, ProfileImage, SERVICE_TYPE_CHOICES
+from .models import User, UserProfile, ProfileImage, Rating, SERVICE_TYPE_CHOICES
+from . import feed_cache, instrumentation
+from .facets import get_facets
+from .pagination import CursorPage
+from .ranking import top_providers
+from .ratelimit import login_buckets
+from .ratings import upsert_rating
+from .tasks import queue_image_processing
+from .search import get_search_backend
+from .storage import adjust_blob_references
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from django.contrib.auth.hashers import make_password
 
 
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator
-from django.db.models import Avg, Count, Q
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery, Value
+from django.db.models.functions import Lower
 
 
-def _render_service_feed(request, service_label, heading, background_image):
-    """Render a category feed page with profiles filtered by service type.
+def _service_profiles(service_label):
+    """Profiles of one service category.
 
-    Supports GET parameters:
-      - q: text search (company_name, company_description, user.city)
-      - city: exact city filter
-      - min_rating: minimum average rating (1-5)
-      - page: page number for pagination
-      - per_page: items per page
+    Compares ``lower(service_type)`` rather than using ``__iexact`` (a LIKE on SQLite)
+    so the query can use the ``profile_feed_order_idx`` functional index.
     """
-    qs = UserProfile.objects.filter(service_type__iexact=service_label).select_related('user')
-    # annotate averages and counts for filtering and display
-    qs = qs.annotate(avg_rating=Avg('ratings__rating'), rating_count=Count('ratings'))
+    return UserProfile.objects.alias(
+        service_type_lower=Lower('service_type'),
+    ).filter(service_type_lower=Lower(Value(service_label)))
+
 
-    # filters from query params
-    q = request.GET.get('q', '').strip()
-    city = request.GET.get('city', '').strip()
-    min_rating = request.GET.get('min_rating', '').strip()
+def _service_feed_queryset(service_label, q='', city='', min_rating=''):
+    """Filtered and ordered profiles for a category feed (see _render_service_feed)."""
+    # avg_rating / rating_count are stored on the profile (see demo.ratings)
+    qs = _service_profiles(service_label).select_related('user')
 
+    search = get_search_backend()
     if q:
-        qs = qs.filter(Q(company_name__icontains=q) | Q(company_description__icontains=q) | Q(user__city__icontains=q))
+        qs = search.filter(qs, q)
     if city:
-        qs = qs.filter(user__city__iexact=city)
+        qs = qs.alias(city_lower=Lower('user__city')).filter(city_lower=Lower(Value(city)))
     if min_rating:
         try:
             mr = float(min_rating)
@@ -40,33 +59,134 @@ def _render_service_feed(request, service_label, heading, background_image):
         except ValueError:
             pass
 
-    # ordering: show higher rated first, then by company name
-    qs = qs.order_by('-avg_rating', 'company_name')
+    # ordering: best search match first (when searching), then by rank (demo.ranking), then by company name
+    if q and search.ranked:
+        return qs.order_by('search_rank', '-rank_score', 'company_name')
+    return qs.order_by('-rank_score', 'company_name')
 
-    # pagination
+
+def _feed_per_page(request):
+    """The ``per_page`` parameter, 9 by default and at most 100."""
     try:
         per_page = int(request.GET.get('per_page', 9))
     except (TypeError, ValueError):
         per_page = 9
-    paginator = Paginator(qs, per_page)
-    page = request.GET.get('page')
-    page_obj = paginator.get_page(page)
+    return max(1, min(per_page, 100))
 
-    # for city filter dropdown
-    cities = UserProfile.objects.filter(service_type__iexact=service_label).values_list('user__city', flat=True).distinct()
 
-    context = {
+def _render_service_feed(request, service_label, heading, background_image):
+    """Render a category feed page with profiles filtered by service type.
+
+    Supports GET parameters:
+      - q: full-text search over company_name, company_description and user.city (see demo.search)
+      - city: exact city filter
+      - min_rating: minimum average rating (1-5)
+      - page: page number for pagination
+      - after / before: cursor tokens for keyset pagination (see demo.pagination)
+      - pagination: 'cursor' or 'page' to override the category's default mode
+      - per_page: items per page
+    """
+    q, city, min_rating = _feed_filters(request)
+
+    def render_results():
+        qs = _service_feed_queryset(service_label, q, city, min_rating)
+        per_page, use_cursor = _feed_pagination(request, service_label, q)
+        if use_cursor:
+            paginator = None
+            page_obj = CursorPage(qs, per_page, after=request.GET.get('after', ''), before=request.GET.get('before', ''))
+        else:
+            paginator = Paginator(qs, per_page)
+            page = request.GET.get('page')
+            page_obj = paginator.get_page(page)
+        return _render_feed_results(page_obj, paginator, use_cursor, request.GET)
+
+    # the profile list and pagination are identical for every visitor, so they are
+    # rendered once per category/filter combination (see demo.feed_cache)
+    feed_html = feed_cache.get_or_render(service_label, request.GET, render_results)
+
+    # city / min_rating dropdowns with profile counts (precomputed, see demo.facets)
+    facets = get_facets(service_label)
+
+    return render(request, 'demo/Modified_files/service_feed.html',
+                  _feed_page_context(feed_html, facets, heading, background_image, q, city, min_rating))
+
+
+def _feed_filters(request):
+    """The ``(q, city, min_rating)`` filter parameters of a feed request."""
+    return (
+        request.GET.get('q', '').strip(),
+        request.GET.get('city', '').strip(),
+        request.GET.get('min_rating', '').strip(),
+    )
+
+
+def _feed_pagination(request, service_label, q):
+    """``(per_page, use_cursor)`` for a feed request."""
+    after = request.GET.get('after', '')
+    before = request.GET.get('before', '')
+    mode = request.GET.get('pagination')
+    # search results are ordered by relevance, which the cursor does not encode
+    use_cursor = not q and bool(
+        mode == 'cursor' or after or before
+        or (mode != 'page' and service_label in settings.FEED_CURSOR_PAGINATION)
+    )
+    return _feed_per_page(request), use_cursor
+
+
+# the parameters the pagination links carry over to the next page
+FEED_LINK_PARAMS = ('q', 'city', 'min_rating', 'pagination', 'per_page')
+
+
+def _feed_link_query(params):
+    """The ``&``-prefixed, urlencoded query string the pagination links append.
+
+    It is built from the normalized parameters the fragment is cached under
+    (demo.feed_cache), so a cached fragment links the same way for every
+    request that shares it.
+    """
+    normalized = feed_cache.normalize_params(params)
+    query = urlencode({key: normalized[key] for key in FEED_LINK_PARAMS if normalized[key]})
+    return f'&{query}' if query else ''
+
+
+def _render_feed_results(page_obj, paginator, use_cursor, params):
+    return render_to_string('demo/Modified_files/service_feed_results.html', {
         'profiles': page_obj,
         'page_obj': page_obj,
         'paginator': paginator,
+        'cursor_pagination': use_cursor,
+        'link_query': _feed_link_query(params),
+    })
+
+
+def _feed_page_context(feed_html, facets, heading, background_image, q, city, min_rating):
+    return {
+        'feed_html': mark_safe(feed_html),
         'page_heading': heading,
         'background_image': background_image,
         'query': q,
         'selected_city': city,
-        'cities': [c for c in cities if c],
+        'cities': facets['cities'],
+        'rating_options': sorted(facets['min_rating'].items()),
         'min_rating': min_rating,
     }
-    return render(request, 'demo/Modified_files/service_feed.html', context)
+
+
+@staff_member_required
+def feed_cache_stats(request):
+    """Per-category feed cache hit/miss counters of this worker process (admin only)."""
+    if request.GET.get('reset'):
+        feed_cache.stats.reset()
+    return JsonResponse({'alias': settings.FEED_CACHE_ALIAS, 'categories': feed_cache.stats.snapshot()})
+
+
+@staff_member_required
+def perf_stats(request):
+    """Rolling per-URL request timings of this worker process (admin only)."""
+    if request.GET.get('reset'):
+        instrumentation.stats.reset()
+    return JsonResponse({'window': settings.REQUEST_STATS_WINDOW, 'views': instrumentation.stats.snapshot()})
+
 
 def inquiry(request):
     response = ""
@@ -107,12 +227,12 @@ def othersfeed(request):
     return _render_service_feed(request, 'Others', 'Other Services Feed', 'assets/images/others-feed.jpg')
 
 def index(request):
-    return render(request, 'demo/Modified_files/index.html')
+    # the first places of every category, precomputed by demo.ranking
+    return render(request, 'demo/Modified_files/index.html', {'top_providers': top_providers(limit=3)})
 
 def choose(request):
-    is_service_provider = request.session.get('is_service_provider', False)
-    is_user = request.session.get('is_user', False)
-    return render(request, 'demo/Modified_files/choose.html', {'is_service_provider': is_service_provider, 'is_user': is_user})
+    # is_service_provider and is_user come from demo.context_processors.user_flags
+    return render(request, 'demo/Modified_files/choose.html')
 
 def about(request):
     return render(request, 'demo/Modified_files/about.html')
@@ -120,6 +240,34 @@ def about(request):
 def contact(request):       
     return render(request, 'demo/Modified_files/contact.html')
 
+def _rejected_uploads(request):
+    """Messages for the uploaded files of the request that demo.uploads dropped."""
+    request.FILES  # parses the upload
+    return getattr(request, 'upload_errors', [])
+
+
+def _save_profile_photos(profile, files):
+    """Store uploaded photos as is and queue their processing for run_worker.
+
+    Resizing and metadata stripping happen in the background (demo.tasks),
+    so the request only pays for writing the files. Photos whose bytes were
+    uploaded and processed before (demo.storage) are ready at once.
+    """
+    if not files:
+        return []
+    with transaction.atomic():
+        images = ProfileImage.objects.bulk_create([ProfileImage(profile=profile, image=f) for f in files])
+        processed = [image for image in images if image.derivatives.exists()]
+        if processed:
+            ProfileImage.objects.filter(pk__in=[image.pk for image in processed]).update(
+                processing_status=ProfileImage.READY,
+            )
+        queue_image_processing([image for image in images if image not in processed], 'image')
+        # bulk_create sends no post_save
+        adjust_blob_references(Counter(image.image.name for image in images))
+        UserProfile.touch(pk=profile.pk)
+    return images
+
 def createprof(request):
     logged_in_username = request.session.get('logged_in_username')
     service_type_choices = SERVICE_TYPE_CHOICES
@@ -139,8 +287,12 @@ def createprof(request):
         # handle logo upload (optional)
         logo = request.FILES.get('logo')
 
-        if service_type not in valid_service_types:
-            messages.error(request, "Invalid service type selection.")
+        rejected_uploads = _rejected_uploads(request)
+        if service_type not in valid_service_types or rejected_uploads:
+            if service_type not in valid_service_types:
+                messages.error(request, "Invalid service type selection.")
+            for message in rejected_uploads:
+                messages.error(request, message)
             context = {
                 'user_id': user_id,
                 'service_type_choices': service_type_choices,
@@ -181,8 +333,7 @@ def createprof(request):
         if request.FILES:
             # form field name expected: photos (multiple files)
             photos = request.FILES.getlist('photos')
-            for ph in photos:
-                ProfileImage.objects.create(profile=user_profile, image=ph)
+            _save_profile_photos(user_profile, photos)
         request.session['logged_in_user_id'] = user_id
 
         # Redirect to a success page or another URL
@@ -236,8 +387,12 @@ def editprofile(request):
         company_description = request.POST.get('company_description')
         logo = request.FILES.get('logo')
 
-        if service_type not in valid_service_types:
-            messages.error(request, "Invalid service type selection.")
+        rejected_uploads = _rejected_uploads(request)
+        if service_type not in valid_service_types or rejected_uploads:
+            if service_type not in valid_service_types:
+                messages.error(request, "Invalid service type selection.")
+            for message in rejected_uploads:
+                messages.error(request, message)
             context = {
                 'profile': profile,
                 'photos': profile.images.all(),
@@ -262,8 +417,7 @@ def editprofile(request):
             ProfileImage.objects.filter(profile=profile, id__in=delete_photo_ids).delete()
 
         new_photos = request.FILES.getlist('photos')
-        for ph in new_photos:
-            ProfileImage.objects.create(profile=profile, image=ph)
+        _save_profile_photos(profile, new_photos)
 
         request.session['logged_in_user_id'] = user.id
         messages.success(request, "Profile updated successfully.")
@@ -300,18 +454,12 @@ def edit_account(request):
         new_password = request.POST.get('new_password')
         confirm_password = request.POST.get('confirm_password')
 
-        # Validate unique username if it changed
-        if name and name != user.name and User.objects.filter(name=name).exists():
-            messages.error(request, "Username already taken.")
-            return render(request, 'demo/Modified_files/edit_account.html', {'user': user})
-
         # Validate password fields if provided
         if new_password:
             if new_password != confirm_password:
                 messages.error(request, "Passwords do not match.")
                 return render(request, 'demo/Modified_files/edit_account.html', {'user': user})
-            user.create_password = new_password
-            user.confirm_password = confirm_password
+            user.set_password(new_password)
 
         # Update other fields
         if name:
@@ -327,7 +475,20 @@ def edit_account(request):
         if city:
             user.city = city
 
-        user.save()
+        try:
+            # a name or email another account has is rejected by the unique constraints
+            with transaction.atomic():
+                user.save()
+        except IntegrityError:
+            taken = _taken_account_fields(user.name, user.email, exclude_pk=user.pk)
+            if 'name' in taken:
+                messages.error(request, "Username already taken.")
+            elif 'email' in taken:
+                messages.error(request, "Email already registered. Please use a different email.")
+            else:
+                raise
+            user.refresh_from_db()
+            return render(request, 'demo/Modified_files/edit_account.html', {'user': user})
         # update session username if changed
         request.session['logged_in_username'] = user.name
         messages.success(request, "Account updated successfully.")
@@ -554,7 +715,7 @@ def edit_account(request):
 #     return render(request, 'demo/Modified_files/createprof.html')
 
 def explore(request):
-    return render(request, 'demo/Modified_files/explore.html')
+    return render(request, 'demo/Modified_files/explore.html', {'top_providers': top_providers()})
 
 def new(request):
     return render(request, 'demo/Modified_files/new.html')
@@ -565,6 +726,50 @@ def otp(request):
 def test(request):
     return render(request, 'demo/Modified_files/test (1).html')
 
+def _profile_page_context(request, **profile_lookup):
+    """Load the companyprofile.html context for the profile matching ``profile_lookup``.
+
+    Uses at most three queries however many photos or ratings the profile has:
+    the profile with its owner (select_related), its photos (prefetch) and, for
+    a logged-in visitor other than the owner, their user_type and own rating.
+    Returns None if there is no such profile.
+    """
+    profile = (UserProfile.objects.select_related('user').prefetch_related('images')
+               .filter(**profile_lookup).first())
+    if profile is None:
+        return None
+
+    # determine if current logged-in user can rate (regular user and not the owner)
+    logged_in_user_id = request.session.get('logged_in_user_id')
+    is_owner = logged_in_user_id is not None and int(logged_in_user_id) == profile.user_id
+    can_rate = False
+    user_rating = None
+    if logged_in_user_id and not is_owner:
+        viewer = User.objects.filter(pk=int(logged_in_user_id)).annotate(
+            own_rating=Subquery(
+                Rating.objects.filter(profile_id=profile.pk, user_id=OuterRef('pk')).values('rating')[:1]
+            ),
+        ).values('user_type', 'own_rating').first()
+        if viewer and viewer['user_type'] == 'user':
+            can_rate = True
+            user_rating = viewer['own_rating']
+
+    return _profile_context(profile, list(profile.images.all()), is_owner, can_rate, user_rating)
+
+
+def _profile_context(profile, photos, is_owner, can_rate, user_rating):
+    return {
+        'profile': profile,
+        'photos': photos,
+        'is_owner': is_owner,
+        # Ratings summary (denormalized on the profile)
+        'avg_rating': profile.avg_rating,
+        'rating_count': profile.rating_count,
+        'can_rate': can_rate,
+        'user_rating': user_rating,
+    }
+
+
 def companyprofile(request):
     logged_in_user_id = request.session.get('logged_in_user_id')
 
@@ -582,50 +787,14 @@ def companyprofile(request):
             messages.error(request, "User ID not found.")
             return redirect('choose')  # Redirect to a different page or handle the error appropriately
 
-    try:
-        # try to retrieve the profile for the logged in user
-        profile = UserProfile.objects.get(user_id=int(logged_in_user_id))
-    except UserProfile.DoesNotExist:
+    # try to retrieve the profile for the logged in user
+    context = _profile_page_context(request, user_id=int(logged_in_user_id))
+    if context is None:
         # Handle the case where the profile doesn't exist for the given user_id
         messages.error(request, "Profile does not exist for the current user.")
         return redirect('choose')  # Redirect to a different page or handle the error appropriately
 
-    photos = profile.images.all()
-
-    # Ratings summary
-    from django.db.models import Avg, Count
-    rating_agg = profile.ratings.aggregate(avg=Avg('rating'), count=Count('id'))
-    avg_rating = rating_agg['avg'] or 0
-    rating_count = rating_agg['count'] or 0
-
-    # determine if current logged-in user can rate (regular user and not the owner)
-    logged_in_user = None
-    logged_in_user_id = request.session.get('logged_in_user_id')
-    can_rate = False
-    user_rating = None
-    if logged_in_user_id:
-        try:
-            logged_in_user = User.objects.get(id=int(logged_in_user_id))
-        except User.DoesNotExist:
-            logged_in_user = None
-
-    if logged_in_user and logged_in_user.user_type == 'user' and profile.user.id != logged_in_user.id:
-        can_rate = True
-        try:
-            user_rating_obj = profile.ratings.get(user=logged_in_user)
-            user_rating = user_rating_obj.rating
-        except Exception:
-            user_rating = None
-
-    return render(request, 'demo/Modified_files/companyprofile.html', {
-        'profile': profile,
-        'photos': photos,
-        'is_owner': True,
-        'avg_rating': avg_rating,
-        'rating_count': rating_count,
-        'can_rate': can_rate,
-        'user_rating': user_rating,
-    })
+    return render(request, 'demo/Modified_files/companyprofile.html', context)
 
 
 def rate_profile(request, pk):
@@ -657,7 +826,7 @@ def rate_profile(request, pk):
         return redirect('choose')
 
     # prevent owner from rating own profile
-    if profile.user.id == user.id:
+    if profile.user_id == user.id:
         messages.error(request, "You cannot rate your own profile.")
         return redirect('profile_detail', pk=pk)
 
@@ -673,21 +842,14 @@ def rate_profile(request, pk):
 
     comment = request.POST.get('comment')
 
-    # Create or update (model validation will also prevent owner self-rating)
-    from .models import Rating
+    # Create or update in one upsert, validated against the user and profile loaded above
     try:
-        rating_obj, created = Rating.objects.update_or_create(
-            profile=profile,
-            user=user,
-            defaults={'rating': rating_val, 'comment': comment},
-        )
+        upsert_rating(profile, user, rating_val, comment)
+    except ValidationError as e:
+        messages.error(request, '; '.join(e.messages))
+        return redirect('profile_detail', pk=pk)
     except Exception as e:
-        # capture ValidationError or any other exception raised by model.clean/save
-        from django.core.exceptions import ValidationError as DjangoValidationError
-        if isinstance(e, DjangoValidationError):
-            messages.error(request, '; '.join(e.messages))
-        else:
-            messages.error(request, 'Could not save rating: %s' % str(e))
+        messages.error(request, 'Could not save rating: %s' % str(e))
         return redirect('profile_detail', pk=pk)
 
     messages.success(request, "Your rating has been submitted.")
@@ -696,52 +858,12 @@ def rate_profile(request, pk):
 
 def profile_detail(request, pk):
     """Show profile detail with all uploaded photos."""
-    try:
-        profile = UserProfile.objects.get(pk=pk)
-    except UserProfile.DoesNotExist:
+    context = _profile_page_context(request, pk=pk)
+    if context is None:
         messages.error(request, "Profile does not exist.")
         return redirect('choose')
 
-    photos = profile.images.all()
-
-    # Ratings summary
-    from django.db.models import Avg, Count
-    rating_agg = profile.ratings.aggregate(avg=Avg('rating'), count=Count('id'))
-    avg_rating = rating_agg['avg'] or 0
-    rating_count = rating_agg['count'] or 0
-
-    # determine if current logged-in user can rate (regular user and not the owner)
-    logged_in_user = None
-    logged_in_user_id = request.session.get('logged_in_user_id')
-    can_rate = False
-    user_rating = None
-    if logged_in_user_id:
-        try:
-            logged_in_user = User.objects.get(id=int(logged_in_user_id))
-        except User.DoesNotExist:
-            logged_in_user = None
-
-    is_owner = False
-    if logged_in_user and profile.user.id == logged_in_user.id:
-        is_owner = True
-
-    if logged_in_user and logged_in_user.user_type == 'user' and profile.user.id != logged_in_user.id:
-        can_rate = True
-        try:
-            user_rating_obj = profile.ratings.get(user=logged_in_user)
-            user_rating = user_rating_obj.rating
-        except Exception:
-            user_rating = None
-
-    return render(request, 'demo/Modified_files/companyprofile.html', {
-        'profile': profile,
-        'photos': photos,
-        'is_owner': is_owner,
-        'avg_rating': avg_rating,
-        'rating_count': rating_count,
-        'can_rate': can_rate,
-        'user_rating': user_rating,
-    })
+    return render(request, 'demo/Modified_files/companyprofile.html', context)
 
 # def companyprofile(request):
 #     logged_in_user_id = request.session.get('logged_in_user_id')
@@ -794,29 +916,71 @@ def profile_detail(request, pk):
 
 
 
+def _users_by_name_or_email(name, email):
+    """Users named ``name`` or with the (case-insensitive) email ``email``.
+
+    Both sides of the OR are indexed (the unique ``name`` and ``user_email_lower_uniq``).
+    """
+    return User.objects.alias(email_lower=Lower('email')).filter(
+        Q(name=name) | Q(email_lower=Lower(Value(email))),
+    )
+
+
+def _login_candidates(identifier):
+    return _users_by_name_or_email(identifier, identifier)
+
+
+def _taken_account_fields(name, email, exclude_pk=None):
+    """Which of ``'name'`` and ``'email'`` another account already uses, in one query."""
+    taken = set()
+    others = _users_by_name_or_email(name, email).exclude(pk=exclude_pk).values_list('name', 'email')
+    for other_name, other_email in others:
+        if other_name == name:
+            taken.add('name')
+        if other_email.lower() == email.lower():
+            taken.add('email')
+    return taken
+
+
+def _login_user(identifier):
+    """The user logging in as ``identifier``, in one query: a name match wins over an email match."""
+    # only a handful of rows: pick in Python rather than sort in the database
+    return min(_login_candidates(identifier), key=lambda user: (user.name != identifier, user.pk), default=None)
+
+
+def _login_throttled(request, identifier):
+    """Take a token from the caller's per-IP and per-account buckets; True if either is empty."""
+    ip_bucket, account_bucket = login_buckets()
+    # behind a reverse proxy REMOTE_ADDR is the proxy: have it pass the client address on
+    if not ip_bucket.consume(request.META.get('REMOTE_ADDR', '')):
+        return True
+    return not account_bucket.consume(identifier.strip().lower())
+
+
 # original
 def trending(request):
     if request.method == 'POST':
-        name = request.POST.get('name')
-        confirm_password = request.POST.get('confirm_password')
+        name = request.POST.get('name') or ''
+        # a missing password is hashed like any other (make_password(None) returns at once)
+        confirm_password = request.POST.get('confirm_password') or ''
         user_type = request.POST.get('user_type')
 
-        # Check if the user exists in the database by name or email
-        user = None
-        try:
-            # Try to find user by name first
-            user = User.objects.get(name=name)
-        except User.DoesNotExist:
-            # If not found by name, try by email
-            try:
-                user = User.objects.get(email=name)
-            except User.DoesNotExist:
-                messages.error(request, "User does not exist. Please sign up.")
-                return render(request, 'demo/Modified_files/trending.html')
+        # rejected before any query, so credential-stuffing bursts never reach the database
+        if _login_throttled(request, name):
+            messages.error(request, "Too many login attempts. Please try again later.")
+            return render(request, 'demo/Modified_files/trending.html', status=429)
+
+        # Look the user up by name or email in one query
+        user = _login_user(name)
+        if user is None:
+            # hash anyway, so an unknown account takes as long as a wrong password
+            make_password(confirm_password)
+            messages.error(request, "Invalid username or password.")
+            return render(request, 'demo/Modified_files/trending.html')
 
         # Validate password and user_type
-        if user.confirm_password != confirm_password:
-            messages.error(request, "Incorrect password.")
+        if not user.check_password(confirm_password):
+            messages.error(request, "Invalid username or password.")
             return render(request, 'demo/Modified_files/trending.html')
         if user.user_type != user_type:
             messages.error(request, "Incorrect user type.")
@@ -847,16 +1011,6 @@ def signup(request):
         confirm_password = request.POST.get('confirm_password')
         user_type = request.POST.get('user_type')
 
-        # Check if username already exists
-        if User.objects.filter(name=name).exists():
-            messages.error(request, "Username already exists. Please choose a different username.")
-            return render(request, 'demo/Modified_files/signup.html')
-        
-        # Check if email already exists
-        if User.objects.filter(email=email).exists():
-            messages.error(request, "Email already registered. Please use a different email.")
-            return render(request, 'demo/Modified_files/signup.html')
-        
 # Contact validation
         if not contact or not contact.isdigit() or len(contact) < 10:
             messages.error(request, "Invalid contact number. Please enter a valid 10-digit number.")
@@ -866,15 +1020,28 @@ def signup(request):
             messages.error(request, "Passwords do not match. Please enter matching passwords.")
             return render(request, 'demo/Modified_files/signup.html')
         
-        user = User.objects.create(
+        user = User(
             name=name,
             contact=contact,
             email=email,
             city=city,
-            create_password=create_password,
-            confirm_password=confirm_password,
             user_type=user_type
         )
+        user.set_password(create_password)
+        try:
+            # No exists() checks first: the unique constraints on name and lower(email)
+            # decide, so two concurrent signups cannot both take the same name or email.
+            with transaction.atomic():
+                user.save()
+        except IntegrityError:
+            taken = _taken_account_fields(name, email or '')
+            if 'name' in taken:
+                messages.error(request, "Username already exists. Please choose a different username.")
+            elif 'email' in taken:
+                messages.error(request, "Email already registered. Please use a different email.")
+            else:
+                raise
+            return render(request, 'demo/Modified_files/signup.html')
 
         if user_type == 'service_provider':
             # pre-populate session so the new provider can create their profile immediately
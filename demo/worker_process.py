@@ -0,0 +1,17 @@
+"""Entry points of the ``run_worker`` pool processes.
+
+The pool spawns fresh interpreters that unpickle these functions before
+Django is set up, so this module must not import models at import time.
+"""
+import django
+
+
+def initialize():
+    # load settings and apps, which also registers the tasks (see DemoConfig.ready)
+    django.setup()
+
+
+def run(job_id):
+    from .jobs import run_job
+
+    return run_job(job_id)
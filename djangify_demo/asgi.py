@@ -3,6 +3,10 @@ ASGI config for djangify_demo project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+It serves the same sync views as WSGI, each run in Django's thread-sensitive
+executor. Prefer the WSGI application (``python manage.py benchmark_asgi``
+shows why).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
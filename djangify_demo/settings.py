@@ -42,8 +42,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'demo.instrumentation.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'demo.sessions.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -51,7 +52,9 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# Login flags from a signed cookie, everything else cached_db (see demo/sessions.py)
+SESSION_ENGINE = 'demo.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
 ROOT_URLCONF = 'djangify_demo.urls'
 
 LOGIN_TEMPLATE = 'demo/Modified_files/trending.html'
@@ -59,7 +62,8 @@ LOGIN_TEMPLATE = 'demo/Modified_files/trending.html'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the stock backend, timed per request (see demo/instrumentation.py)
+        'BACKEND': 'demo.instrumentation.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'Modified_files')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -84,10 +88,74 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # a file rather than SQLite's shared in-memory database, whose table locks
+        # fail at once instead of waiting: the signup concurrency tests use threads
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
 
+# Full-text search backend for the feed `q` parameter (see demo/search.py).
+# None picks SQLite FTS5 / PostgreSQL tsvector from the database vendor.
+SEARCH_BACKEND = None
+
+
+# Service categories whose feeds default to keyset (cursor) pagination instead of
+# page numbers; any feed switches with ?pagination=cursor (see demo/pagination.py).
+FEED_CURSOR_PAGINATION = ['Builders']
+
+# Feed and homepage ranking (see demo/ranking.py): the average of a profile's
+# ratings and RANKING_PRIOR_WEIGHT virtual ratings of RANKING_PRIOR_MEAN, each
+# real rating counting half as much every RANKING_HALF_LIFE_DAYS. The first
+# RANKING_TOP_N profiles of each category are stored for the home and explore pages.
+RANKING_PRIOR_MEAN = 3.0
+RANKING_PRIOR_WEIGHT = 5
+RANKING_HALF_LIFE_DAYS = 180
+RANKING_TOP_N = 12
+
+
+# Caches
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# LocMemCache is a per-process LRU; point 'feeds' at Redis/Memcached to share it between workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'feeds': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'feeds',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    # write-through cache of the session data; must be shared (Redis/Memcached)
+    # when several processes serve requests, or they see each other's stale copies
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
+# Request instrumentation (see demo/instrumentation.py): requests kept per URL name
+# for the perf_stats view, and how often one SQL statement may run in a request
+# before it is logged as a possible N+1.
+REQUEST_STATS_WINDOW = 1000
+DUPLICATE_QUERY_THRESHOLD = 5
+SERVER_TIMING_HEADER = True
+
+# Rendered service feed fragments (see demo/feed_cache.py)
+FEED_CACHE_ALIAS = 'feeds'
+FEED_CACHE_TIMEOUT = 600
+
+# Login throttling (see demo/ratelimit.py): (burst size, tokens refilled per second)
+# per client IP and per account name/email. Per process with the LocMemCache default.
+RATELIMIT_CACHE_ALIAS = 'default'
+LOGIN_RATE_LIMITS = {
+    'ip': (20, 1 / 6),
+    'account': (5, 1 / 60),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -125,9 +193,41 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# uploads are stored once per content (demo/storage.py); collectstatic
+# fingerprints, compresses and slims the assets (demo/staticfiles.py)
+STORAGES = {
+    'default': {'BACKEND': 'demo.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'demo.staticfiles.OptimizingManifestStaticFilesStorage'},
+}
+STATICFILES_MAX_IMAGE_WIDTH = 1920
+
+# renders pages against the plain static storage (no manifest is collected for tests)
+TEST_RUNNER = 'demo.test_runner.DemoTestRunner'
+
 # Media files (uploads)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# served by demo.media.serve_media: browser cache lifetime of files stored under
+# their client names (content-addressed files are immutable), and the header
+# handing the file to the front-end server ('X-Accel-Redirect' for nginx,
+# 'X-Sendfile' for Apache/lighttpd; None sends it from Django)
+MEDIA_CACHE_MAX_AGE = 24 * 60 * 60
+MEDIA_SENDFILE_HEADER = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+# unreferenced media files are deleted when the transaction releasing them
+# commits (demo.storage.release_blobs) or by manage.py gc_media, unless they
+# were stored or reused less than this many seconds ago
+MEDIA_ORPHAN_GRACE = 15 * 60
+
+# done and failed background jobs (demo.jobs) are deleted by run_worker after this many days
+JOB_RETENTION_DAYS = 7
+
+# Uploaded images are streamed to their content-addressed file as they arrive,
+# within these quotas (see demo/uploads.py)
+FILE_UPLOAD_HANDLERS = ['demo.uploads.ImageUploadHandler']
+UPLOAD_MAX_FILE_SIZE = 10 * 1024 * 1024
+UPLOAD_MAX_REQUEST_SIZE = 50 * 1024 * 1024
+UPLOAD_MAX_FILES = 20
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -15,9 +15,8 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.urls import include, path
-from demo import views
+from demo import api, media, views
 from django.contrib import admin
-from django.conf.urls.static import static
 
 from djangify_demo import settings
 
@@ -48,6 +47,12 @@ urlpatterns = [
     path('profile/<int:pk>/', views.profile_detail, name='profile_detail'),
     path('edit_account.html/', views.edit_account, name='edit_account'),
     path('rate_profile/<int:pk>/', views.rate_profile, name='rate_profile'),
+    path('feed-cache/stats/', views.feed_cache_stats, name='feed_cache_stats'),
+    path('perf/stats/', views.perf_stats, name='perf_stats'),
+    path('api/feeds/<slug:service>/', api.service_feed, name='api_service_feed'),
+    path('api/profiles/<int:pk>/', api.profile, name='api_profile'),
+    # uploads, in production too (see demo/media.py)
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", media.serve_media, name='media'),
     # path('accounts/', include('django.contrib.auth.urls')),
     path('admin/', admin.site.urls),
   # Adjust the URL and view function as needed
@@ -55,7 +60,3 @@ urlpatterns = [
     # path('accounts/', include('accounts.urls'))
 
 ]
-
-if settings.DEBUG:
-        urlpatterns += static(settings.MEDIA_URL,
-                              document_root=settings.MEDIA_ROOT)
\ No newline at end of file